@@ -1,6 +1,6 @@
 import sys
 
-from PySide6.QtGui import QAction, QKeySequence
+from PySide6.QtGui import QAction, QActionGroup, QKeySequence
 from PySide6.QtWidgets import QApplication, QMainWindow
 from src.gui.main_window import Ui_MainWindow
 from src.analysis.project_manager import ProjectManager
@@ -26,6 +26,12 @@ class MainWindow(QMainWindow):
         # Add the 'Save Project' shortcut (Ctrl+S)
         self.add_save_shortcut()
 
+        # Add the 'Undo' and 'Redo' shortcuts (Ctrl+Z, Ctrl+Y or Ctrl+Shift+Z)
+        self.add_undo_shortcuts()
+
+        # Add the options of the projects created or loaded to the File menu
+        self.add_project_options()
+
     def add_save_shortcut(self):
         # Create a QAction for save
         save_action = QAction("Save Project", self)
@@ -35,6 +41,45 @@ class MainWindow(QMainWindow):
         # Add the action to the main window so that the shortcut is active
         self.addAction(save_action)
 
+    def add_undo_shortcuts(self):
+        # Create QActions for undo and redo, with the platform's standard shortcuts
+        undo_action = QAction("Undo", self)
+        undo_action.setShortcut(QKeySequence.Undo)
+        undo_action.triggered.connect(self.project_manager.undo_clicked)
+        redo_action = QAction("Redo", self)
+        redo_action.setShortcuts(QKeySequence.keyBindings(QKeySequence.Redo))
+        redo_action.triggered.connect(self.project_manager.redo_clicked)
+
+        # Cell editors keep their own text undo, as they take the shortcuts while they have the focus
+        self.addAction(undo_action)
+        self.addAction(redo_action)
+
+    def add_project_options(self):
+        # Create a checkable QAction holding the working copy of the projects in RAM
+        in_memory_action = QAction("Hold Projects in Memory", self)
+        in_memory_action.setCheckable(True)
+        in_memory_action.setChecked(self.project_manager.in_memory)
+        in_memory_action.toggled.connect(self.project_manager.set_in_memory)
+
+        # Create a checkable QAction opening the projects as overlays; the two modes cannot be combined
+        overlay_action = QAction("Open Projects Without Copying", self)
+        overlay_action.setCheckable(True)
+        overlay_action.setChecked(self.project_manager.overlay)
+        overlay_action.toggled.connect(self.project_manager.set_overlay)
+        mode_group = QActionGroup(self)
+        mode_group.setExclusionPolicy(QActionGroup.ExclusionPolicy.ExclusiveOptional)
+        mode_group.addAction(in_memory_action)
+        mode_group.addAction(overlay_action)
+        self.ui.menuFile.addActions([in_memory_action, overlay_action])
+
+        # Create QActions choosing the directory of the temporary files
+        self.ui.menuFile.addSeparator()
+        scratch_action = QAction("Set Scratch Folder...", self)
+        scratch_action.triggered.connect(self.project_manager.choose_scratch_folder)
+        project_scratch_action = QAction("Use Project Folders for Scratch Files", self)
+        project_scratch_action.triggered.connect(lambda: self.project_manager.set_scratch_folder(None))
+        self.ui.menuFile.addActions([scratch_action, project_scratch_action])
+
     def closeEvent(self, event):
         # Call a method in ProjectManager to handle unsaved changes, etc.
         if not self.project_manager.check_unsaved_changes():
@@ -1,10 +1,205 @@
+import contextlib
+import functools
 import h5py
+import hashlib
+import itertools
+import json
 import os
 import time
-import shutil
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+from src.utils.archive_reader import ArchiveReader, is_archive
+from src.utils.dat_parser import hash_content, parse_dat_bytes, read_dat_file
+from src.utils.fit_results import (FIT_RESULTS_GROUP, PEAK_FIT_FIELDS, FitResults, legacy_fit_results,
+                                   unknown_fit_fields)
+from src.utils.folder_watcher import FolderWatcher
+from src.utils.import_manifest import MANIFEST_GROUP, ImportManifest
+from src.utils.metadata_table import (METADATA_COLUMNS, METADATA_GROUP, NUMERIC_COLUMNS, MetadataTable,
+                                     legacy_metadata)
+from src.utils.mutation_journal import MutationJournal, encode_call
+from src.utils.project_migration import SCHEMA_VERSION, read_schema_version
+from src.utils.project_repack import REPACK_OPTIONS, REPACK_THRESHOLD, free_space_ratio, repack_project
+from src.utils.spectra_matrix import SPECTRA_GROUP, SpectraMatrix
+from src.utils.spectra_shards import SHARDED_SPECTRA_GROUP, SHARDS_GROUP, SpectraShards, shard_key
+from src.utils.spectrum_feed import FEED_QUEUE_SIZE, SpectrumFeed
+from src.utils.undo_history import UNDO_MEMORY_LIMIT, UndoHistory
+from src.utils.working_copy import (OverlayFile, apply_delta, backup_path, copy_file, delta_matches, reflink_file,
+                                    replace_file, sync_directory)
+from src.utils.h5_storage import (DEFAULT_STORAGE_OPTIONS, PROJECT_FILE_SPACE, copy_member, create_array_dataset,
+                                  create_bytes_dataset, read_bytes_dataset, read_counts_dataset,
+                                  storage_options_from_attr, storage_options_to_attr, validate_storage_options)
+
+# Per-file statuses reported by the bulk import methods
+IMPORT_IMPORTED = 'imported'
+IMPORT_SKIPPED = 'skipped'
+IMPORT_FAILED = 'failed'
+IMPORT_CANCELLED = 'cancelled'
+IMPORT_CONFLICT = 'conflict'  # A different file with the same name is already in the project
+
+CHECKPOINT_INTERVAL = 500  # Number of files written by a bulk import between two flushes of the file and manifest
+
+BLOBS_GROUP = 'blobs'  # Content-addressed store of .DAT payloads, one group per SHA-256 digest
+
+AUTOSAVE_INTERVAL = 300.0  # Seconds between two autosaves of the working copy of the in-memory mode
+IN_MEMORY_HEADROOM = 2.0  # RAM needed by the in-memory mode, as a multiple of the file size: autosaves copy it
+
+SAVE_BACKUPS = 1  # Previous versions of the project file kept by save_project(), as <name>.h5.1, <name>.h5.2...
+
+
+_JOURNAL_OPERATIONS = {'_create_data_group', '_create_calibration_file_group', '_replay_payload', '_replay_file_record',
+                       '_replay_import_record'}  # Methods the journal may replay, see _journaled()
+_REPLAY_BATCHES = {'set_dataset_metadata': ('_replay_metadata', 2),
+                   'set_peak_fit_data': ('_replay_peak_fits', 3)}  # Operation -> (batch method, positional args)
+
+
+def _journaled(method):
+    """
+    Decorator recording the calls of a BrillouinProject method changing the working copy in the journal, once
+    they return, with their arguments as they were before the call, and the calls undoing them in the undo
+    history (see _inverse()). Calls made by another journaled method are part of that call and are not recorded.
+    """
+    _JOURNAL_OPERATIONS.add(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._journal_depth:
+            return method(self, *args, **kwargs)
+        payload = encode_call(method.__name__, args, kwargs) if self._journal is not None else None
+        inverse = self._inverse(method.__name__, args, kwargs)
+        self._journal_depth += 1
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._journal_depth -= 1
+        if payload is not None and self._journal is not None:
+            self._journal.append_payload(payload)
+        self._record_history(method.__name__, inverse)
+        return result
+
+    return wrapper
+
+
+def _copy_attributes(source, target):
+    """Replaces the attributes of an HDF5 object with those of another."""
+    for key in set(target.attrs) - set(source.attrs):
+        del target.attrs[key]
+    for key, value in source.attrs.items():
+        target.attrs[key] = value
+
+
+def _validate_dat_file(dat_file):
+    """
+    Returns a parsed .DAT file, raising ValueError if it holds no channel counts.
+    """
+    if len(dat_file.counts) == 0:
+        raise ValueError(f"No channel counts found in {dat_file.name}.")
+    return dat_file
+
+
+def _read_and_validate_dat_file(file_path):
+    """
+    Reads and parses a .DAT file on a worker thread, raising ValueError if it holds no channel counts.
+    """
+    return _validate_dat_file(read_dat_file(file_path))
+
+
+class _ImportSources:
+    """
+    The files of a bulk import, optionally with the zip and tar archives among them replaced by their .DAT members.
+
+    Iterating yields the path of every loose file and archive member, streaming through tar archives only
+    as far as the import has progressed, and read() reads any of them: loose files with the given read function,
+    archive members by parsing and validating them. Archives that cannot be opened are yielded as is and
+    reading them raises the error.
+    """
+
+    def __init__(self, file_paths, read, expand_archives):
+        self._read = read
+        self._sources = []  # Loose file paths and ArchiveReader objects, in input order
+        self._readers = {}  # Path -> ArchiveReader reading it, for archive members yielded but not read yet
+        self._errors = {}  # Archive path -> error raised when opening it
+        self.total = 0
+        for file_path in file_paths:
+            if expand_archives and is_archive(file_path):
+                try:
+                    reader = ArchiveReader(file_path)
+                except (OSError, ValueError) as e:
+                    self._errors[file_path] = e
+                else:
+                    self._sources.append(reader)
+                    self.total += len(reader)
+                    continue
+            self._sources.append(file_path)
+            self.total += 1
+
+    def __iter__(self):
+        for source in self._sources:
+            if not isinstance(source, ArchiveReader):
+                yield source
+                continue
+            for member_path in source:
+                self._readers[member_path] = source
+                yield member_path
+
+    def read(self, file_path):
+        """Reads a loose file or an archive member; called on the worker threads."""
+        if file_path in self._errors:
+            raise self._errors[file_path]
+        reader = self._readers.pop(file_path, None)
+        if reader is None:
+            return self._read(file_path)
+        return _validate_dat_file(reader.read(file_path))
+
+    def discard(self, file_path):
+        """Releases an archive member that will not be read."""
+        reader = self._readers.pop(file_path, None)
+        if reader is not None:
+            reader.discard(file_path)
+
+    def close(self):
+        for source in self._sources:
+            if isinstance(source, ArchiveReader):
+                source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _FileRecord:
+    """
+    What is stored when a .DAT file is registered: its name, absolute path, size, modification time and content hash.
+    """
+
+    __slots__ = ('name', 'source_path', 'source_size', 'source_mtime', 'content_hash')
+
+    def __init__(self, name, source_path, source_size, source_mtime, content_hash):
+        self.name = name
+        self.source_path = source_path
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.content_hash = content_hash
+
+
+def _read_file_record(file_path):
+    """
+    Reads a .DAT file on a worker thread and returns its _FileRecord, without parsing it.
+    """
+    if is_archive(file_path):
+        raise ValueError(f"{os.path.basename(file_path)} is an archive; archives can be imported but not registered.")
+    stat = os.stat(file_path)
+    with open(file_path, 'rb') as file:
+        raw_content = file.read()
+    if not raw_content:
+        raise ValueError(f"{os.path.basename(file_path)} is empty.")
+    return _FileRecord(os.path.basename(file_path), os.path.abspath(file_path), stat.st_size, stat.st_mtime,
+                       hash_content(raw_content))
+
 
 class BrillouinProject:
     """
@@ -15,7 +210,16 @@ class BrillouinProject:
         project_name (str): The name of the project, used to create the HDF5 file.
         h5file_path (str): The full path to the HDF5 file.
         temp_h5file_path (str): The full path to the temporary HDF5 file.
+        delta_path (str): The full path to the file holding the changes of the overlay mode.
         h5file (h5py.File or None): The handle to the open temporary HDF5 file.
+        in_memory (bool): Whether the temporary file is held in RAM (h5py 'core' driver) instead of on disk.
+        overlay (bool): Whether the project file is opened as a copy-on-write overlay instead of being copied.
+        autosave_interval (float or None): In the in-memory mode, the seconds between two autosaves of the
+                                           working copy to the temporary file; None disables autosaves.
+        repack_threshold (float or None): The free fraction of the working copy above which save_project()
+                                          compacts it; None disables compaction.
+        backups (int): The number of previous versions of the project file kept when it is saved.
+        history (UndoHistory): The changes of the session that can be undone and redone, see undo().
 
     Methods:
         create_h5file(): Creates a new HDF5 file in the specified folder.
@@ -24,6 +228,25 @@ class BrillouinProject:
         remove_calibration(): Removes an existing calibration from the project.
         update_calibration_attributes(): Updates attributes of a calibration.
         add_file_to_calibration(): Adds a file to a calibration.
+        import_files(): Bulk-imports .DAT files, parsing them on a pool of worker threads.
+        import_files_to_calibration(): Bulk-imports .DAT files into a calibration.
+        register_files(): Records .DAT files in the project without parsing them; they are parsed on first access.
+        register_files_to_calibration(): Registers .DAT files in a calibration.
+        materialize_files(): Parses and stores the data of registered files.
+        start_watch_folder(): Watches a directory for .DAT files written by the spectrometer.
+        poll_watch_folder(): Imports the watched files that have been completely written.
+        start_feed(): Listens on a local socket for spectra pushed by the acquisition PC.
+        poll_feed(): Writes the spectra received from the feed.
+        get_blob_statistics(): Reports how much storage the deduplicating blob store saves.
+        get_memory_usage(): Reports the RAM the in-memory mode needs for the project.
+        poll_autosave(): Autosaves the in-memory working copy when the autosave interval has elapsed.
+        get_spectra(): Reads the channel counts of many files at once.
+        set_dataset_metadata(): Sets several metadata values of a file at once.
+        get_metadata_of_datasets(): Reads metadata columns of many files at once from the metadata table.
+        get_file_fit_results(): Reads the peak fit data of a file for all velocities at once.
+        get_velocity_fit_results(): Reads the peak fit data of many files for one velocity at once.
+        consolidate_spectra(): Moves the counts of the files into a single 2-D dataset.
+        set_storage_options(): Sets chunking, compression and dtype narrowing for newly written data.
         remove_file_from_calibration(): Removes a file from a calibration.
         update_calibration_file_data(): Updates file-level data within a calibration.
         update_peak_fit(): Updates peak fit data for a file within a calibration.
@@ -33,29 +256,655 @@ class BrillouinProject:
         list_calibrations(): Lists all calibrations in the project.
         list_files_in_calibration(): Lists all files in a calibration.
         save_project(): Saves the temporary HDF5 file to the main project file.
+        repack(): Saves and compacts the project file, optionally recompressing the data already stored.
         check_unsaved_changes(): Checks if there are unsaved changes.
+        undo(): Undoes the last change, or group of changes (see undo_group()).
+        redo(): Redoes the last change undone.
         cleanup_temp_file(): Cleans up the temporary HDF5 file.
         Other methods for managing pressures, crystals, and datasets.
     """
 
-    def __init__(self, folder, project_name):
+    def __init__(self, folder, project_name, storage_options=None, in_memory=False,
+                 autosave_interval=AUTOSAVE_INTERVAL, scratch_folder=None, overlay=False,
+                 repack_threshold=REPACK_THRESHOLD, backups=SAVE_BACKUPS, undo_limit=UNDO_MEMORY_LIMIT):
         """
         Initializes the BrillouinProject object with the folder path and project name.
 
         Parameters:
             folder (str): The directory where the HDF5 file will be stored.
             project_name (str): The name of the project, used to create the HDF5 file.
+            storage_options (dict or None): Storage options for a new project (see set_storage_options).
+                                            Loaded projects use the options saved with them.
+            in_memory (bool): If True, the working copy is held in RAM instead of a temporary file, so changes
+                              cost no disk writes. It is written to disk only by save_project() and by the
+                              autosaves, which go to the temporary file so that an interrupted session can still
+                              be recovered. See get_memory_usage() to check that a project fits in RAM.
+            autosave_interval (float or None): Seconds between two autosaves in the in-memory mode, or None to
+                                               write the working copy to disk only when the project is saved.
+            scratch_folder (str or None): The directory of the temporary files, e.g. on a tmpfs or a fast local
+                                          SSD, instead of a 'temp' directory in the project folder.
+            overlay (bool): If True, the project file is not copied when it is loaded: the working copy reads from
+                            it and keeps the pages written in a small delta file, so opening takes the same time
+                            whatever the size of the project. Otherwise the project file is copied, as a reflink
+                            where the filesystem supports it.
+            repack_threshold (float or None): The fraction of the working copy left free by removed and replaced
+                                              objects above which save_project() compacts it, or None.
+            backups (int): The number of previous versions of the project file kept by save_project(), the most
+                           recent as '<name>.h5.1'. Rename one to '<name>.h5' to restore it.
+            undo_limit (int): The memory the undo history may hold, in bytes, the oldest changes being forgotten
+                              beyond; 0 disables undo.
+
+        Raises:
+            ValueError: If both in_memory and overlay are True.
         """
+        if in_memory and overlay:
+            raise ValueError("The in-memory and overlay modes cannot be combined.")
         self.folder = folder
+        self.storage_options = validate_storage_options(storage_options or {})
         self.project_name = project_name
         self.h5file_path = os.path.join(folder, f"{project_name}.h5")
 
-        # Create a /temp/ directory within the folder if it doesn't exist
-        temp_folder = os.path.join(folder, "temp")
+        if scratch_folder is None:
+            # Create a /temp/ directory within the folder if it doesn't exist
+            temp_folder, temp_name = os.path.join(folder, "temp"), project_name
+        else:
+            # Projects of the same name in different folders may share the scratch folder
+            digest = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:8]
+            temp_folder, temp_name = scratch_folder, f"{project_name}_{digest}"
         os.makedirs(temp_folder, exist_ok=True)
 
-        self.temp_h5file_path = os.path.join(temp_folder, f"{project_name}_temp.h5")
+        self.temp_h5file_path = os.path.join(temp_folder, f"{temp_name}_temp.h5")
+        self.delta_path = os.path.join(temp_folder, f"{temp_name}_temp.delta")
+        self.journal_path = os.path.join(temp_folder, f"{temp_name}_temp.journal")
+        self.shards_folder = os.path.join(folder, f"{project_name}_shards")  # Shard files of the 'shards' layout
         self.h5file = None  # Handle to the temporary HDF5 file object, initially set to None
+        self.folder_watcher = None  # FolderWatcher used by the watch mode, None when not watching
+        self.feed = None  # SpectrumFeed receiving spectra over a socket, None when not listening
+        self.spectra_matrix = None  # SpectraMatrix of the open file, loaded on first use
+        self.metadata_table = None  # MetadataTable of the open file, loaded on first use
+        self.fit_results = None  # FitResults of the open file, loaded on first use
+        self.spectra_shards = None  # SpectraShards of the project, loaded on first use
+        self.in_memory = in_memory
+        self.overlay = overlay
+        self._overlay_file = None  # OverlayFile the working copy is opened through in the overlay mode
+        self.autosave_interval = autosave_interval
+        self.repack_threshold = repack_threshold
+        self.backups = backups
+        self.history = UndoHistory(undo_limit)
+        self._last_autosave = time.monotonic()  # When the in-memory working copy was last written to disk
+        self._changed_since_autosave = False  # Whether the in-memory working copy changed since then
+        self._changed_paths = None  # Paths of the objects changed since the last save, None if not known
+        self._changed_attrs = set()  # Paths of the objects whose attributes alone changed since the last save
+        self._moves = []  # (old path, new path) of the groups renamed since the last save, in order
+        self._journal = None  # MutationJournal of the changes since the last save, None when not journaling
+        self._journal_depth = 0  # Number of journaled calls in progress, whose inner calls are not recorded
+        self._replaying = False  # Whether the journal is being replayed, which flushes once at the end
+        self._replay_manifest = None  # ImportManifest the replayed import records go to, written at the end
+        self._applying_history = False  # Whether a step of the history is undone or redone, which flushes at the end
+
+    def _flush(self):
+        """
+        Internal method called after each change. Flushes the temporary file, or in the in-memory mode autosaves
+        the working copy if the autosave interval has elapsed.
+        """
+        if self._replaying or self._applying_history:
+            return
+        if self.in_memory:
+            self._changed_since_autosave = True
+            self.poll_autosave()
+        else:
+            self.h5file.flush()
+
+    def _mark_changed(self, *paths, attrs_only=False):
+        """
+        Internal method recording objects of the working copy changed since the last save, by absolute path, so
+        that save_project() only writes those. A path stands for the whole object and everything below it, or
+        with attrs_only for its attributes alone. The attributes of the root are saved anyway. Does not flush.
+        """
+        if self._changed_paths is not None:
+            (self._changed_attrs if attrs_only else self._changed_paths).update(paths)
+
+    def _mark_moved(self, old_path, new_path):
+        """
+        Internal method recording a group renamed in the working copy, so that save_project() renames it in the
+        project file too instead of copying it. Changes recorded below the old path follow the group.
+        """
+        if self._changed_paths is None:
+            return
+
+        def renamed(path):
+            if path == old_path or path.startswith(old_path + '/'):
+                return new_path + path[len(old_path):]
+            return path
+
+        self._changed_paths = {renamed(path) for path in self._changed_paths}
+        self._changed_attrs = {renamed(path) for path in self._changed_attrs}
+        self._moves.append((old_path, new_path))
+
+    def _reset_changes(self, known=True):
+        """
+        Internal method forgetting the recorded changes once the working copy and the project file match, or with
+        known False, when they may differ in ways that were not recorded, so that the next save writes it all.
+        """
+        self._changed_paths = set() if known else None
+        self._changed_attrs = set()
+        self._moves = []
+
+    def _log(self, operation, *args):
+        """
+        Internal method recording in the journal a change made by an internal method, e.g. the import of a file,
+        unless it is part of a journaled call. The operation is the method replaying it. Such changes cannot be
+        undone, so the undo history is forgotten.
+        """
+        if self._journal_depth:
+            return
+        if self._journal is not None:
+            self._journal.append(operation, args)
+        self.history.clear()
+
+    def _start_journal(self):
+        """Internal method starting an empty journal following the project file as it is now."""
+        self._close_journal()
+        self._journal = MutationJournal(self.journal_path, self.h5file_path)
+
+    def _close_journal(self):
+        """Internal method closing the journal, leaving its file in place."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _has_journal(self):
+        """
+        Internal method returning True if the journal of a previous session holds changes that can be replayed
+        on the project file, i.e. it follows the project file as it is now.
+        """
+        if self._journal is not None or not os.path.exists(self.journal_path):
+            return False
+        try:
+            journal = MutationJournal(self.journal_path, self.h5file_path, resume=True)
+        except OSError:
+            return False
+        journal.close()
+        return journal.record_count > 0
+
+    def _replay_journal(self):
+        """
+        Internal method applying the changes of the journal of a previous session to the working copy, which was
+        just opened from the project file, then journaling the new changes after them. A change that fails, e.g.
+        because it failed the same way when it was made, is reported and skipped. Flushes once at the end.
+
+        The edits of the metadata table and of the fit results (_REPLAY_BATCHES) are gathered until another
+        operation, which may depend on them, and applied together, writing each value changed once.
+        """
+        journal = MutationJournal(self.journal_path, self.h5file_path, resume=True)
+        replayed, failed = 0, 0
+        batches = {operation: [] for operation in _REPLAY_BATCHES}
+        self._replaying = True
+        try:
+            for operation, args, kwargs in journal.records(self.h5file):
+                if operation not in _JOURNAL_OPERATIONS:
+                    raise ValueError(f"Unknown operation '{operation}' in {self.journal_path}.")
+                if operation in batches and len(args) == _REPLAY_BATCHES[operation][1] and not kwargs:
+                    batches[operation].append(args)
+                    continue
+                replayed, failed = self._replay_batches(batches, replayed, failed)
+                try:
+                    getattr(self, operation)(*args, **kwargs)
+                    replayed += 1
+                except (KeyError, OSError, ValueError) as e:
+                    print(f"Could not replay {operation}: {e}")
+                    failed += 1
+            replayed, failed = self._replay_batches(batches, replayed, failed)
+        except BaseException:
+            journal.close()
+            raise
+        finally:
+            self._replaying = False
+        if self._replay_manifest is not None:
+            self._checkpoint_import(self._replay_manifest)
+            self._replay_manifest = None
+        self._journal = journal
+        self._flush()
+        print(f"Replayed {replayed} change(s) from the journal" + (f", {failed} failed." if failed else "."))
+
+    def _replay_batches(self, batches, replayed, failed):
+        """
+        Internal method applying and emptying the batches of calls gathered by _replay_journal(). A batch that
+        fails is reported and skipped as a whole. Returns the counts of calls replayed and failed updated.
+        """
+        for operation, calls in batches.items():
+            if not calls:
+                continue
+            try:
+                getattr(self, _REPLAY_BATCHES[operation][0])(calls)
+                replayed += len(calls)
+            except (KeyError, OSError, ValueError) as e:
+                print(f"Could not replay {len(calls)} call(s) of {operation}: {e}")
+                failed += len(calls)
+            calls.clear()
+        return replayed, failed
+
+    def _replay_metadata(self, calls):
+        """
+        Internal method replaying set_dataset_metadata() calls, given as (dataset_name, metadata), writing the
+        values of the metadata table with a single MetadataTable.set_many().
+        """
+        data_group = self.h5file['data']
+        for dataset_name in {dataset_name for dataset_name, _ in calls}:
+            if dataset_name not in data_group:
+                raise ValueError(f"Dataset {dataset_name} does not exist in the HDF5 file.")
+
+        metadata_table = self._get_metadata_table()
+        values = []
+        for dataset_name, metadata in calls:
+            for key, value in metadata.items():
+                if key in METADATA_COLUMNS and dataset_name in metadata_table:
+                    values.append((dataset_name, key, value))
+                else:
+                    data_group[dataset_name].attrs[key] = value
+                    self._mark_changed(data_group[dataset_name].name, attrs_only=True)
+        if metadata_table.set_many(values):
+            self._mark_changed(f'/{METADATA_GROUP}')
+
+    def _replay_peak_fits(self, calls):
+        """
+        Internal method replaying set_peak_fit_data() calls, given as (file_name, velocity_name, data_dict), with
+        a single FitResults.update_many(). The last value of a field wins.
+        """
+        data_group = self.h5file['data']
+        results = {}
+        for file_name, velocity_name, data_dict in calls:
+            results.setdefault((file_name, velocity_name), {}).update(data_dict)
+        for file_name in {file_name for file_name, _ in results}:
+            if file_name not in data_group:
+                raise ValueError(f"Dataset {file_name} does not exist in the HDF5 file.")
+        self._get_fit_results().update_many(results)
+        self._mark_changed(f'/{FIT_RESULTS_GROUP}')
+
+    def _replay_payload(self, group, name, raw_content):
+        """Internal method replaying the storage of the contents of a .DAT file for its group."""
+        self._store_payload(group, parse_dat_bytes(raw_content, name))
+
+    def _replay_import_record(self, *row):
+        """
+        Internal method replaying the record of the outcome of importing a file in the import manifest, which is
+        written at the end of the replay.
+        """
+        if self._replay_manifest is None:
+            self._replay_manifest = ImportManifest(self.h5file)
+        self._replay_manifest.record(*row)
+
+    def _replay_file_record(self, group, name, source_path, source_size, source_mtime, content_hash):
+        """Internal method replaying the storage of the record of a registered file."""
+        self._write_file_record(group, _FileRecord(name, source_path, source_size, source_mtime, content_hash))
+
+    @contextlib.contextmanager
+    def undo_group(self, label):
+        """
+        Gathers the changes made in the block into a single step of the undo history, e.g. the cells of a filled
+        column, so that they are undone and redone together.
+
+        Parameters:
+            label (str): The label of the step, returned by undo() and redo().
+        """
+        self.history.begin(label)
+        try:
+            yield
+        finally:
+            self.history.end()
+
+    def undo(self):
+        """
+        Undoes the last change of the undo history, or group of changes (see undo_group()).
+
+        The history holds the changes to the metadata and arrays of the files, the peak fit data, the pressures,
+        crystals and velocities, as the calls undoing them: the values they replaced, and the datasets they
+        removed, which stay in the working copy until the step is forgotten. Other changes, e.g. imports, removals
+        of files and changes to the calibrations, cannot be undone and forget the history, which is also
+        forgotten when the working copy is reopened. Undoing is journaled like any change.
+
+        Returns:
+            dict: What changed, so that views update only that: 'label' (the label of the step), 'files' (set of
+                  the files whose metadata or arrays changed), 'peak_fits' (set of the files whose fit results
+                  changed) and 'attributes' (set of the project lists changed: 'pressures', 'crystals',
+                  'velocities').
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open or there is nothing to undo.
+        """
+        return self._apply_history(redo=False)
+
+    def redo(self):
+        """
+        Redoes the last change undone, unless a change was made since. See undo().
+
+        Returns:
+            dict: What changed, as returned by undo().
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open or there is nothing to redo.
+        """
+        return self._apply_history(redo=True)
+
+    def _apply_history(self, redo):
+        """
+        Internal method making the calls of the last step of the undo history, or of the redo history, recording
+        their own inverses as the step redoing or undoing it. Flushes once at the end.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        step = self.history.pop(redo)
+        if step is None:
+            raise ValueError(f"Nothing to {'redo' if redo else 'undo'}.")
+        self.history.begin(step.label, replay='redo' if redo else 'undo')
+        self._applying_history = True
+        try:
+            for operation, args, kwargs in reversed(step.calls):
+                getattr(self, operation)(*args, **kwargs)
+        except BaseException:
+            self.history.clear()  # The working copy is between two steps
+            raise
+        finally:
+            self._applying_history = False
+            self.history.end()
+            self._flush()
+
+        changes = {'label': step.label, 'files': set(), 'peak_fits': set(), 'attributes': set()}
+        for operation, args, kwargs in step.calls:
+            if operation in ('set_dataset_metadata', '_remove_array', '_restore_array'):
+                changes['files'].add(args[0])
+            elif operation == 'set_peak_fit_data':
+                changes['peak_fits'].add(args[0])
+            elif operation == '_restore_fit_results':
+                changes['peak_fits'].update(args[1])
+            elif operation in ('add_velocity', 'remove_velocity', 'rename_velocity'):
+                changes['attributes'].add('velocities')
+            elif operation == '_restore_attributes':
+                path, attributes = args
+                if path == '/':
+                    changes['attributes'].update(attributes)
+                else:
+                    changes['files'].add(path.rsplit('/', 1)[1])
+        return changes
+
+    def _inverse(self, operation, args, kwargs):
+        """
+        Internal method returning the calls undoing a call of a journaled method about to be made, as (operation,
+        args, kwargs) in the order to make them, from the state of the working copy before the call, [] if the call
+        changes nothing. Returns None if the call cannot be undone, the method having no _inverse_<operation>
+        method, or if it is about to fail. Nothing is read while the journal is replayed or without a history.
+        """
+        if self._replaying or not self.history.limit or self.h5file is None:
+            return None
+        inverse = getattr(self, '_inverse_' + operation.lstrip('_'), None)
+        if inverse is None:
+            return None
+        try:
+            return inverse(*args, **kwargs)
+        except (KeyError, TypeError, ValueError):
+            return None  # The call fails the same way
+
+    def _record_history(self, operation, inverse):
+        """Internal method recording a call made in the undo history, which is forgotten if it cannot be undone."""
+        if inverse is None:
+            self.history.clear()
+        else:
+            self.history.record(operation.lstrip('_').replace('_', ' ').capitalize(), inverse)
+
+    def _attribute_inverse(self, path, *keys):
+        """Internal method returning the call restoring attributes of an object of the working copy as they are."""
+        attrs = self.h5file[path].attrs
+        return '_restore_attributes', (path, {key: attrs[key] if key in attrs else None for key in keys}), {}
+
+    def _inverse_set_storage_options(self, **options):
+        return [('set_storage_options', (), dict(self.storage_options))]
+
+    def _inverse_set_dataset_metadata(self, dataset_name, metadata):
+        metadata_table = self._get_metadata_table()
+        table_values, attribute_keys = {}, []
+        for key, value in metadata.items():
+            if key in METADATA_COLUMNS and dataset_name in metadata_table:
+                if metadata_table.differs(dataset_name, key, value):
+                    old_value = metadata_table.get(dataset_name, key)
+                    table_values[key] = None if key in NUMERIC_COLUMNS and np.isnan(old_value) else old_value
+            else:
+                attribute_keys.append(key)
+        calls = [('set_dataset_metadata', (dataset_name, table_values), {})] if table_values else []
+        if attribute_keys:
+            calls.append(self._attribute_inverse(self.h5file['data'][dataset_name].name, *attribute_keys))
+        return calls
+
+    def _inverse_add_array_to_dataset(self, dataset_name, array_name, array_data):
+        if array_name in self.h5file['data'][dataset_name]:
+            return None
+        return [('_remove_array', (dataset_name, array_name), {})]
+
+    def _inverse_remove_array(self, dataset_name, array_name):
+        # The dataset is kept open, so that it stays in the working copy once unlinked and is linked back
+        return [('_restore_array', (dataset_name, array_name, self.h5file['data'][dataset_name][array_name]), {})]
+
+    def _inverse_restore_array(self, dataset_name, array_name, dataset):
+        return [('_remove_array', (dataset_name, array_name), {})]
+
+    def _inverse_restore_attributes(self, path, attributes):
+        return [self._attribute_inverse(path, *attributes)]
+
+    def _inverse_add_pressure(self, pressure):
+        return [] if pressure in list(self.h5file.attrs.get('pressures', [])) else [
+            self._attribute_inverse('/', 'pressures')]
+
+    def _inverse_remove_pressure(self, pressure):
+        return [self._attribute_inverse('/', 'pressures')] if pressure in list(self.h5file.attrs['pressures']) else []
+
+    def _inverse_add_crystal(self, crystal):
+        return [] if crystal in list(self.h5file.attrs.get('crystals', [])) else [
+            self._attribute_inverse('/', 'crystals')]
+
+    def _inverse_remove_crystal(self, crystal):
+        return [self._attribute_inverse('/', 'crystals')] if crystal in list(self.h5file.attrs['crystals']) else []
+
+    def _inverse_add_velocity(self, velocity):
+        if velocity in self._get_fit_results().velocities():
+            if velocity in list(self.h5file.attrs.get('velocities', [])):
+                return []
+            return [self._attribute_inverse('/', 'velocities')]
+        return [('remove_velocity', (velocity,), {}), self._attribute_inverse('/', 'velocities')]
+
+    def _inverse_remove_velocity(self, velocity):
+        fit_results = self._get_fit_results()
+        calls = []
+        if velocity in fit_results.velocities():
+            calls.append(('add_velocity', (velocity,), {}))
+            file_names, values = fit_results.stored_results(velocity)
+            if file_names:
+                calls.append(('_restore_fit_results', (velocity, file_names, values), {}))
+        elif velocity not in list(self.h5file.attrs['velocities']):
+            return []
+        calls.append(self._attribute_inverse('/', 'velocities'))  # Keeps the velocity at its place in the list
+        return calls
+
+    def _inverse_rename_velocity(self, old_velocity, new_velocity):
+        if old_velocity == new_velocity or old_velocity not in list(self.h5file.attrs['velocities']):
+            return []
+        if new_velocity in self._get_fit_results().velocities():
+            return None
+        return [('rename_velocity', (new_velocity, old_velocity), {})]
+
+    def _inverse_set_peak_fit_data(self, file_name, velocity_name, data_dict):
+        fit_results = self._get_fit_results()
+        if velocity_name not in fit_results.velocities():
+            return [('remove_velocity', (velocity_name,), {}), self._attribute_inverse('/', 'velocities')]
+        current = fit_results.get(file_name, velocity_name)
+        old_values = {}
+        for field, value in data_dict.items():
+            value = np.nan if value is None else float(value)
+            if not (current[field] == value or (np.isnan(current[field]) and np.isnan(value))):
+                old_values[field] = current[field]
+        return [('set_peak_fit_data', (file_name, velocity_name, old_values), {})] if old_values else []
+
+    def _inverse_restore_fit_results(self, velocity, file_names, values):
+        return [('_restore_fit_results', (velocity, file_names, self._get_fit_results().velocity_results(
+            velocity, file_names)), {})]
+
+    @_journaled
+    def _restore_attributes(self, path, attributes):
+        """
+        Internal method setting attributes of an object of the working copy to the values a change replaced,
+        deleting those whose value is None.
+        """
+        attrs = self.h5file[path].attrs
+        for key, value in attributes.items():
+            if value is None:
+                if key in attrs:
+                    del attrs[key]
+            else:
+                if isinstance(value, np.ndarray) and value.dtype.kind in 'OU':
+                    value = value.tolist()  # Strings are stored as variable-length strings, as when first written
+                attrs[key] = value
+        self._mark_changed(path, attrs_only=True)
+        self._flush()
+
+    @_journaled
+    def _restore_fit_results(self, velocity, file_names, values):
+        """Internal method writing back the fit results of files for a velocity, e.g. after its removal is undone."""
+        self._get_fit_results().set_many(file_names, velocity, values)
+        self._mark_changed(f'/{FIT_RESULTS_GROUP}')
+        self._flush()
+
+    @_journaled
+    def _remove_array(self, dataset_name, array_name):
+        """Internal method removing an array added by add_array_to_dataset(), when that is undone."""
+        group = self.h5file['data'][dataset_name]
+        self._mark_changed(group[array_name].name)
+        del group[array_name]
+        self._flush()
+
+    @_journaled
+    def _restore_array(self, dataset_name, array_name, dataset):
+        """
+        Internal method linking back an array removed by _remove_array(), which the undo history kept open, or
+        writing it from its contents when the journal is replayed.
+        """
+        group = self.h5file['data'][dataset_name]
+        if isinstance(dataset, h5py.Dataset):
+            group[array_name] = dataset
+        else:
+            group.create_dataset(array_name, data=dataset)
+        self._mark_changed(group[array_name].name)
+        self._flush()
+
+    def _open_in_memory(self, source_path=None):
+        """
+        Internal method opening the working copy in RAM. It is named after a file of the folder of the temporary
+        file, so that the paths of its external links and virtual datasets resolve as they do on disk, but not after
+        the temporary file itself, which HDF5 refuses while an autosave of it exists. Nothing is written to disk.
+
+        Parameters:
+            source_path (str or None): The file whose contents are loaded, or None for an empty file.
+        """
+        self._last_autosave = time.monotonic()
+        self._changed_since_autosave = False
+        name = os.path.splitext(self.temp_h5file_path)[0] + '_memory.h5'
+        if source_path is None:
+            return h5py.File(name, 'w', driver='core', backing_store=False)
+        with open(source_path, 'rb') as file:
+            image = file.read()
+        fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+        fapl.set_fapl_core(backing_store=False)
+        fapl.set_file_image(image)
+        return h5py.File(h5py.h5f.open(os.fsencode(name), h5py.h5f.ACC_RDWR, fapl=fapl))
+
+    def _open_overlay(self, resume=False):
+        """
+        Internal method opening the working copy as a copy-on-write overlay of the project file.
+
+        Parameters:
+            resume (bool): Whether to keep the changes of the delta file left by a previous session.
+
+        Raises:
+            OSError: If resume is True and the delta file cannot be reopened, e.g. because the project file was
+                     saved by another session since.
+        """
+        self._overlay_file = OverlayFile(self.h5file_path, self.delta_path, resume=resume)
+        return h5py.File(self._overlay_file, 'r+')
+
+    def _close_working_copy(self):
+        """Internal method closing the working copy and, in the overlay mode, the files under it."""
+        if self.h5file is not None and self.h5file.id:
+            self.h5file.close()
+        self.h5file = None
+        self.history.clear()  # Its steps may hold objects of the working copy
+        if self._overlay_file is not None:
+            self._overlay_file.close()
+            self._overlay_file = None
+
+    def _session_path(self):
+        """Internal method returning the file holding the unsaved changes of a session on disk."""
+        return self.delta_path if self.overlay else self.temp_h5file_path
+
+    def autosave(self):
+        """
+        Writes the working copy of the in-memory mode to the temporary file, from which load_h5file(recover=True)
+        can reopen it if the session ends without closing the project. The file is replaced atomically. In the
+        default mode the temporary file is already up to date, and it is only flushed.
+        """
+        if self.h5file is None:
+            return
+        if not self.in_memory:
+            self.h5file.flush()
+            return
+        self.h5file.flush()  # Moves the chunks still in the caches of the open datasets into the image
+        partial_path = self.temp_h5file_path + '.part'
+        with open(partial_path, 'wb') as file:
+            file.write(self.h5file.id.get_file_image())
+        os.replace(partial_path, self.temp_h5file_path)
+        self._last_autosave = time.monotonic()
+        self._changed_since_autosave = False
+
+    def poll_autosave(self):
+        """
+        Autosaves the in-memory working copy if it changed and the autosave interval has elapsed since the last
+        autosave. Changes call it, and a timer of the interface should too, so that the last changes before a
+        pause are autosaved as well.
+
+        Returns:
+            bool: True if the working copy was written.
+        """
+        if (self.h5file is None or not self.in_memory or not self._changed_since_autosave
+                or self.autosave_interval is None or time.monotonic() - self._last_autosave < self.autosave_interval):
+            return False
+        self.autosave()
+        return True
+
+    def get_memory_usage(self):
+        """
+        Reports the RAM the in-memory mode needs for this project, so it can be chosen for projects that fit.
+
+        Returns:
+            dict: 'in_memory' (bool): whether the working copy is held in RAM;
+                  'file_bytes' (int): the size of the open working copy, or of the project file if none is open;
+                  'required_bytes' (int): the RAM the in-memory mode needs, as autosaves copy the working copy;
+                  'available_bytes' (int or None): the RAM currently available, None if it cannot be read;
+                  'fits_in_memory' (bool or None): whether the required RAM is available, None if unknown.
+        """
+        if self.h5file is not None:
+            file_bytes = self.h5file.id.get_filesize()
+        elif os.path.exists(self.h5file_path):
+            file_bytes = os.path.getsize(self.h5file_path)
+        else:
+            file_bytes = 0
+        required_bytes = int(file_bytes * IN_MEMORY_HEADROOM)
+        try:
+            available_bytes = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            available_bytes = None  # Not available on Windows
+        return {
+            'in_memory': self.in_memory,
+            'file_bytes': file_bytes,
+            'required_bytes': required_bytes,
+            'available_bytes': available_bytes,
+            'fits_in_memory': None if available_bytes is None else required_bytes <= available_bytes,
+        }
 
     def _update_modification_date(self):
         """
@@ -63,29 +912,50 @@ class BrillouinProject:
         """
         if self.h5file is not None:
             self.h5file.attrs['modification_date'] = time.ctime()
-            self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+            self._flush()  # Ensure that the temporary file is immediately updated.
 
     def create_h5file(self):
         """
         Creates a new HDF5 file in the specified folder with the project name and initializes a temporary HDF5 file.
         """
         # Create the original HDF5 file
-        with h5py.File(self.h5file_path, 'w') as h5file:
+        with h5py.File(self.h5file_path, 'w', **PROJECT_FILE_SPACE) as h5file:
             h5file.attrs['creation_date'] = time.ctime()
             h5file.attrs['modification_date'] = time.ctime()
             h5file.attrs['project_name'] = self.project_name
+            h5file.attrs['storage_options'] = storage_options_to_attr(self.storage_options)
+            h5file.attrs['schema_version'] = SCHEMA_VERSION
             h5file.create_group('data')  # Create 'data' group
 
+        self._reset_changes()  # The working copy starts as the file just written, but for its root attributes
+        self._start_journal()
+        self.history.clear()
+        if self.overlay:
+            self.h5file = self._open_overlay()
+            return
+
         # Initialize the temporary HDF5 file
-        self.h5file = h5py.File(self.temp_h5file_path, 'w')
+        self.h5file = self._open_in_memory() if self.in_memory else h5py.File(self.temp_h5file_path, 'w')
         self.h5file.attrs['creation_date'] = time.ctime()
         self._update_modification_date()
         self.h5file.attrs['project_name'] = self.project_name
+        self.h5file.attrs['storage_options'] = storage_options_to_attr(self.storage_options)
+        self.h5file.attrs['schema_version'] = SCHEMA_VERSION
         self.h5file.create_group('data')  # Create 'data' group
 
     def load_all_files_with_metadata(self, file_paths, pressure, crystal):
-        for file_path in file_paths:
-            self.add_file_to_h5(file_path, pressure, crystal)
+        """
+        Adds all provided .DAT file paths to the temporary HDF5 file with the given pressure and crystal.
+
+        Parameters:
+            file_paths (list of str): A list of file paths to .DAT files to be added.
+            pressure (float): The pressure to assign to the files.
+            crystal (str): The crystal to assign to the files.
+
+        Returns:
+            list of dict: The per-file status report returned by import_files().
+        """
+        return self.import_files(file_paths, pressure, crystal)
 
     def load_all_files(self, file_paths):
         """
@@ -93,31 +963,158 @@ class BrillouinProject:
 
         Parameters:
             file_paths (list of str): A list of file paths to .DAT files to be added.
+
+        Returns:
+            list of dict: The per-file status report returned by import_files().
         """
-        for file_path in file_paths:
-            self.add_file_to_h5(file_path)
+        return self.import_files(file_paths)
 
-    def load_h5file(self):
+    def load_h5file(self, recover=False):
         """
-        Loads an existing HDF5 file for reading and writing by copying it to a temporary file.
+        Loads an existing HDF5 file for reading and writing by copying it to a temporary file, into RAM in the
+        in-memory mode, or without copying it in the overlay mode.
+
+        Projects with an older layout (see SCHEMA_VERSION) keep opening: their metadata and fit results are
+        converted into the working copy as it is loaded, see _convert_legacy_layout(), and written by the next
+        save. They can be converted on disk with src.utils.project_migration.
+
+        Parameters:
+            recover (bool): If True and a session ended without closing the project (see
+                            has_recoverable_session()), its unsaved changes are recovered: the changes of its
+                            journal are replayed on the project file, or if it has none that can be replayed, the
+                            temporary file it left behind is reopened.
 
         Raises:
             FileNotFoundError: If the HDF5 file does not exist at the specified path.
+            ValueError: If the project was written by a newer version with a layout this version cannot read.
+            OSError: If the temporary file to recover cannot be opened.
         """
         if not os.path.exists(self.h5file_path):
             raise FileNotFoundError(f"The file {self.h5file_path} does not exist.")
-
-        # Copy the original file to the temporary file
-        shutil.copyfile(self.h5file_path, self.temp_h5file_path)
-        self.h5file = h5py.File(self.temp_h5file_path, 'a')
+        if os.path.exists(self.h5file_path + '.redo'):
+            self._apply_redo_log()  # A save ended while its changes were written into the project file
+        schema_version = read_schema_version(self.h5file_path)
+        if schema_version > SCHEMA_VERSION:
+            raise ValueError(f"{os.path.basename(self.h5file_path)} was written by a newer version of the "
+                             f"application (layout version {schema_version}).")
+        if schema_version < SCHEMA_VERSION:
+            print(f"{os.path.basename(self.h5file_path)} uses the layout version {schema_version}; "
+                  f"run 'python -m src.utils.project_migration' on it to convert it.")
+
+        replaying = recover and self._has_journal()
+        recovering = recover and not replaying and self.has_recoverable_session()
+        self._reset_changes(known=not recovering)  # The changes of the session recovered were not recorded
+        self._close_journal()
+        if self.in_memory:
+            self.h5file = self._open_in_memory(self.temp_h5file_path if recovering else self.h5file_path)
+            print(f"{os.path.basename(self.h5file_path)} is held in memory "
+                  f"({self.h5file.id.get_filesize() / 2 ** 20:.1f} MB).")
+        elif self.overlay:
+            self.h5file = self._open_overlay(resume=recovering)
+        else:
+            if not recovering:
+                # Copy the original file to the temporary file, sharing its blocks where the filesystem can
+                copy_file(self.h5file_path, self.temp_h5file_path)
+            self.h5file = h5py.File(self.temp_h5file_path, 'a')
 
         # Ensure 'data' group exists
         if 'data' not in self.h5file:
             self.h5file.create_group('data')
+            self._mark_changed('/data')
+
+        # Projects created before storage options existed are read as stored and get the defaults for new data
+        if 'storage_options' in self.h5file.attrs:
+            self.storage_options = storage_options_from_attr(self.h5file.attrs['storage_options'])
+        else:
+            self.storage_options = dict(DEFAULT_STORAGE_OPTIONS)
+
+        if schema_version < SCHEMA_VERSION:
+            self._convert_legacy_layout()
+
+        if os.path.isdir(self.shards_folder):
+            # Free the spectra written by sessions that were not saved, and point the views of the temporary file,
+            # which is in another folder, at the shards
+            if self.spectra_shards is not None:
+                self.spectra_shards.close()
+            self.spectra_shards = SpectraShards(self.shards_folder)
+            self.spectra_shards.release_orphans(self._is_live_shard_spectrum, all_spectra=True)
+            self.spectra_shards.flush()
+            if not self.overlay:
+                self.spectra_shards.refresh_views(self.h5file, self.temp_h5file_path)
+                self._flush()
+
+        if replaying:
+            self._replay_journal()
+        elif recovering:
+            # The changes of the temporary file are not all in a journal: journaling resumes at the next save
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        else:
+            self._start_journal()
+        self.history.clear()  # The changes of a previous session cannot be undone
+
+    def has_recoverable_session(self):
+        """
+        Returns True if a previous session ended without closing the project, leaving its journal or its
+        temporary file behind. In the overlay mode, the delta file is looked for instead of the temporary file.
+        """
+        return self.h5file is None and (self._has_journal() or os.path.exists(self._session_path()))
+
+    @_journaled
+    def set_storage_options(self, **options):
+        """
+        Sets the project-level options used to store spectra and raw file contents written from now on.
+        Existing data keeps its layout and remains readable.
+
+        Parameters:
+            compression (str or None): None, 'gzip' or 'lzf'.
+            compression_opts (int): The gzip compression level (0-9).
+            shuffle (bool): Whether to apply the byte shuffle filter before compression.
+            chunks (int or None): The chunk length in elements, or None to let h5py choose.
+            narrow_dtype (bool): Whether to store counts in the smallest integer dtype that fits.
+            spectra_layout (str): 'groups' to link the counts of each file from its group, 'matrix' to store
+                                  the counts of the files under 'data' as the rows of a single 2-D dataset
+                                  (see consolidate_spectra()), or 'shards' to store the counts and raw contents
+                                  of the files under 'data' in one file per shard, in the '<project>_shards'
+                                  folder. Calibration files always use 'groups'.
+            shard_by (str): How the 'shards' layout splits the files: 'pressure' or 'day' (of acquisition).
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open or an option is invalid.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+
+        self.storage_options = validate_storage_options({**self.storage_options, **options})
+        self.h5file.attrs['storage_options'] = storage_options_to_attr(self.storage_options)
+        self._flush()  # Ensure that the temporary file is immediately updated.
+
+    def get_storage_options(self):
+        """Return a copy of the project-level storage options."""
+        return dict(self.storage_options)
 
     def add_metadata_to_dataset(self, dataset_name, key, value):
         """
         Adds a key-value pair as metadata to a specific dataset within the temporary HDF5 file.
+
+        The keys of the metadata table (METADATA_COLUMNS) are stored in the table; other keys are stored as
+        attributes of the dataset group.
+        """
+        self.set_dataset_metadata(dataset_name, {key: value})
+
+    @_journaled
+    def set_dataset_metadata(self, dataset_name, metadata):
+        """
+        Sets several metadata key-value pairs of a dataset at once, like add_metadata_to_dataset().
+        The file is flushed once, and only if a value changed.
+
+        Parameters:
+            dataset_name (str): The name of the dataset.
+            metadata (dict): The values by key. For the numeric keys of the metadata table, None clears the value.
+
+        Raises:
+            ValueError: If the dataset does not exist, or a numeric value of the metadata table is not a number,
+                        in which case no value is set.
         """
         if self.h5file is None:
             raise ValueError(
@@ -129,11 +1126,26 @@ class BrillouinProject:
             print('Error in add_metadata_to_dataset')
             raise ValueError(f"Dataset {dataset_name} does not exist in the HDF5 file.")
 
-        group = data_group[dataset_name]
-        group.attrs[key] = value
+        metadata_table = self._get_metadata_table()
+        if dataset_name in metadata_table:
+            for key, value in metadata.items():
+                if key in METADATA_COLUMNS:
+                    metadata_table.check(key, value)  # Before anything is written, so a row is never half set
+        changed = False
+        for key, value in metadata.items():
+            if key in METADATA_COLUMNS and dataset_name in metadata_table:
+                if metadata_table.set(dataset_name, key, value):
+                    self._mark_changed(f'/{METADATA_GROUP}')
+                    changed = True
+            else:
+                data_group[dataset_name].attrs[key] = value
+                self._mark_changed(data_group[dataset_name].name, attrs_only=True)
+                changed = True
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        if changed:
+            self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def add_array_to_dataset(self, dataset_name, array_name, array_data):
         """
         Adds a new array to the specified dataset within the temporary HDF5 file.
@@ -157,10 +1169,12 @@ class BrillouinProject:
             raise ValueError(f"Dataset {dataset_name} does not exist in the HDF5 file.")
 
         group = data_group[dataset_name]
-        group.create_dataset(array_name, data=array_data)
+        dataset = group.create_dataset(array_name, data=array_data)
+        self._mark_changed(dataset.name)
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def add_pressure(self, pressure):
         """Add a new pressure to the project."""
         if self.h5file is None:
@@ -174,8 +1188,9 @@ class BrillouinProject:
             pressures.append(pressure)
             self.h5file.attrs['pressures'] = pressures
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def add_crystal(self, crystal):
         """Add a new crystal to the project."""
         if self.h5file is None:
@@ -189,8 +1204,9 @@ class BrillouinProject:
             crystals.append(crystal)
             self.h5file.attrs['crystals'] = crystals
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def remove_crystal(self, crystal):
         """Remove an existing crystal from the project."""
         if self.h5file is None:
@@ -201,8 +1217,9 @@ class BrillouinProject:
             crystals.remove(crystal)
             self.h5file.attrs['crystals'] = crystals
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def remove_dataset(self, dataset_name):
         """
         Removes a dataset (group) from the temporary HDF5 file.
@@ -223,11 +1240,28 @@ class BrillouinProject:
             print('Error in remove_dataset')
             raise ValueError(f"Dataset {dataset_name} does not exist in the HDF5 file.")
 
+        self._release_blobs(data_group[dataset_name])
+        if 'shard' in data_group[dataset_name].attrs:
+            # The spectrum is freed once the removal is saved
+            self._get_spectra_shards().discard(self._shard_entry(data_group[dataset_name]))
+        spectra_matrix, metadata_table, fit_results = (self._get_spectra_matrix(), self._get_metadata_table(),
+                                                       self._get_fit_results())
+        if dataset_name in spectra_matrix:
+            spectra_matrix.remove(dataset_name)
+            self._mark_changed(f'/{SPECTRA_GROUP}')
+        if dataset_name in metadata_table:
+            metadata_table.remove(dataset_name)
+            self._mark_changed(f'/{METADATA_GROUP}')
+        if dataset_name in fit_results:
+            fit_results.remove_file(dataset_name)
+            self._mark_changed(f'/{FIT_RESULTS_GROUP}')
+        self._mark_changed(data_group[dataset_name].name)
         del data_group[dataset_name]
         print(f"Dataset {dataset_name} has been removed from the HDF5 file.")
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def add_calibration(self, calibration_name, mirror_spacing=np.nan, laser_wavelength=np.nan, scattering_angle=np.nan):
         """
         Adds a new calibration to the project.
@@ -251,9 +1285,11 @@ class BrillouinProject:
         calibration_group.attrs['mirror_spacing'] = mirror_spacing
         calibration_group.attrs['laser_wavelength'] = laser_wavelength
         calibration_group.attrs['scattering_angle'] = scattering_angle
+        self._mark_changed(calibration_group.name)
 
-        self.h5file.flush()
+        self._flush()
 
+    @_journaled
     def rename_calibration(self, old_name, new_name):
         """
         Renames an existing calibration.
@@ -263,135 +1299,648 @@ class BrillouinProject:
             new_name (str): The new name for the calibration.
 
         Raises:
-            ValueError: If the calibration does not exist or the new name is already in use.
+            ValueError: If the calibration does not exist or the new name is already in use.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+
+        if 'calibrations' not in self.h5file:
+            raise ValueError("No calibrations exist in the project.")
+
+        if old_name not in self.h5file['calibrations']:
+            raise ValueError(f"Calibration '{old_name}' does not exist.")
+
+        if new_name in self.h5file['calibrations']:
+            raise ValueError(f"Calibration '{new_name}' already exists.")
+
+        # Only the link to the group is renamed: its objects, attributes and soft links into the blob store
+        # stay where they are, so the rename takes the same time whatever the size of the calibration
+        self.h5file['calibrations'].move(old_name, new_name)
+        self._mark_moved(f'/calibrations/{old_name}', f'/calibrations/{new_name}')
+
+        # Flush the changes to disk
+        self._flush()
+
+    @_journaled
+    def remove_pressure(self, pressure):
+        """Remove an existing pressure from the project."""
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+
+        pressures = list(self.h5file.attrs['pressures'])
+        if pressure in pressures:
+            pressures.remove(pressure)
+            self.h5file.attrs['pressures'] = pressures
+
+        self._flush()  # Ensure that the temporary file is immediately updated.
+
+    @_journaled
+    def remove_calibration(self, calibration_name):
+        """
+        Removes an existing calibration from the project.
+
+        Parameters:
+            calibration_name (str): The name of the calibration to remove.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        if 'calibrations' not in self.h5file or calibration_name not in self.h5file['calibrations']:
+            raise ValueError(f"Calibration '{calibration_name}' does not exist.")
+
+        self._release_blobs(self.h5file['calibrations'][calibration_name])
+        self._mark_changed(self.h5file['calibrations'][calibration_name].name)
+        del self.h5file['calibrations'][calibration_name]
+        self._flush()
+
+    def add_file_to_h5(self, file_path, pressure=np.nan, crystal=''):
+        """
+        Adds the contents of a single .dat file to the temporary HDF5 file.
+        """
+        if self.h5file is None:
+            raise ValueError(
+                "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
+
+        dataset_name = os.path.basename(file_path)
+
+        data_group = self.h5file['data']
+
+        if dataset_name in data_group:
+            print(f"Dataset {dataset_name} already exists in the HDF5 file. Skipping.")
+            return
+
+        # Read and parse the file in a single pass before touching the HDF5 file
+        dat_file = read_dat_file(file_path)
+        self._write_data_file(dat_file, pressure, crystal)
+
+        self._flush()  # Ensure that the temporary file is immediately updated.
+
+    def _write_data_file(self, dat_file, pressure, crystal):
+        """
+        Internal method to write a parsed .DAT file as a new group under 'data'. Does not flush.
+        """
+        group = self._create_data_group(dat_file.name, pressure, crystal)
+
+        # Add the file content
+        self._store_payload(group, dat_file)
+
+    def _create_data_group(self, name, pressure, crystal):
+        """
+        Internal method to create the group of a file under 'data' with its metadata, but without its content.
+        Its fit results are NaN until set_peak_fit_data() is called. Does not flush.
+        """
+        metadata_table = self._get_metadata_table()
+
+        # Create the dataset under 'data' group
+        group = self.h5file['data'].create_group(name)
+
+        # The metadata goes to the metadata table; fields not given are NaN (numbers) or '' (names)
+        metadata_table.add(name, pressure=pressure, crystal=crystal)
+        self._mark_changed(group.name, f'/{METADATA_GROUP}')
+        self._log('_create_data_group', name, pressure, crystal)
+
+        return group
+
+    def import_files(self, file_paths, pressure=np.nan, crystal='', max_workers=None, progress_callback=None,
+                     cancel_event=None):
+        """
+        Bulk-imports .DAT files into the 'data' group of the temporary HDF5 file.
+
+        Files are read, parsed and validated on a pool of worker threads while the calling thread acts as
+        the single writer, appending each parsed file to the HDF5 file as soon as it is ready. The number of
+        parsed files waiting to be written is bounded, so memory use does not grow with the size of the batch.
+
+        Zip and tar (optionally gzip, bzip2 or xz compressed) archives among the paths are imported member by
+        member without being extracted to disk. Zip members are decompressed in parallel by the worker threads;
+        tar archives are streamed in order by the calling thread while the workers parse the members. The report
+        then has one entry per .DAT member, with 'file_path' made of the archive path and the member name.
+
+        The import is idempotent: the outcome for each file is kept in the import manifest of the project
+        (see get_import_manifest()), and files already imported that have not changed since (same size and
+        modification time) are skipped without being read. A file whose name is already in the project is
+        skipped if its contents are identical and reported as a conflict otherwise. The file and the manifest
+        are flushed every CHECKPOINT_INTERVAL files, so an interrupted import resumes where it stopped.
+
+        Parameters:
+            file_paths (list of str): The paths of the .DAT files or archives to import.
+            pressure (float): The pressure to assign to the imported files.
+            crystal (str): The crystal to assign to the imported files.
+            max_workers (int or None): The number of parser threads. Defaults to the number of CPUs.
+            progress_callback (callable or None): Called on the writer thread as progress_callback(done, total, entry)
+                                                  after each file has been handled.
+            cancel_event (threading.Event or None): When set, files not yet written are reported as cancelled.
+
+        Returns:
+            list of dict: One entry per file path, in input order, with keys 'file_path', 'name', 'status'
+                          (one of IMPORT_IMPORTED, IMPORT_SKIPPED, IMPORT_FAILED, IMPORT_CANCELLED, IMPORT_CONFLICT),
+                          'message', 'channels' and 'scans' (the number of scans given by the header as a float,
+                          or None), so callers on other threads can show the files without reading the project.
+        """
+        if self.h5file is None:
+            raise ValueError(
+                "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
+
+        data_group = self.h5file['data']
+
+        def write(file_path, dat_file):
+            if dat_file.name in data_group:
+                return self._existing_file_status(data_group[dat_file.name], dat_file.content_hash)
+            self._write_data_file(dat_file, pressure, crystal)
+            return IMPORT_IMPORTED, ''
+
+        return self._bulk_import(file_paths, write, max_workers, progress_callback, cancel_event,
+                                 manifest_group=data_group, expand_archives=True)
+
+    def import_files_to_calibration(self, calibration_name, file_paths, max_workers=None, progress_callback=None,
+                                    cancel_event=None):
+        """
+        Bulk-imports .DAT files into a calibration, using the same pipeline as import_files().
+
+        Parameters:
+            calibration_name (str): The name of the calibration.
+            file_paths (list of str): The paths of the .DAT files or archives to import.
+            max_workers (int or None): The number of parser threads. Defaults to the number of CPUs.
+            progress_callback (callable or None): See import_files().
+            cancel_event (threading.Event or None): See import_files().
+
+        Returns:
+            list of dict: The per-file status report, see import_files().
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        if 'calibrations' not in self.h5file or calibration_name not in self.h5file['calibrations']:
+            raise ValueError(f"Calibration '{calibration_name}' does not exist.")
+
+        calibration_group = self.h5file['calibrations'][calibration_name]
+
+        def write(file_path, dat_file):
+            if dat_file.name in calibration_group:
+                return self._existing_file_status(calibration_group[dat_file.name], dat_file.content_hash)
+            self._write_calibration_file(calibration_group, dat_file)
+            return IMPORT_IMPORTED, ''
+
+        return self._bulk_import(file_paths, write, max_workers, progress_callback, cancel_event,
+                                 manifest_group=calibration_group, expand_archives=True)
+
+    def register_files(self, file_paths, pressure=np.nan, crystal='', max_workers=None, progress_callback=None,
+                       cancel_event=None):
+        """
+        Registers .DAT files in the 'data' group without parsing them.
+
+        Only the path, size, modification time and content hash of each file are recorded, together with the
+        usual metadata and velocities. The channel counts and raw contents are read from the original file the
+        first time they are needed (see get_file_data() and get_metadata_from_dataset()), or all at once with
+        materialize_files(). Registered files must stay in place and unchanged until they are materialized.
+
+        Parameters:
+            file_paths (list of str): The paths of the .DAT files to register.
+            pressure (float): The pressure to assign to the registered files.
+            crystal (str): The crystal to assign to the registered files.
+            max_workers (int or None): The number of threads hashing files. Defaults to the number of CPUs.
+            progress_callback (callable or None): See import_files().
+            cancel_event (threading.Event or None): See import_files().
+
+        Returns:
+            list of dict: The per-file status report, see import_files(). 'channels' and 'scans' are None for
+                          registered files.
+        """
+        if self.h5file is None:
+            raise ValueError(
+                "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
+
+        data_group = self.h5file['data']
+
+        def write(file_path, record):
+            if record.name in data_group:
+                return self._existing_file_status(data_group[record.name], record.content_hash)
+            group = self._create_data_group(record.name, pressure, crystal)
+            self._write_file_record(group, record)
+            return IMPORT_IMPORTED, ''
+
+        return self._bulk_import(file_paths, write, max_workers, progress_callback, cancel_event,
+                                 read=_read_file_record, manifest_group=data_group)
+
+    def register_files_to_calibration(self, calibration_name, file_paths, max_workers=None, progress_callback=None,
+                                      cancel_event=None):
+        """
+        Registers .DAT files in a calibration without parsing them, like register_files(). Their data is read
+        when first requested with get_calibration_file_data().
+
+        Parameters:
+            calibration_name (str): The name of the calibration.
+            file_paths (list of str): The paths of the .DAT files to register.
+            max_workers (int or None): The number of threads hashing files. Defaults to the number of CPUs.
+            progress_callback (callable or None): See import_files().
+            cancel_event (threading.Event or None): See import_files().
+
+        Returns:
+            list of dict: The per-file status report, see import_files().
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        if 'calibrations' not in self.h5file or calibration_name not in self.h5file['calibrations']:
+            raise ValueError(f"Calibration '{calibration_name}' does not exist.")
+
+        calibration_group = self.h5file['calibrations'][calibration_name]
+
+        def write(file_path, record):
+            if record.name in calibration_group:
+                return self._existing_file_status(calibration_group[record.name], record.content_hash)
+            group = self._create_calibration_file_group(calibration_group, record.name)
+            self._write_file_record(group, record)
+            return IMPORT_IMPORTED, ''
+
+        return self._bulk_import(file_paths, write, max_workers, progress_callback, cancel_event,
+                                 read=_read_file_record, manifest_group=calibration_group)
+
+    def materialize_files(self, file_names=None, max_workers=None, progress_callback=None, cancel_event=None):
+        """
+        Parses registered files and stores their data in the project, so the original files are no longer needed.
+
+        Parameters:
+            file_names (list of str or None): Names of files in the 'data' group to materialize. If None, every
+                                              registered file of the project is materialized, calibrations included.
+            max_workers (int or None): The number of parser threads. Defaults to the number of CPUs.
+            progress_callback (callable or None): See import_files().
+            cancel_event (threading.Event or None): See import_files().
+
+        Returns:
+            list of dict: The per-file status report, with one entry per original file still to be read.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+
+        if file_names is None:
+            groups = self._find_registered_groups()
+        else:
+            data_group = self.h5file['data']
+            missing = [file_name for file_name in file_names if file_name not in data_group]
+            if missing:
+                raise ValueError(f"Dataset(s) {', '.join(missing)} do not exist in the HDF5 file.")
+            groups = [data_group[file_name] for file_name in file_names if self._is_registered(data_group[file_name])]
+
+        # The same original file may be registered in several places, e.g. in 'data' and in a calibration
+        groups_by_path = {}
+        for group in groups:
+            groups_by_path.setdefault(group.attrs['source_path'], []).append(group)
+
+        def write(file_path, dat_file):
+            registered = [group for group in groups_by_path[file_path] if self._is_registered(group)]
+            if not registered:
+                return IMPORT_SKIPPED, f"{dat_file.name} is already materialized."
+            for group in registered:
+                self._materialize(group, dat_file)
+            return IMPORT_IMPORTED, ''
+
+        return self._bulk_import(list(groups_by_path), write, max_workers, progress_callback, cancel_event)
+
+    def list_registered_files(self):
+        """
+        Returns the names of the files in the 'data' group that are registered and not yet materialized.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        data_group = self.h5file['data']
+        return [name for name, group in data_group.items() if self._is_registered(group)]
+
+    def _write_file_record(self, group, record):
+        """
+        Internal method to store the record of a registered file in its group. Does not flush.
+        """
+        group.attrs['source_path'] = record.source_path
+        group.attrs['source_size'] = record.source_size
+        group.attrs['source_mtime'] = record.source_mtime
+        group.attrs['content_hash'] = record.content_hash
+        self._log('_replay_file_record', group, record.name, record.source_path, record.source_size,
+                  record.source_mtime, record.content_hash)
+
+    @staticmethod
+    def _is_registered(group):
+        """
+        Internal method returning True if a file group was registered and its data has not been read yet.
+        """
+        return 'source_path' in group.attrs and 'blob' not in group.attrs and 'shard' not in group.attrs
+
+    def _find_registered_groups(self):
+        """
+        Internal method returning every registered file group of the project that is not yet materialized.
+        """
+        groups = []
+
+        def collect(name, obj):
+            if isinstance(obj, h5py.Group) and self._is_registered(obj):
+                groups.append(obj)
+
+        for group_name in ['data', 'calibrations']:
+            if group_name in self.h5file:
+                self.h5file[group_name].visititems(collect)
+        return groups
+
+    def _materialize(self, group, dat_file=None):
+        """
+        Internal method to store the data of a registered file group, reading the original file unless
+        it has already been parsed. Does not flush.
+
+        Raises:
+            ValueError: If the original file has changed since it was registered.
+            OSError: If the original file can no longer be read.
+        """
+        source_path = group.attrs['source_path']
+        if dat_file is None:
+            dat_file = read_dat_file(source_path)
+        if dat_file.content_hash != group.attrs['content_hash']:
+            raise ValueError(f"{source_path} has changed since it was registered.")
+        self._store_payload(group, dat_file)
+
+    def _ensure_materialized(self, group):
+        """
+        Internal method materializing a registered file group on first access.
+        """
+        if self._is_registered(group):
+            self._materialize(group)
+            self._flush()
+
+    def start_watch_folder(self, folder, settle_time=2.0, include_existing=False):
+        """
+        Starts watching a directory for new .DAT files, e.g. the output folder of the spectrometer software.
+
+        Watching does not import anything by itself: call poll_watch_folder() periodically to import the files
+        that have been completely written since the last call.
+
+        Parameters:
+            folder (str): The directory to watch.
+            settle_time (float): Seconds a file's size and modification time must stay unchanged before it is
+                                 considered completely written.
+            include_existing (bool): Whether .DAT files already in the folder are imported too.
+
+        Raises:
+            ValueError: If the folder does not exist.
         """
-        if self.h5file is None:
-            raise ValueError("Temporary HDF5 file not created or opened.")
+        self.folder_watcher = FolderWatcher(folder, settle_time=settle_time, include_existing=include_existing)
 
-        if 'calibrations' not in self.h5file:
-            raise ValueError("No calibrations exist in the project.")
+    def stop_watch_folder(self):
+        """
+        Stops watching the directory set with start_watch_folder().
+        """
+        self.folder_watcher = None
 
-        if old_name not in self.h5file['calibrations']:
-            raise ValueError(f"Calibration '{old_name}' does not exist.")
+    def is_watching_folder(self):
+        """
+        Returns True if a directory is being watched.
+        """
+        return self.folder_watcher is not None
 
-        if new_name in self.h5file['calibrations']:
-            raise ValueError(f"Calibration '{new_name}' already exists.")
+    def poll_watch_folder(self, pressure=np.nan, crystal='', max_workers=None):
+        """
+        Imports the watched files that have been completely written since the last poll.
 
-        # Get the old calibration group
-        old_calibration_group = self.h5file['calibrations'][old_name]
+        Each file is offered once; a file that fails to import is retried only if it is written again.
 
-        # Create a new group with the new name
-        new_calibration_group = self.h5file['calibrations'].create_group(new_name)
+        Parameters:
+            pressure (float): The pressure to assign to the new files.
+            crystal (str): The crystal to assign to the new files.
+            max_workers (int or None): The number of parser threads, see import_files().
 
-        # Copy attributes from the old calibration to the new one
-        for attr_name, attr_value in old_calibration_group.attrs.items():
-            new_calibration_group.attrs[attr_name] = attr_value
+        Returns:
+            list of dict: The per-file status report of the new files, see import_files(). Empty if no file is ready.
 
-        # Copy all datasets and groups from the old calibration to the new one
-        def copy_group_contents(source_group, target_group):
-            for key in source_group:
-                if isinstance(source_group[key], h5py.Group):
-                    sub_group = target_group.create_group(key)
-                    # Copy attributes of the group
-                    for attr_name, attr_value in source_group[key].attrs.items():
-                        sub_group.attrs[attr_name] = attr_value
-                    copy_group_contents(source_group[key], sub_group)
-                elif isinstance(source_group[key], h5py.Dataset):
-                    target_group.create_dataset(key, data=source_group[key][()])
-                    # Copy attributes of the dataset
-                    for attr_key, attr_value in source_group[key].attrs.items():
-                        target_group[key].attrs[attr_key] = attr_value
+        Raises:
+            ValueError: If no directory is being watched.
+        """
+        if self.folder_watcher is None:
+            raise ValueError("No folder is being watched. Please call start_watch_folder first.")
 
-        copy_group_contents(old_calibration_group, new_calibration_group)
+        file_paths = self.folder_watcher.poll()
+        if not file_paths:
+            return []
+        return self.import_files(file_paths, pressure, crystal, max_workers=max_workers)
 
-        # Delete the old calibration group
-        del self.h5file['calibrations'][old_name]
+    def start_feed(self, address, max_queue=FEED_QUEUE_SIZE):
+        """
+        Starts listening on a local socket for spectra pushed by the acquisition PC (see src.utils.spectrum_feed).
 
-        # Flush the changes to disk
-        self.h5file.flush()
+        Spectra are received and parsed on background threads and wait in a bounded queue until
+        poll_feed() writes them; while the queue is full, the senders are slowed down.
 
-    def remove_pressure(self, pressure):
-        """Remove an existing pressure from the project."""
-        if self.h5file is None:
-            raise ValueError("Temporary HDF5 file not created or opened.")
+        Parameters:
+            address (tuple or str): (host, port) to listen on over TCP, or the path of a Unix socket.
+            max_queue (int): The number of received spectra that may wait to be written.
 
-        pressures = list(self.h5file.attrs['pressures'])
-        if pressure in pressures:
-            pressures.remove(pressure)
-            self.h5file.attrs['pressures'] = pressures
+        Returns:
+            tuple or str: The address listened on, with the actual port if port 0 was given.
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        Raises:
+            OSError: If the socket cannot be opened.
+            ValueError: If the feed is already running or Unix sockets are not available.
+        """
+        if self.feed is not None:
+            raise ValueError("The feed is already running. Please call stop_feed first.")
+        self.feed = SpectrumFeed(address, max_queue)
+        return self.feed.address
 
-    def remove_calibration(self, calibration_name):
+    def stop_feed(self):
         """
-        Removes an existing calibration from the project.
+        Stops listening for spectra. Spectra received but not written by poll_feed() are discarded.
+        """
+        if self.feed is not None:
+            self.feed.stop()
+            self.feed = None
 
-        Parameters:
-            calibration_name (str): The name of the calibration to remove.
+    def poll_feed(self, pressure=np.nan, crystal='', max_spectra=None):
         """
-        if self.h5file is None:
-            raise ValueError("Temporary HDF5 file not created or opened.")
-        if 'calibrations' not in self.h5file or calibration_name not in self.h5file['calibrations']:
-            raise ValueError(f"Calibration '{calibration_name}' does not exist.")
+        Writes the spectra received from the feed since the last poll into the 'data' group.
 
-        del self.h5file['calibrations'][calibration_name]
-        self.h5file.flush()
+        Parameters:
+            pressure (float): The pressure to assign to the new spectra.
+            crystal (str): The crystal to assign to the new spectra.
+            max_spectra (int or None): The maximum number of spectra to write in this call, to keep it short.
 
-    def add_file_to_h5(self, file_path, pressure=np.nan, crystal=''):
-        """
-        Adds the contents of a single .dat file to the temporary HDF5 file.
+        Returns:
+            list of dict: The per-spectrum status report, see import_files(), with 'file_path' set to the name
+                          given by the sender and the timestamps 'sent_at', 'received_at' and 'written_at'
+                          (time.time() values) for measuring latency.
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open or the feed is not running.
         """
         if self.h5file is None:
             raise ValueError(
                 "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
-
-        dataset_name = os.path.basename(file_path)
+        if self.feed is None:
+            raise ValueError("The feed is not running. Please call start_feed first.")
 
         data_group = self.h5file['data']
+        report = []
+        for item in self.feed.get_items(max_spectra):
+            entry = {'file_path': item.name, 'name': item.name, 'status': IMPORT_FAILED, 'message': item.error,
+                     'channels': None, 'scans': None, 'sent_at': item.sent_at, 'received_at': item.received_at}
+            try:
+                if item.dat_file is None:
+                    raise ValueError(item.error)
+                if not item.name or '/' in item.name:
+                    raise ValueError(f"Invalid spectrum name '{item.name}'.")
+                dat_file = _validate_dat_file(item.dat_file)
+                entry['channels'] = len(dat_file.counts)
+                entry['scans'] = float(dat_file.scans) if dat_file.scans is not None else None
+                if dat_file.name in data_group:
+                    entry['status'], entry['message'] = self._existing_file_status(data_group[dat_file.name],
+                                                                                   dat_file.content_hash)
+                else:
+                    self._write_data_file(dat_file, pressure, crystal)
+                    entry['status'] = IMPORT_IMPORTED
+            except ValueError as e:
+                entry['message'] = str(e)
+            entry['written_at'] = time.time()
+            report.append(entry)
 
-        if dataset_name in data_group:
-            print(f"Dataset {dataset_name} already exists in the HDF5 file. Skipping.")
-            return
+        if report:
+            self._flush()
+        return report
 
-        # Create the dataset under 'data' group
-        group = data_group.create_group(dataset_name)
-
-        # Use np.nan for numeric fields instead of None
-        group.attrs['pressure'] = pressure
-        group.attrs['crystal'] = crystal
-        group.attrs['chi_angle'] = np.nan
-        group.attrs['pinhole'] = np.nan
-        group.attrs['power'] = np.nan
-        group.attrs['polarization'] = np.nan
-        group.attrs['scans'] = np.nan
-
-        # Create velocities group under the file group
-        velocities_group = group.create_group('velocities')
-
-        # Initialize velocities per file
-        project_velocities = self.h5file.attrs.get('velocities', [])
-        for velocity in project_velocities:
-            velocity_group = velocities_group.create_group(velocity)
-            # Initialize peak fit data as attributes
-            for key in ['left_center_mps', 'right_center_mps', 'offset_mps',
-                        'left_center_ch', 'right_center_ch', 'offset_ch',
-                        'left_goodness_of_fit', 'left_amplitude', 'left_sigma',
-                        'left_gamma', 'left_fwhm', 'left_area',
-                        'right_goodness_of_fit', 'right_amplitude', 'right_sigma',
-                        'right_gamma', 'right_fwhm', 'right_area']:
-                velocity_group.attrs[key] = np.nan  # Initialize as NaN
-
-        # Optionally, add the file content
-        with open(file_path, 'rb') as file:
-            raw_data = file.read()
-        group.create_dataset('raw_content', data=raw_data)
-
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
-            numeric_data = [int(line.strip()) for line in lines[12:] if line.strip().isdigit()]
-        group.create_dataset('original_data', data=numeric_data)
-
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+    def _bulk_import(self, file_paths, write, max_workers=None, progress_callback=None, cancel_event=None,
+                     read=_read_and_validate_dat_file, manifest_group=None, expand_archives=False):
+        """
+        Internal method running the parse/validate/write pipeline shared by the bulk import methods.
+
+        Parameters:
+            file_paths (list of str): The paths of the .DAT files to import.
+            write (callable): Called on the calling thread as write(file_path, result) with the result of read;
+                              returns a (status, message) tuple.
+            max_workers (int or None): The number of parser threads. Defaults to the number of CPUs.
+            progress_callback (callable or None): Called as progress_callback(done, total, entry) after each file.
+            cancel_event (threading.Event or None): When set, files not yet written are reported as cancelled.
+            read (callable): Called on the worker threads with each file path; raises OSError or ValueError
+                             for files that cannot be imported. Defaults to parsing and validating the file.
+                             The result must have name and content_hash attributes.
+            manifest_group (h5py.Group or None): The group the files are imported into. If given, the outcome
+                                                 of each file is recorded in the import manifest and files that
+                                                 are unchanged since they were imported are skipped unread.
+            expand_archives (bool): Whether zip and tar archives among the paths are imported member by member.
+                                    Members are always parsed and validated, whatever the read function.
+
+        Returns:
+            list of dict: The per-file status report, in input order.
+        """
+        sources = _ImportSources(file_paths, read, expand_archives)
+        max_workers = max_workers or os.cpu_count() or 1
+        max_pending = max_workers * 4  # Bound on parsed files waiting for the writer
+        manifest = ImportManifest(self.h5file) if manifest_group is not None else None
+        report = []
+        written = 0
+
+        def new_entry(file_path, status=IMPORT_FAILED, message=''):
+            return {'file_path': file_path, 'name': os.path.basename(file_path), 'status': status,
+                    'message': message, 'channels': None, 'scans': None}
+
+        def finish(entry):
+            report.append(entry)
+            if progress_callback is not None:
+                progress_callback(len(report), sources.total, entry)
+
+        with sources, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def submit(file_path):
+                # Returns (file_path, stat, future); future is None for files unchanged since their import
+                stat = None
+                if manifest is not None:
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        pass
+                    if (stat is not None and os.path.basename(file_path) in manifest_group
+                            and manifest.is_unchanged(manifest_group.name, os.path.abspath(file_path), stat.st_size,
+                                                      stat.st_mtime, (IMPORT_IMPORTED, IMPORT_SKIPPED))):
+                        return file_path, stat, None
+                return file_path, stat, executor.submit(sources.read, file_path)
+
+            pending = deque()
+            paths = iter(sources)
+            for file_path in itertools.islice(paths, max_pending):
+                pending.append(submit(file_path))
+
+            while pending:
+                file_path, stat, future = pending.popleft()
+                entry = new_entry(file_path)
+
+                if cancel_event is not None and cancel_event.is_set():
+                    if future is not None and future.cancel():
+                        sources.discard(file_path)
+                    entry['status'] = IMPORT_CANCELLED
+                    finish(entry)
+                    continue
+
+                for next_path in itertools.islice(paths, 1):
+                    pending.append(submit(next_path))
+                if future is None:
+                    entry['status'], entry['message'] = IMPORT_SKIPPED, "Unchanged since it was last imported."
+                    finish(entry)
+                    continue
+
+                content_hash = ''
+                try:
+                    result = future.result()
+                    content_hash = result.content_hash
+                    if hasattr(result, 'counts'):
+                        entry['channels'] = len(result.counts)
+                        entry['scans'] = float(result.scans) if result.scans is not None else None
+                    entry['status'], entry['message'] = write(file_path, result)
+                except (OSError, ValueError) as e:
+                    entry['message'] = str(e)
+
+                if manifest is not None:
+                    row = (manifest_group.name, os.path.abspath(file_path), entry['name'],
+                           stat.st_size if stat is not None else -1, stat.st_mtime if stat is not None else np.nan,
+                           content_hash, entry['status'], entry['message'])
+                    manifest.record(*row)
+                    self._log('_replay_import_record', *row)
+                written += 1
+                if written % CHECKPOINT_INTERVAL == 0:
+                    self._checkpoint_import(manifest)
+                finish(entry)
+
+            # Files never submitted because the import was cancelled
+            for file_path in paths:
+                sources.discard(file_path)
+                finish(new_entry(file_path, IMPORT_CANCELLED))
+
+        self._checkpoint_import(manifest)  # Flush once for the whole batch
+        return report
+
+    def _checkpoint_import(self, manifest):
+        """
+        Internal method writing the pending manifest rows of a bulk import and flushing the file.
+        """
+        if manifest is not None:
+            manifest.flush()
+            self._mark_changed(f'/{MANIFEST_GROUP}')
+        self._flush()
+
+    def _existing_file_status(self, group, content_hash):
+        """
+        Internal method returning the (status, message) of importing a file whose name is already taken by
+        a file group: skipped if the stored contents are identical, a conflict otherwise.
+        """
+        existing_hash = group.attrs.get('blob', group.attrs.get('content_hash'))
+        if existing_hash is None and 'raw_content' in group:
+            # Files imported before content hashes were stored
+            existing_hash = hash_content(read_bytes_dataset(group['raw_content']))
+        name = group.name.rsplit('/', 1)[-1]
+        if existing_hash == content_hash:
+            return IMPORT_SKIPPED, f"{name} is already in the project."
+        return IMPORT_CONFLICT, f"A different file named {name} is already in the project."
+
+    def get_import_manifest(self, target=None):
+        """
+        Returns the import manifest: the last recorded outcome of importing each original file.
+
+        Parameters:
+            target (str or None): Only return the entries of one group, e.g. '/data' or '/calibrations/<name>'.
+
+        Returns:
+            list of dict: One entry per original file and target group, with keys 'target', 'path', 'name', 'size',
+                          'mtime', 'content_hash', 'status' and 'message'.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        return ImportManifest(self.h5file).entries(target)
 
     def add_file_to_calibration(self, calibration_name, file_path):
         """
@@ -413,16 +1962,25 @@ class BrillouinProject:
             print(f"File {dataset_name} already exists in the calibration. Skipping.")
             return
 
-        with open(file_path, 'rb') as file:
-            raw_data = file.read()
+        dat_file = read_dat_file(file_path)
+        self._write_calibration_file(calibration_group, dat_file)
 
-        group = calibration_group.create_group(dataset_name)
-        group.create_dataset('raw_content', data=raw_data)
+        self._flush()
 
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
-            numeric_data = [int(line.strip()) for line in lines[12:] if line.strip().isdigit()]
-        group.create_dataset('original_data', data=numeric_data)
+    def _write_calibration_file(self, calibration_group, dat_file):
+        """
+        Internal method to write a parsed .DAT file as a new group under a calibration. Does not flush.
+        """
+        group = self._create_calibration_file_group(calibration_group, dat_file.name)
+        self._store_payload(group, dat_file)
+
+    def _create_calibration_file_group(self, calibration_group, name):
+        """
+        Internal method to create the group of a file under a calibration with its empty peak fits,
+        but without its content. Does not flush.
+        """
+        group = calibration_group.create_group(name)
+        self._mark_changed(group.name)
 
         # Initialize empty attributes for the peak fits
         for peak in ['left_peak', 'right_peak']:
@@ -447,8 +2005,144 @@ class BrillouinProject:
         # Initialize inverted attribute
         group.attrs['inverted'] = 1  # Default to 1 (True)
 
-        self.h5file.flush()
+        self._log('_create_calibration_file_group', calibration_group, name)
+        return group
+
+    def _write_header_metadata(self, group, dat_file):
+        """
+        Internal method to store the typed header fields of a parsed .DAT file on its group, so they can be
+        queried without decoding the raw contents again. All fields are kept as JSON in the 'header' attribute;
+        the acquisition time and, for files under 'data', an unset number of scans are stored as attributes.
+        Does not flush.
+        """
+        group.attrs['header'] = json.dumps(dat_file.metadata)
+        acquisition_time = dat_file.acquisition_time
+        if acquisition_time is not None:
+            group.attrs['acquisition_time'] = acquisition_time
+        scans = dat_file.scans
+        if scans is None or group.parent.name != '/data':
+            return
+        metadata_table = self._get_metadata_table()
+        if dat_file.name in metadata_table:
+            if np.isnan(metadata_table.get(dat_file.name, 'scans')):
+                metadata_table.set(dat_file.name, 'scans', float(scans))  # Same type as values entered in the table
+                self._mark_changed(f'/{METADATA_GROUP}')
+        elif 'scans' in group.attrs and np.isnan(group.attrs['scans']):
+            group.attrs['scans'] = float(scans)
+
+    def _store_payload(self, group, dat_file):
+        """
+        Internal method to store the contents and header fields of a parsed .DAT file for its group. With the
+        'matrix' spectra layout, the counts of files under 'data' go to the spectra matrix instead of the blob;
+        with the 'shards' layout, their counts and raw contents go to their shard file. Does not flush.
+        """
+        self._mark_changed(group.name)
+        if self.storage_options['spectra_layout'] == 'shards' and group.parent.name == '/data':
+            name = group.name.rsplit('/', 1)[-1]
+            key = shard_key(self.storage_options['shard_by'], self._get_metadata_table().get(name, 'pressure'),
+                            dat_file.acquisition_time)
+            # Written under a new entry, so the saved spectrum of a file of that name stays until the next save
+            group.attrs['shard_entry'] = self._get_spectra_shards().write(name, key, dat_file.counts,
+                                                                          dat_file.raw_content, self.storage_options)
+            group.attrs['shard'] = key
+            group.attrs['content_hash'] = dat_file.content_hash
+        else:
+            in_matrix = self.storage_options['spectra_layout'] == 'matrix' and group.parent.name == '/data'
+            self._link_blob(group, dat_file, link_counts=not in_matrix)
+            if in_matrix:
+                self._get_spectra_matrix().write(dat_file.name, dat_file.counts, self.storage_options)
+                self._mark_changed(f'/{SPECTRA_GROUP}')
+        self._write_header_metadata(group, dat_file)
+        self._log('_replay_payload', group, dat_file.name, dat_file.raw_content)
+
+    def _link_blob(self, group, dat_file, link_counts=True):
+        """
+        Internal method to point a file group at the blob holding the payload of a parsed .DAT file.
+
+        The blob is created if no identical payload is stored yet, otherwise its reference count is
+        incremented. The group gets a 'blob' attribute and soft links named 'raw_content' and, if link_counts
+        is True, 'original_data', so readers access the payload exactly as if it were stored in the group.
+        Does not flush.
+        """
+        blobs_group = self.h5file.require_group(BLOBS_GROUP)
+        blob_name = dat_file.content_hash
+
+        if blob_name in blobs_group:
+            blob = blobs_group[blob_name]
+            blob.attrs['refcount'] += 1
+            self._mark_changed(blob.name, attrs_only=True)
+        else:
+            blob = blobs_group.create_group(blob_name)
+            create_bytes_dataset(blob, 'raw_content', dat_file.raw_content, self.storage_options)
+            blob.attrs['refcount'] = 1
+            self._mark_changed(blob.name)
+        if link_counts and 'original_data' not in blob:
+            # New blob, or one created for a file whose counts are in the spectra matrix
+            dataset = create_array_dataset(blob, 'original_data', dat_file.counts, self.storage_options)
+            self._mark_changed(dataset.name)
+
+        group.attrs['blob'] = blob_name
+        group['raw_content'] = h5py.SoftLink(f'/{BLOBS_GROUP}/{blob_name}/raw_content')
+        if link_counts:
+            group['original_data'] = h5py.SoftLink(f'/{BLOBS_GROUP}/{blob_name}/original_data')
+
+    def _release_blobs(self, group):
+        """
+        Internal method to drop the blob references held by a file group, or by every file group below it
+        (e.g. a whole calibration), deleting blobs that are no longer referenced. Call before deleting the group.
+        Groups written before the blob store existed hold their data inline and are ignored. Does not flush.
+        """
+        blob_names = []
+        if 'blob' in group.attrs:
+            blob_names.append(group.attrs['blob'])
+
+        def collect(name, obj):
+            if isinstance(obj, h5py.Group) and 'blob' in obj.attrs:
+                blob_names.append(obj.attrs['blob'])
+
+        group.visititems(collect)
+
+        blobs_group = self.h5file.get(BLOBS_GROUP)
+        for blob_name in blob_names:
+            if blobs_group is None or blob_name not in blobs_group:
+                continue
+            blob = blobs_group[blob_name]
+            refcount = blob.attrs['refcount'] - 1
+            if refcount > 0:
+                blob.attrs['refcount'] = refcount
+                self._mark_changed(blob.name, attrs_only=True)
+            else:
+                self._mark_changed(blob.name)
+                del blobs_group[blob_name]
+
+    def get_blob_statistics(self):
+        """
+        Returns deduplication statistics for the content-addressed blob store.
+
+        Returns:
+            dict: 'blobs' (number of distinct payloads stored), 'references' (number of file groups referring
+                  to them), 'stored_bytes' (bytes of payload stored), 'referenced_bytes' (bytes the references
+                  would occupy without deduplication) and 'saved_bytes' (the difference).
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
 
+        statistics = {'blobs': 0, 'references': 0, 'stored_bytes': 0, 'referenced_bytes': 0, 'saved_bytes': 0}
+        if BLOBS_GROUP not in self.h5file:
+            return statistics
+
+        for blob in self.h5file[BLOBS_GROUP].values():
+            size = blob['raw_content'].nbytes + (blob['original_data'].nbytes if 'original_data' in blob else 0)
+            refcount = int(blob.attrs['refcount'])
+            statistics['blobs'] += 1
+            statistics['references'] += refcount
+            statistics['stored_bytes'] += size
+            statistics['referenced_bytes'] += refcount * size
+
+        statistics['saved_bytes'] = statistics['referenced_bytes'] - statistics['stored_bytes']
+        return statistics
+
+    @_journaled
     def remove_file_from_calibration(self, calibration_name, file_name):
         """
         Removes a file from a calibration.
@@ -465,11 +2159,14 @@ class BrillouinProject:
         calibration_group = self.h5file['calibrations'][calibration_name]
 
         if file_name in calibration_group:
+            self._release_blobs(calibration_group[file_name])
+            self._mark_changed(calibration_group[file_name].name)
             del calibration_group[file_name]
-            self.h5file.flush()
+            self._flush()
         else:
             raise ValueError(f"File '{file_name}' does not exist in the calibration.")
 
+    @_journaled
     def update_calibration_attributes(self, calibration_name, mirror_spacing=None, laser_wavelength=None, scattering_angle=None):
         """
         Updates attributes of a calibration.
@@ -493,36 +2190,20 @@ class BrillouinProject:
             calibration_group.attrs['laser_wavelength'] = laser_wavelength
         if scattering_angle is not None:
             calibration_group.attrs['scattering_angle'] = scattering_angle
+        self._mark_changed(calibration_group.name, attrs_only=True)
 
-        self.h5file.flush()
+        self._flush()
 
     def update_file_velocities(self, file_name):
+        """
+        Kept for compatibility: the fit results of every file always cover the velocities of the project,
+        which add_velocity(), remove_velocity() and rename_velocity() maintain for all files at once.
+        """
         if self.h5file is None:
             raise ValueError("Temporary HDF5 file not created or opened.")
-        data_group = self.h5file['data']
-        if file_name not in data_group:
-            return
-        dataset_group = data_group[file_name]
-        velocities_group = dataset_group.require_group('velocities')
-        project_velocities = self.h5file.attrs.get('velocities', [])
-        # Add new velocities
-        for velocity in project_velocities:
-            if velocity not in velocities_group:
-                velocity_group = velocities_group.create_group(velocity)
-                # Initialize peak fit data as attributes
-                for key in ['left_center_mps', 'right_center_mps', 'offset_mps',
-                            'left_center_ch', 'right_center_ch', 'offset_ch',
-                            'left_goodness_of_fit', 'left_amplitude', 'left_sigma',
-                            'left_gamma', 'left_fwhm', 'left_area',
-                            'right_goodness_of_fit', 'right_amplitude', 'right_sigma',
-                            'right_gamma', 'right_fwhm', 'right_area']:
-                    velocity_group.attrs[key] = np.nan  # Initialize as NaN
-        # Remove velocities no longer in project
-        for velocity in list(velocities_group.keys()):
-            if velocity not in project_velocities:
-                del velocities_group[velocity]
-        self.h5file.flush()
+        self._get_fit_results()
 
+    @_journaled
     def update_calibration_file_data(self, calibration_name, file_name, **attributes):
         """
         Updates file-level data within a calibration, including calibration ratios and peak fits.
@@ -547,6 +2228,7 @@ class BrillouinProject:
             if attr_name in ['left_peak_fit', 'right_peak_fit']:
                 continue  # Handle peak fits separately
             group.attrs[attr_name] = attr_value
+        self._mark_changed(group.name, attrs_only=True)
 
         # Update peak fits if provided
         if 'left_peak_fit' in attributes:
@@ -559,8 +2241,9 @@ class BrillouinProject:
             if right_peak_fit is not None:
                 self.update_peak_fit(calibration_name, file_name, right_peak_fit=right_peak_fit)
 
-        self.h5file.flush()
+        self._flush()
 
+    @_journaled
     def update_peak_fit(self, calibration_name, file_name, left_peak_fit=None, right_peak_fit=None):
         """
         Updates peak fit data for a file within a calibration.
@@ -582,6 +2265,7 @@ class BrillouinProject:
             raise ValueError(f"File '{file_name}' does not exist in the calibration.")
 
         group = calibration_group[file_name]
+        self._mark_changed(group.name)
 
         if left_peak_fit is not None:
             for key, value in left_peak_fit.items():
@@ -605,7 +2289,7 @@ class BrillouinProject:
                 else:
                     group.attrs[f'right_peak_{key}'] = value  # Scalar attributes
 
-        self.h5file.flush()
+        self._flush()
 
     def get_metadata_from_dataset(self, dataset_name, key):
         """
@@ -622,14 +2306,317 @@ class BrillouinProject:
             raise ValueError(f"Dataset {dataset_name} does not exist in the HDF5 file.")
 
         group = data_group[dataset_name]
+        metadata_table = self._get_metadata_table()
 
-        value = group.attrs[key]
+        if key in METADATA_COLUMNS and dataset_name in metadata_table:
+            value = metadata_table.get(dataset_name, key)
+        else:
+            # Metadata not recorded at registration may only be known once the file has been read
+            if key not in group.attrs:
+                self._ensure_materialized(group)
+            value = group.attrs[key]
 
         # Replace np.nan with None for display purposes
         if isinstance(value, float) and np.isnan(value):
             return None
         return value
 
+    def get_metadata_of_datasets(self, dataset_names, keys=METADATA_COLUMNS):
+        """
+        Retrieves several metadata keys of many datasets at once, reading them from the metadata table in memory.
+
+        Parameters:
+            dataset_names (list of str): The names of the datasets.
+            keys (tuple of str): The keys to retrieve.
+
+        Returns:
+            dict: key -> list of values in the order of dataset_names, with None for unset numeric values
+                  as returned by get_metadata_from_dataset().
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        metadata_table = self._get_metadata_table()
+        table_keys = [key for key in keys if key in METADATA_COLUMNS]
+        in_table = [name for name in dataset_names if name in metadata_table]
+        columns = metadata_table.columns(in_table, table_keys)
+
+        result = {key: [] for key in keys}
+        table_rows = {name: row for row, name in enumerate(in_table)}
+        for name in dataset_names:
+            row = table_rows.get(name)
+            for key in keys:
+                if row is not None and key in columns:
+                    value = columns[key][row]
+                    if key in NUMERIC_COLUMNS:
+                        value = None if np.isnan(value) else float(value)
+                    result[key].append(value)
+                else:
+                    result[key].append(self.get_metadata_from_dataset(name, key))
+        return result
+
+    def _get_metadata_table(self):
+        """
+        Internal method returning the MetadataTable of the open file, loading it on first use. Projects written
+        before the table existed get it when they are loaded, see _convert_legacy_layout().
+        """
+        if self.metadata_table is None or self.metadata_table.h5file is not self.h5file:
+            self.metadata_table = MetadataTable(self.h5file)
+        return self.metadata_table
+
+    def _convert_legacy_layout(self):
+        """
+        Internal method converting the working copy of a project written with an older layout as it is loaded,
+        before the journal starts, so that reading the project never writes to it: the metadata table is built
+        from the attributes of the dataset groups, and the fit results array from their 'velocities' groups,
+        which are kept. Attributes of the velocity groups that are not peak fit fields are reported. The velocities
+        of the project without a column of the array get one. The next save writes the changes to the project
+        file.
+        """
+        converted = False
+        data_group = self.h5file['data']
+        if METADATA_GROUP not in self.h5file and len(data_group) > 0:
+            self.metadata_table = MetadataTable(self.h5file)
+            self.metadata_table.add_many([(name, legacy_metadata(group.attrs)) for name, group in data_group.items()])
+            self._mark_changed(f'/{METADATA_GROUP}')
+            converted = True
+
+        velocities = [str(velocity) for velocity in self.h5file.attrs.get('velocities', [])]
+        build = FIT_RESULTS_GROUP not in self.h5file
+        fit_results = FitResults(self.h5file)
+        missing = [velocity for velocity in velocities if velocity not in fit_results.velocities()]
+        if missing:
+            for velocity in missing:
+                fit_results.add_velocity(velocity)
+            unknown = set()
+            for name, group in data_group.items() if build else ():
+                for velocity, velocity_group in group.get('velocities', {}).items():
+                    if velocity not in velocities:
+                        continue  # Left over from a velocity removed from the project
+                    unknown.update(unknown_fit_fields(velocity_group.attrs))
+                    results = legacy_fit_results(velocity_group.attrs)
+                    if results:
+                        fit_results.set(name, velocity, results)
+            if unknown:
+                print(f"The 'velocities' groups of the files hold attributes that are not peak fit results "
+                      f"({', '.join(sorted(unknown))}): they are kept there, but not shown or exported.")
+            self.fit_results = fit_results
+            self._mark_changed(f'/{FIT_RESULTS_GROUP}')
+            converted = True
+
+        if converted:
+            self._flush()
+
+    def get_header_metadata(self, dataset_name):
+        """
+        Retrieves the typed header fields of a file in the 'data' group, reading registered files on first access.
+
+        Parameters:
+            dataset_name (str): The name of the file.
+
+        Returns:
+            dict: The header fields, empty for files imported before header fields were extracted.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        data_group = self.h5file['data']
+        if dataset_name not in data_group:
+            raise ValueError(f"Dataset {dataset_name} does not exist in the HDF5 file.")
+        group = data_group[dataset_name]
+        self._ensure_materialized(group)
+        return json.loads(group.attrs.get('header', '{}'))
+
+    def get_file_data(self, file_name):
+        """
+        Retrieves the channel counts of a file in the 'data' group, reading registered files on first access.
+
+        Parameters:
+            file_name (str): The name of the file.
+
+        Returns:
+            numpy.ndarray: The channel counts as an int64 array.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        data_group = self.h5file['data']
+        if file_name not in data_group:
+            raise ValueError(f"Dataset {file_name} does not exist in the HDF5 file.")
+        group = data_group[file_name]
+        self._ensure_materialized(group)
+        return self._read_counts(group)
+
+    def get_spectra(self, file_names=None):
+        """
+        Retrieves the channel counts of several files in the 'data' group at once, reading registered files
+        on first access.
+
+        Counts stored in the spectra matrix are read with a single selection of the matrix, and counts stored in
+        shards with a single selection of the virtual dataset gathering the shards; the others are read file by
+        file, so the result is the same whatever the layout of each file.
+
+        Parameters:
+            file_names (list of str or None): The names of the files, or None for every file of the 'data' group.
+
+        Returns:
+            tuple: (counts, lengths) where counts is a [len(file_names), channels] int64 array with one row
+                   per file, in the given order, zero-padded beyond the number of channels of each file given
+                   in the int64 array lengths.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        data_group = self.h5file['data']
+        if file_names is None:
+            file_names = list(data_group.keys())
+        missing = [file_name for file_name in file_names if file_name not in data_group]
+        if missing:
+            raise ValueError(f"Dataset(s) {', '.join(missing)} do not exist in the HDF5 file.")
+
+        spectra_matrix = self._get_spectra_matrix()
+        spectra_shards = self._get_spectra_shards()
+        in_matrix, in_shards, in_groups = [], [], []  # Positions in file_names of the files of each layout
+        shard_entries = []  # Entries of the files in in_shards
+        for index, file_name in enumerate(file_names):
+            entry = self._shard_entry(data_group[file_name])
+            if file_name not in spectra_matrix and entry not in spectra_shards:
+                self._ensure_materialized(data_group[file_name])
+            if file_name in spectra_matrix:
+                in_matrix.append(index)
+            elif entry in spectra_shards:
+                in_shards.append(index)
+                shard_entries.append(entry)
+            else:
+                in_groups.append(index)
+
+        parts = []  # (positions, counts, lengths) read with a single selection
+        if in_matrix or not (in_shards or in_groups):
+            parts.append((in_matrix, *spectra_matrix.read_many([file_names[index] for index in in_matrix])))
+        if in_shards:
+            parts.append((in_shards, *self._read_shard_spectra(shard_entries)))
+        if len(parts) == 1 and not in_groups:
+            return parts[0][1], parts[0][2]
+
+        group_counts = [self._read_counts(data_group[file_names[index]]) for index in in_groups]
+        channels = max([part_counts.shape[1] for _, part_counts, _ in parts] +
+                       [len(file_counts) for file_counts in group_counts] + [0])
+        counts = np.zeros((len(file_names), channels), dtype=np.int64)
+        lengths = np.zeros(len(file_names), dtype=np.int64)
+        for positions, part_counts, part_lengths in parts:
+            counts[positions, :part_counts.shape[1]] = part_counts
+            lengths[positions] = part_lengths
+        for index, file_counts in zip(in_groups, group_counts):
+            counts[index, :len(file_counts)] = file_counts
+            lengths[index] = len(file_counts)
+        return counts, lengths
+
+    @_journaled
+    def consolidate_spectra(self):
+        """
+        Switches the project to the 'matrix' spectra layout and moves the counts of the files already in the
+        'data' group into the spectra matrix. Registered files are moved when they are materialized.
+        The per-file accessors keep working; raw contents stay in the blob store. The counts of blobs no longer
+        linked by any file are deleted, the space they held being reused by the working copy and reclaimed in
+        the project file when it is saved.
+
+        Returns:
+            int: The number of files whose counts were moved.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        self.set_storage_options(spectra_layout='matrix')
+
+        spectra_matrix = self._get_spectra_matrix()
+        moved = 0
+        data_references = Counter()  # Blob name -> number of files of 'data' referring to it
+        linked = set()  # Blobs whose counts are still linked by a file of 'data'
+        for file_name, group in self.h5file['data'].items():
+            blob_name = group.attrs.get('blob')
+            data_references[blob_name] += 1
+            if file_name in spectra_matrix or 'original_data' not in group:
+                if 'original_data' in group:
+                    linked.add(blob_name)
+                continue
+            spectra_matrix.write(file_name, read_counts_dataset(group['original_data']), self.storage_options)
+            self._mark_changed(f'/{SPECTRA_GROUP}', f'{group.name}/original_data')
+            del group['original_data']  # The link, or the dataset of files written before the blob store
+            moved += 1
+
+        # The blobs referred to by files of 'data' alone no longer need their counts; blobs also referred to by
+        # calibration files, which their reference count tells, keep them
+        blobs_group = self.h5file.get(BLOBS_GROUP)
+        for blob_name, references in data_references.items():
+            blob = blobs_group.get(blob_name) if blobs_group is not None and blob_name is not None else None
+            if (blob is not None and 'original_data' in blob and blob_name not in linked
+                    and blob.attrs['refcount'] == references):
+                self._mark_changed(f'{blob.name}/original_data')
+                del blob['original_data']
+
+        self._flush()
+        return moved
+
+    def _get_spectra_matrix(self):
+        """
+        Internal method returning the SpectraMatrix of the open file, loading its name index on first use.
+        """
+        if self.spectra_matrix is None or self.spectra_matrix.h5file is not self.h5file:
+            self.spectra_matrix = SpectraMatrix(self.h5file)
+        return self.spectra_matrix
+
+    def _get_spectra_shards(self):
+        """
+        Internal method returning the SpectraShards of the project, loading the name indices of the shards on
+        first use.
+        """
+        if self.spectra_shards is None:
+            self.spectra_shards = SpectraShards(self.shards_folder)
+        return self.spectra_shards
+
+    @staticmethod
+    def _shard_entry(group):
+        """
+        Internal method returning the entry under which the spectrum of a file group is stored in its shard,
+        or None if it is not stored in a shard. Projects written before entries were recorded use the file name.
+        """
+        if 'shard' not in group.attrs:
+            return None
+        return group.attrs.get('shard_entry', group.name.rsplit('/', 1)[-1])
+
+    def _read_shard_spectra(self, entries):
+        """
+        Internal method reading counts stored in shards through the virtual datasets of the working copy, or in
+        the overlay mode, whose working copy cannot resolve them, from the shard files.
+        """
+        spectra_shards = self._get_spectra_shards()
+        if self.overlay:
+            return spectra_shards.read_many(None, entries)
+        spectra_shards.refresh_views(self.h5file, self.temp_h5file_path)
+        return spectra_shards.read_many(self.h5file, entries)
+
+    def _is_live_shard_spectrum(self, entry, key):
+        """
+        Internal method returning True if a file of the project has its spectrum stored under an entry of a
+        shard. The file is named after the entry, without its '@<n>' suffix if it has one.
+        """
+        data_group = self.h5file['data']
+        for name in {entry, entry.rsplit('@', 1)[0]}:
+            group = data_group.get(name)
+            if group is not None and group.attrs.get('shard') == key and self._shard_entry(group) == entry:
+                return True
+        return False
+
+    def _read_counts(self, group):
+        """
+        Internal method returning the counts of a materialized file group as an int64 array, from the group
+        or, for files under 'data', from the spectra matrix or the shards.
+        """
+        if 'shard' in group.attrs:
+            counts, lengths = self._read_shard_spectra([self._shard_entry(group)])
+            return counts[0, :lengths[0]]
+        if 'original_data' not in group and group.parent.name == '/data':
+            file_name = group.name.rsplit('/', 1)[-1]
+            spectra_matrix = self._get_spectra_matrix()
+            if file_name in spectra_matrix:
+                return spectra_matrix.read(file_name)
+        return read_counts_dataset(group['original_data'])
+
     def get_file_count(self):
         """Return the number of files in the project."""
         data_group = self.h5file['data']
@@ -641,6 +2628,7 @@ class BrillouinProject:
         crystals = self.h5file.attrs.get('crystals', [])
         return sorted(pressures), sorted(crystals)
 
+    @_journaled
     def set_peak_fit_data(self, file_name, velocity_name, data_dict):
         # Stores the peak fit data for the specified file and velocity.
         if self.h5file is None:
@@ -648,25 +2636,80 @@ class BrillouinProject:
         data_group = self.h5file['data']
         if file_name not in data_group:
             raise ValueError(f"Dataset {file_name} does not exist in the HDF5 file.")
-        dataset_group = data_group[file_name]
-        velocities_group = dataset_group.require_group('velocities')
-        velocity_group = velocities_group.require_group(velocity_name)
-        for key, value in data_dict.items():
-            velocity_group.attrs[key] = value
-        self.h5file.flush()
+        self._get_fit_results().set(file_name, velocity_name, data_dict)
+        self._mark_changed(f'/{FIT_RESULTS_GROUP}')
+        self._flush()
 
     def get_peak_fit_data(self, file_name, velocity_name):
-        # Retrieves the peak fit data for the specified file and velocity.
+        # Retrieves the peak fit data for the specified file and velocity, {} if the velocity does not exist.
         if self.h5file is None:
             raise ValueError("Temporary HDF5 file not created or opened.")
         data_group = self.h5file['data']
         if file_name not in data_group:
             raise ValueError(f"Dataset {file_name} does not exist in the HDF5 file.")
-        dataset_group = data_group[file_name]
-        velocities_group = dataset_group.get('velocities', {})
-        velocity_group = velocities_group.get(velocity_name, {})
-        data_dict = dict(velocity_group.attrs.items()) if velocity_group else {}
-        return data_dict
+        try:
+            return self._get_fit_results().get(file_name, velocity_name)
+        except KeyError:
+            return {}
+
+    def get_file_fit_results(self, file_name):
+        """
+        Retrieves the peak fit data of a file for all the velocities of the project with a single read.
+
+        Parameters:
+            file_name (str): The name of the file.
+
+        Returns:
+            tuple: (velocities, values) where velocities is the sorted list of velocity names and values is a
+                   [len(velocities), len(PEAK_FIT_FIELDS)] float64 array, NaN where no fit was stored.
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open or the file does not exist.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        if file_name not in self.h5file['data']:
+            raise ValueError(f"Dataset {file_name} does not exist in the HDF5 file.")
+        fit_results = self._get_fit_results()
+        velocities = sorted(self.h5file.attrs.get('velocities', []))
+        # Velocities without a column, e.g. added to the attribute outside the project methods, have no results
+        stored = [index for index, velocity in enumerate(velocities) if velocity in fit_results.velocities()]
+        values = np.full((len(velocities), len(PEAK_FIT_FIELDS)), np.nan)
+        values[stored] = fit_results.file_results(file_name, [velocities[index] for index in stored])
+        return velocities, values
+
+    def get_velocity_fit_results(self, velocity_name, file_names=None):
+        """
+        Retrieves the peak fit data of many files for one velocity with a single read, e.g. for exports.
+
+        Parameters:
+            velocity_name (str): The name of the velocity.
+            file_names (list of str or None): The files to read, by default all the files of the project.
+
+        Returns:
+            tuple: (file_names, values) where values is a [len(file_names), len(PEAK_FIT_FIELDS)] float64 array
+                   in the order of file_names, NaN where no fit was stored.
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open or the velocity does not exist.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        if file_names is None:
+            file_names = self.list_datasets()
+        try:
+            return list(file_names), self._get_fit_results().velocity_results(velocity_name, list(file_names))
+        except KeyError:
+            raise ValueError(f"Velocity {velocity_name} does not exist in the HDF5 file.")
+
+    def _get_fit_results(self):
+        """
+        Internal method returning the FitResults of the open file, loading its name indices on first use. Projects
+        written before it existed get it when they are loaded, see _convert_legacy_layout().
+        """
+        if self.fit_results is None or self.fit_results.h5file is not self.h5file:
+            self.fit_results = FitResults(self.h5file)
+        return self.fit_results
 
     def get_peak_fit(self, calibration_name, file_name, peak_type):
         """
@@ -720,6 +2763,7 @@ class BrillouinProject:
 
         return peak_fit
 
+    @_journaled
     def add_velocity(self, velocity):
         """Add a new velocity to the project."""
         if self.h5file is None:
@@ -732,9 +2776,12 @@ class BrillouinProject:
         if velocity not in velocities:
             velocities.append(velocity)
             self.h5file.attrs['velocities'] = velocities
+        self._get_fit_results().add_velocity(velocity)  # A single resize, whatever the number of files
+        self._mark_changed(f'/{FIT_RESULTS_GROUP}')
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def remove_velocity(self, velocity):
         """Remove an existing velocity from the project."""
         if self.h5file is None:
@@ -744,9 +2791,12 @@ class BrillouinProject:
         if velocity in velocities:
             velocities.remove(velocity)
             self.h5file.attrs['velocities'] = velocities
+        self._get_fit_results().remove_velocity(velocity)
+        self._mark_changed(f'/{FIT_RESULTS_GROUP}')
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
+    @_journaled
     def rename_velocity(self, old_velocity, new_velocity):
         """Rename an existing velocity in the project."""
         if self.h5file is None:
@@ -754,10 +2804,12 @@ class BrillouinProject:
 
         velocities = list(self.h5file.attrs['velocities'])
         if old_velocity in velocities:
+            self._get_fit_results().rename_velocity(old_velocity, new_velocity)  # The fit results are kept
+            self._mark_changed(f'/{FIT_RESULTS_GROUP}')
             velocities[velocities.index(old_velocity)] = new_velocity
             self.h5file.attrs['velocities'] = velocities
 
-        self.h5file.flush()  # Ensure that the temporary file is immediately updated.
+        self._flush()  # Ensure that the temporary file is immediately updated.
 
     def get_unique_pressures_crystals_velocities(self):
         """Return the unique pressures, crystals, and velocities."""
@@ -808,7 +2860,8 @@ class BrillouinProject:
         if file_name not in calibration_group:
             raise ValueError(f"File '{file_name}' does not exist in the calibration.")
         group = calibration_group[file_name]
-        data = group['original_data'][()]
+        self._ensure_materialized(group)
+        data = read_counts_dataset(group['original_data'])
         return data
 
     def get_calibration_file_attributes(self, calibration_name, file_name):
@@ -887,21 +2940,29 @@ class BrillouinProject:
 
     def cleanup_temp_file(self):
         """
-        Closes the temporary HDF5 file if it is open and then deletes it.
+        Closes the temporary HDF5 file if it is open and then deletes it, along with the journal.
         """
         try:
+            if self.spectra_shards is not None:
+                self.spectra_shards.close()
+                self.spectra_shards = None
+
+            self._close_journal()
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
             # Close the file if it is open
+            session_path = self._session_path()
             if self.h5file is not None and self.h5file.id:
-                self.h5file.close()
-                self.h5file = None
-                print(f"Temporary file {self.temp_h5file_path} has been closed.")
+                self._close_working_copy()
+                print(f"Temporary file {session_path} has been closed.")
 
             # Delete the temporary file
-            if os.path.exists(self.temp_h5file_path):
-                os.remove(self.temp_h5file_path)
-                print(f"Temporary file {self.temp_h5file_path} has been deleted.")
+            if os.path.exists(session_path):
+                os.remove(session_path)
+                print(f"Temporary file {session_path} has been deleted.")
             else:
-                print(f"Temporary file {self.temp_h5file_path} does not exist.")
+                print(f"Temporary file {session_path} does not exist.")
         except Exception as e:
             print(f"Error deleting temporary file: {e}")
 
@@ -922,15 +2983,7 @@ class BrillouinProject:
             raise ValueError(
                 "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
 
-        matching_datasets = []
-        data_group = self.h5file['data']
-        for dataset_name in data_group.keys():
-            group = data_group[dataset_name]
-            match = all(group.attrs.get(key) == value for key, value in metadata_dict.items())
-            if match:
-                matching_datasets.append(dataset_name)
-
-        return matching_datasets
+        return self._find_datasets(metadata_dict)
 
     def find_datasets_by_metadata(self, key, value):
         """
@@ -950,67 +3003,314 @@ class BrillouinProject:
             raise ValueError(
                 "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
 
-        matching_datasets = []
-        data_group = self.h5file['data']
-        for dataset_name in data_group.keys():
-            group = data_group[dataset_name]
-            if key in group.attrs and group.attrs[key] == value:
-                matching_datasets.append(dataset_name)
-
-        return matching_datasets
+        return self._find_datasets({key: value})
 
     def find_files_by_pressure_and_crystal(self, pressure, crystal):
-        matching_files = []
+        """
+        Returns the names of the files with the given pressure and crystal, selected in the metadata table.
+        """
+        return self._find_datasets({'pressure': pressure, 'crystal': crystal})
+
+    def _find_datasets(self, metadata_dict):
+        """
+        Internal method returning the names of the datasets matching all the key-value pairs, sorted by name.
+
+        Keys of the metadata table are compared in memory for all datasets at once; the groups are only opened
+        to compare other keys, and only for the datasets that matched the table keys.
+        """
         data_group = self.h5file['data']
-        for dataset_name in data_group.keys():
-            group = data_group[dataset_name]
-            if group.attrs['pressure'] == pressure and group.attrs['crystal'] == crystal:
-                matching_files.append(dataset_name)
-        return matching_files
+        metadata_table = self._get_metadata_table()
+        table_criteria = {key: value for key, value in metadata_dict.items() if key in METADATA_COLUMNS}
+        other_criteria = {key: value for key, value in metadata_dict.items() if key not in METADATA_COLUMNS}
+
+        def matches(group, criteria):
+            return all(key in group.attrs and group.attrs[key] == value for key, value in criteria.items())
+
+        matching_datasets = [name for name in metadata_table.select(**table_criteria)
+                             if not other_criteria or matches(data_group[name], other_criteria)]
+
+        if len(metadata_table) < len(data_group):
+            # Groups without a row in the table, e.g. created outside the project methods
+            matching_datasets.extend(name for name, group in data_group.items()
+                                     if name not in metadata_table and matches(group, metadata_dict))
+            matching_datasets.sort()
+        return matching_datasets
 
     def save_project(self):
         """
-        Saves and closes the temporary HDF5 file, updating the modification date,
-        and then copies the contents of the temporary file to the original HDF5 file.
+        Saves the temporary HDF5 file to the original HDF5 file, updating the modification date.
+
+        The new version is written to '<name>.h5.saving', synced to the disk and renamed over the project file
+        (see replace_file()), or for changes written in place, renamed to a redo log applied again if the save is
+        interrupted, so a crash or power loss during a save leaves the previous or the new version intact. The
+        version replaced is kept as the first of the backups, see __init__().
+
+        Only the changes made since the last save are written: the new version starts as a reflink copy of the
+        project file, or without reflinks as an overlay of it written in place (see _save_changes()), in which the
+        objects that changed are replaced by copies of those of the working copy or deleted, renamed groups are
+        renamed, and attributes are rewritten, so saving takes a time proportional to the changes rather than to
+        the project. The project file keeps track
+        of the space freed this way, which the next saves reuse. It is written in full instead when the changes
+        are not known (a new project file, or a recovered session), in the overlay mode, which reads from the
+        project file, when it was written without free-space tracking, e.g. by an older version, or when more than
+        repack_threshold of it is unused.
+
+        A project file written in full is copied from the working copy, from RAM in the in-memory mode, and has no
+        unused space. In the overlay mode, the working copy is reopened over the new version with an empty delta
+        file. In the in-memory mode, the autosave of the temporary file, now older than the project file, is
+        deleted.
+
+        If more than repack_threshold of the working copy was freed by removing or replacing data, the working
+        copy is reopened from the project file. The journal is emptied, its changes being saved.
         """
         self._update_modification_date()
 
         if self.h5file is not None:
             self.h5file.flush()  # Ensure everything in memory is written to the temporary file
 
-            # Copy the temporary file contents to the original HDF5 file
-            with h5py.File(self.temp_h5file_path, 'r') as temp_file, h5py.File(self.h5file_path, 'w') as orig_file:
+            if not self._save_changes():
+                self._save_all()
+            self._reset_changes()
+            self._start_journal()  # The changes journaled so far are saved
+
+            if self.spectra_shards is not None:
+                # Spectra of files whose removal has now been saved; only their shards are written
+                self.spectra_shards.release_orphans(self._is_live_shard_spectrum)
+                self.spectra_shards.flush()
+
+            if self.in_memory:
+                if os.path.exists(self.temp_h5file_path):
+                    os.remove(self.temp_h5file_path)
+                self._last_autosave = time.monotonic()
+                self._changed_since_autosave = False
+
+            if (not self.overlay and self.repack_threshold is not None
+                    and free_space_ratio(self.h5file) > self.repack_threshold):
+                size = self.h5file.id.get_filesize()
+                self._close_working_copy()
+                self.load_h5file()
+                print(f"Compacted the working copy: "
+                      f"{(size - self.h5file.id.get_filesize()) / 2 ** 20:.1f} MB reclaimed.")
+
+        else:
+            print("No open temporary HDF5 file to save.")
+
+    def _save_all(self):
+        """
+        Internal method writing the whole working copy to a new version of the project file, see save_project().
+        """
+        temp_file = self.h5file
+        saved_path = self.h5file_path + '.saving'
+        try:
+            with h5py.File(saved_path, 'w', **PROJECT_FILE_SPACE) as orig_file:
 
                 # Copy attributes of the root
                 for key, value in temp_file.attrs.items():
                     orig_file.attrs[key] = value
 
-                # Copy datasets, groups, and their attributes
-                def copy_items(source, target):
-                    for key in source.keys():
-                        item = source[key]
-                        if isinstance(item, h5py.Group):
-                            # Create the group and copy its attributes
-                            new_group = target.create_group(key)
-                            for attr_key, attr_value in item.attrs.items():
-                                new_group.attrs[attr_key] = attr_value
-                            copy_items(item, new_group)
-                        elif isinstance(item, h5py.Dataset):
-                            # Create the dataset and copy its data
-                            target.create_dataset(key, data=item[()])
-                            # Copy dataset attributes
-                            for attr_key, attr_value in item.attrs.items():
-                                target[key].attrs[attr_key] = attr_value
-
-                copy_items(temp_file, orig_file)
+                # Copy the groups and datasets with native object copies, which stream the data in blocks and keep
+                # the chunking, filters, maximum shape and fill value of each dataset, and soft links as links
+                for key in temp_file:
+                    if key in (SHARDS_GROUP, SHARDED_SPECTRA_GROUP):
+                        continue  # Views of the shards, written below with paths relative to the project
+                    copy_member(temp_file, key, orig_file)
+
+                if self.spectra_shards is not None and self.spectra_shards.keys():
+                    self.spectra_shards.write_views(orig_file, self.h5file_path)
+        except BaseException:
+            if os.path.exists(saved_path):
+                os.remove(saved_path)
+            raise
+
+        if self.overlay:
+            self._close_working_copy()
+            self._replace_project_file(saved_path)
+            self.h5file = self._open_overlay()
+        else:
+            self._replace_project_file(saved_path)
+
+    def _replace_project_file(self, saved_path):
+        """
+        Internal method replacing the project file with a new version, see replace_file(). The delta that would
+        bring the first backup up to date with the project file no longer applies, see _save_changes().
+        """
+        if os.path.exists(self._backup_redo_path()):
+            os.remove(self._backup_redo_path())
+        replace_file(saved_path, self.h5file_path, self.backups)
+
+    def _backup_redo_path(self):
+        """Internal method returning the path of the delta from the first backup to the project file."""
+        return backup_path(self.h5file_path, 1) + '.redo'
+
+    def _save_changes(self):
+        """
+        Internal method saving the project by writing the changes recorded since the last save, see
+        save_project().
+
+        Where the filesystem supports reflinks, or with more than one backup, the changes are written into a copy
+        of the project file, which then replaces it. Elsewhere copying would write the whole file, so they are
+        written through an OverlayFile over the project file, whose delta file only holds the pages written. The
+        delta is synced to the disk and renamed to '<name>.h5.redo', then applied to the project file in place
+        (see _apply_redo_log()); after a crash, load_h5file() applies it again. With one backup, the backup is
+        first brought up to the version being replaced, by applying the delta of the previous save to it, or by
+        copying the project file when the delta no longer applies, e.g. after a save in full.
+
+        Returns:
+            bool: False if the project file must be written in full instead.
+        """
+        if self._changed_paths is None or self.overlay or not os.path.exists(self.h5file_path):
+            return False
 
+        saved_path = self.h5file_path + '.saving'
+        overlay_file = None
+        if not reflink_file(self.h5file_path, saved_path):
+            if self.backups > 1:
+                copy_file(self.h5file_path, saved_path)
+            else:
+                overlay_file = OverlayFile(self.h5file_path, saved_path)
+        try:
+            with h5py.File(saved_path if overlay_file is None else overlay_file, 'r+') as project_file:
+                # Without free-space tracking, the space of the objects replaced would be lost for good once the
+                # file is closed
+                complete = bool(project_file.id.get_create_plist().get_file_space_strategy()[1])
+                if complete:
+                    self._write_changes(project_file)
+                    # Written in full when mostly unused, so that the working copy can be compacted from it
+                    complete = self.repack_threshold is None or free_space_ratio(project_file) <= self.repack_threshold
+        except BaseException:
+            if overlay_file is not None:
+                overlay_file.close()
+            os.remove(saved_path)
+            raise
+        if overlay_file is not None:
+            overlay_file.close()
+        if not complete:
+            os.remove(saved_path)
+            return False
+        if overlay_file is None:
+            self._replace_project_file(saved_path)
+            return True
+
+        if self.backups:
+            first_backup = backup_path(self.h5file_path, 1)
+            backup_redo_path = self._backup_redo_path()
+            if (os.path.exists(first_backup) and not os.path.samefile(first_backup, self.h5file_path)
+                    and delta_matches(backup_redo_path, self.h5file_path)):
+                apply_delta(backup_redo_path, first_backup)
+            else:
+                copy_file(self.h5file_path, first_backup + '.saving')
+                replace_file(first_backup + '.saving', first_backup)
+            if os.path.exists(backup_redo_path):
+                os.remove(backup_redo_path)
+        redo_path = self.h5file_path + '.redo'
+        replace_file(saved_path, redo_path)  # Synced, then committed by the rename
+        self._apply_redo_log()
+        return True
+
+    def _apply_redo_log(self):
+        """
+        Internal method applying the changes of a save committed to '<name>.h5.redo' to the project file, see
+        _save_changes(). The delta is then kept to bring the first backup up to date at the next save, or deleted
+        without backups.
+        """
+        redo_path = self.h5file_path + '.redo'
+        apply_delta(redo_path, self.h5file_path)
+        if self.backups:
+            os.replace(redo_path, self._backup_redo_path())
         else:
-            print("No open temporary HDF5 file to save.")
+            os.remove(redo_path)
+        sync_directory(redo_path)
+
+    def _write_changes(self, project_file):
+        """
+        Internal method writing the changes recorded since the last save into the open project file. Does not
+        flush.
+        """
+        temp_file = self.h5file
+        _copy_attributes(temp_file, project_file)
+
+        for old_path, new_path in self._moves:
+            if old_path in project_file:
+                if new_path in project_file:
+                    del project_file[new_path]  # Replaced in the working copy: the changes below it are recorded
+                project_file.move(old_path, new_path)
+
+        def is_covered(path):
+            # Whether a parent of the path was changed, and is copied with everything below it
+            while path.count('/') > 1:
+                path = path.rsplit('/', 1)[0]
+                if path in self._changed_paths:
+                    return True
+            return False
+
+        for path in sorted(self._changed_paths):
+            if is_covered(path):
+                continue
+            if project_file.get(path, getlink=True) is not None:
+                del project_file[path]
+            parent_path, name = path.rsplit('/', 1)
+            if (parent_path or '/') not in temp_file:
+                continue  # Deleted along with its parent
+            parent = project_file
+            for group_name in parent_path.strip('/').split('/') if parent_path else []:
+                if group_name not in parent:
+                    # A group created since the last save, which stays even if the object was deleted since
+                    _copy_attributes(temp_file[f'{parent.name.rstrip("/")}/{group_name}'],
+                                     parent.create_group(group_name))
+                parent = parent[group_name]
+            if temp_file.get(path, getlink=True) is None:
+                continue  # Deleted
+            copy_member(temp_file[parent_path or '/'], name, parent)
+
+        for path in self._changed_attrs:
+            if path in self._changed_paths or is_covered(path) or path not in temp_file or path not in project_file:
+                continue
+            _copy_attributes(temp_file[path], project_file[path])
+
+        if self.spectra_shards is not None and self.spectra_shards.keys():
+            self.spectra_shards.write_views(project_file, self.h5file_path)
+
+    def repack(self, progress_callback=None, cancel_event=None, **options):
+        """
+        Saves the project, then rewrites the project file into a fresh one with repack_project(), reclaiming the
+        space left unused in it and optionally storing the data already in the project with other chunking,
+        shuffle and compression options, which new data then uses too. The working copy is reopened from the
+        repacked file.
+
+        Parameters:
+            progress_callback (callable or None): Called as progress_callback(done, total), see repack_file().
+            cancel_event (threading.Event or None): When set, the repack stops and the saved file is kept.
+            **options: Values of the storage options 'compression', 'compression_opts', 'shuffle' and 'chunks'.
+
+        Returns:
+            dict: The report of repack_project(), with the bytes reclaimed.
+
+        Raises:
+            ValueError: If the temporary HDF5 file is not open, or an option cannot be changed by a repack or has
+                        an invalid value.
+        """
+        if self.h5file is None:
+            raise ValueError("Temporary HDF5 file not created or opened.")
+        unknown = set(options) - set(REPACK_OPTIONS)
+        if unknown:
+            raise ValueError(f"Storage option(s) {', '.join(sorted(unknown))} cannot be changed by a repack.")
+        validate_storage_options({**self.storage_options, **options})
+        self.save_project()
+        self._close_working_copy()
+        try:
+            report = repack_project(self.h5file_path, options=options or None, progress_callback=progress_callback,
+                                    cancel_event=cancel_event)
+        finally:
+            self.load_h5file()
+        return report
 
     def check_unsaved_changes(self, detailed=False):
         """
         Checks if there are unsaved changes in the temporary HDF5 file and returns them.
 
+        Whether there are changes is told by those recorded since the last save, see save_project(), without
+        reading the files. The files are compared for the details, or when the changes are not known.
+
         Parameters:
             detailed (bool): If True, returns a dictionary with details of differences;
                              if False, returns a boolean indicating whether there are unsaved changes.
@@ -1023,11 +3323,14 @@ class BrillouinProject:
             raise ValueError(
                 "Temporary HDF5 file not created or opened. Please call create_h5file or load_h5file first.")
 
+        if not detailed and self._changed_paths is not None:
+            return bool(self._changed_paths or self._changed_attrs or self._moves)
+
         # Save the current in-memory version to ensure it is up-to-date
         self.h5file.flush()
 
         # Compare the temporary file with the on-disk version
-        differences = self._compare_h5_files(self.temp_h5file_path, self.h5file_path)
+        differences = self._compare_h5_files(self.h5file, self.h5file_path)
 
         if detailed:
             return differences
@@ -1039,7 +3342,8 @@ class BrillouinProject:
         Compares two HDF5 files and returns the differences.
 
         Parameters:
-            file1_path (str): Path to the first HDF5 file (temporary file).
+            file1_path (str or h5py.File): Path to the first HDF5 file (temporary file), or that file if it is open,
+                                           e.g. held in memory.
             file2_path (str): Path to the second HDF5 file (original file on disk).
 
         Returns:
@@ -1047,7 +3351,11 @@ class BrillouinProject:
         """
         differences = {"added": [], "removed": [], "altered": []}
 
-        with h5py.File(file1_path, 'r') as file1, h5py.File(file2_path, 'r') as file2:
+        with contextlib.ExitStack() as stack:
+            file1 = file1_path
+            if not isinstance(file1, h5py.File):
+                file1 = stack.enter_context(h5py.File(file1_path, 'r'))
+            file2 = stack.enter_context(h5py.File(file2_path, 'r'))
             def compare_items(name, obj):
                 if name not in file2:
                     differences["added"].append(name)
@@ -1059,7 +3367,9 @@ class BrillouinProject:
                         for sub_name in obj:
                             compare_items(name + '/' + sub_name, obj[sub_name])
                     elif isinstance(obj, h5py.Dataset):
-                        if not np.array_equal(obj[()], file2[name][()]):
+                        # Unset values of the metadata table and fit results are NaN
+                        equal_nan = obj.dtype.kind == 'f' and file2[name].dtype.kind == 'f'
+                        if not np.array_equal(obj[()], file2[name][()], equal_nan=equal_nan):
                             differences["altered"].append(name)
 
             def compare_removed(name, obj):
@@ -1070,11 +3380,15 @@ class BrillouinProject:
                         for sub_name in obj:
                             compare_removed(name + '/' + sub_name, obj[sub_name])
 
+            # The views of the shards are rewritten by every save, and cannot be read through an overlay
+            views = (SHARDS_GROUP, SHARDED_SPECTRA_GROUP)
             for item in file1:
-                compare_items(item, file1[item])
+                if item not in views:
+                    compare_items(item, file1[item])
 
             for item in file2:
-                compare_removed(item, file2[item])
+                if item not in views:
+                    compare_removed(item, file2[item])
 
         return differences
 
@@ -1,8 +1,12 @@
 # calibration_manager.py
+from functools import partial
+
 import numpy as np
 from PySide6.QtCore import Qt, QObject, Signal
 from PySide6.QtWidgets import QFileDialog, QMessageBox, QInputDialog
+from .brillouin_project import IMPORT_IMPORTED, IMPORT_CANCELLED
 from .calibration_file_table_model import CalibrationFileTableModel
+from .import_worker import BackgroundImport, IMPORT_FILE_FILTER
 from .calibration_plot_widget import CalibrationPlotWidget
 from ..utils.brillouin_calibration import BrillouinCalibration
 
@@ -463,16 +467,41 @@ class CalibrationManager(QObject):
         self.calib_files_model.setPlottedFile(None)
 
     def calib_add_files_clicked(self):
-        if self.project:
+        if self.project and self.project_manager.import_job is None:
             calibration_name = self.ui.comboBox_calibSelect.currentText()
             if calibration_name:
-                filepaths, _ = QFileDialog.getOpenFileNames(None, "Add Calibration Files", "", "Data Files (*.DAT)")
+                filepaths, _ = QFileDialog.getOpenFileNames(None, "Add Calibration Files", "", IMPORT_FILE_FILTER)
                 if filepaths:
-                    for filepath in filepaths:
-                        self.project.add_file_to_calibration(calibration_name, filepath)
-                    self.calib_select_changed()  # Refresh the files in the calibration
-                    self.last_action('Files added to calibration')
-                    self.save_status()
+                    import_function = partial(self.project.import_files_to_calibration, calibration_name)
+                    import_job = BackgroundImport(import_function, filepaths, "Adding calibration files")
+                    import_job.files_imported.connect(self.calib_add_imported_files_to_table)
+                    import_job.finished.connect(self.calib_import_finished)
+                    import_job.error.connect(self.calib_import_failed)
+                    self.last_action('Adding files to calibration')
+                    # Shares the import slot of the project manager, which locks the controls of both tabs
+                    self.project_manager.start_import(import_job)
+
+    def calib_add_imported_files_to_table(self, entries):
+        """Add the rows of newly imported calibration files to the table while the import is running."""
+        imported = [entry['name'] for entry in entries if entry['status'] == IMPORT_IMPORTED]
+        if imported:
+            self.calib_files_model.addFiles(imported)
+
+    def calib_import_finished(self, report):
+        """Slot called once a background calibration import has finished or was cancelled."""
+        self.project_manager.end_import()
+        self.calib_select_changed()  # Refresh the files in the calibration
+        self.project_manager.show_import_failures(report)
+        cancelled = any(entry['status'] == IMPORT_CANCELLED for entry in report)
+        self.last_action('Calibration file import cancelled' if cancelled else 'Files added to calibration')
+        self.save_status()
+
+    def calib_import_failed(self, message):
+        """Slot called if a background calibration import raised an error."""
+        self.project_manager.end_import()
+        self.calib_select_changed()
+        QMessageBox.critical(None, "Error", f"Failed to add calibration files: {message}")
+        self.save_status()
 
     def calib_remove_files_clicked(self):
         if self.project:
@@ -6,6 +6,7 @@ import os
 
 class FileTableModel(QAbstractTableModel):
     data_changed_signal = Signal(int, str, dict)  # Signal to notify ProjectManager (row index, filename, metadata)
+    validation_failed = Signal(str)  # Message for a value rejected by setData, e.g. text in a numeric column
 
     def __init__(self, files=None, parent=None):
         super(FileTableModel, self).__init__(parent)
@@ -66,11 +67,13 @@ class FileTableModel(QAbstractTableModel):
             if col in [0, 1]:
                 return False
             if role == Qt.EditRole:
+                # Default values are numbers like the values of the files they are applied to
+                default_value = self._to_number(col, value['value'] if isinstance(value, dict) else value)
+                if default_value is False:
+                    return False
+                self._default_values[col]['value'] = default_value
                 if isinstance(value, dict):
-                    self._default_values[col]['value'] = value['value'] if value['value'] != '' else None
                     self._default_values[col]['use_default'] = value['use_default']
-                else:
-                    self._default_values[col]['value'] = value if value != '' else None
                 self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
                 return True
             return False
@@ -132,9 +135,47 @@ class FileTableModel(QAbstractTableModel):
     def removeFileByName(self, filename):
         self._remove_file_by_condition(lambda row: row[0] == filename)
 
-    def addFiles(self, filepaths, default_calibration=None):
+    def fileNames(self):
+        return [row[0] for row in self._files]
+
+    def updateFiles(self, files):
+        """
+        Replaces the values of the rows of files, e.g. whose metadata an undo restored, without reporting them as
+        edits. Only the rows whose values changed are repainted.
+
+        Parameters:
+            files (dict): filename -> values of the columns after 'Calibration'.
+        """
+        for row, file_data in enumerate(self._files):
+            values = files.get(file_data[0])
+            if values is not None and file_data[2:] != list(values):
+                file_data[2:] = values
+                self.dataChanged.emit(self.index(row + 1, 2), self.index(row + 1, self.columnCount() - 1),
+                                      [Qt.DisplayRole, Qt.EditRole])
+
+    def addFileRows(self, files):
+        """
+        Appends rows of files without reporting them as edits, e.g. files an undo moved into the table, so that
+        their metadata is not written back.
+
+        Parameters:
+            files (list of tuple): The values of the rows, as for addFilesWithMetadata().
+        """
+        if not files:
+            return
+        position = len(self._files)
+        self.beginInsertRows(QModelIndex(), position + 1, position + len(files))  # Skip the default row
+        self._files.extend(list(file_data) for file_data in files)
+        self.endInsertRows()
+
+    def addFiles(self, filepaths, default_calibration=None, file_metadata=None):
+        # file_metadata optionally gives per-file values known from the file itself (e.g. {'scans': 100}),
+        # used for columns without an applied default value
+        metadata_columns = {'chi_angle': 2, 'pinhole': 3, 'power': 4, 'polarization': 5, 'scans': 6}
         new_files = []
-        for filepath in filepaths:
+        for i, filepath in enumerate(filepaths):
+            metadata = file_metadata[i] if file_metadata else {}
+            known_values = {metadata_columns[key]: value for key, value in metadata.items() if key in metadata_columns}
             file_data = [os.path.basename(filepath)]
             for col in range(1, self.columnCount()):
                 if col == 1:
@@ -142,7 +183,7 @@ class FileTableModel(QAbstractTableModel):
                 elif self._default_values[col]['use_default']:
                     value = self._default_values[col]['value']
                 else:
-                    value = None
+                    value = known_values.get(col)
                 file_data.append(value)
             new_files.append(file_data)
         self._add_files_to_model(new_files)
@@ -174,14 +215,26 @@ class FileTableModel(QAbstractTableModel):
         return column > 1  # Columns after 'Calibration' are editable
 
     def _validate_and_set_data(self, index, value):
+        if index.column() == 1:
+            self._files[index.row() - 1][index.column()] = value  # Store the calibration name
+        elif index.column() > 1:
+            value = self._to_number(index.column(), value)  # Convert to float or None for empty
+            if value is False:
+                return False
+            self._files[index.row() - 1][index.column()] = value  # Adjust for default row
+        return True
+
+    def _to_number(self, column, value):
+        """
+        Returns the float of a value entered in a numeric column, None if it is empty, or False after emitting
+        validation_failed if it is not a number, so that it is neither shown nor written to the project.
+        """
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return None
         try:
-            if index.column() == 1:
-                self._files[index.row() - 1][index.column()] = value  # Store the calibration name
-            elif index.column() > 1:
-                value = float(value) if value else None  # Convert to float or None for empty
-                self._files[index.row() - 1][index.column()] = value  # Adjust for default row
-            return True
-        except ValueError:
+            return float(value)
+        except (TypeError, ValueError):
+            self.validation_failed.emit(f"{self._headers[column]} must be a number, got '{value}'")
             return False
 
     def clear(self):
@@ -0,0 +1,123 @@
+# src/analysis/import_worker.py
+import threading
+import time
+
+from PySide6.QtCore import Qt, QObject, QThread, Signal
+from PySide6.QtWidgets import QProgressDialog
+
+# File dialog filter for the files accepted by the bulk imports: .DAT files and archives of .DAT files
+IMPORT_FILE_FILTER = "Data Files (*.DAT);;Archives (*.zip *.tar *.tar.gz *.tgz *.tar.bz2 *.tar.xz)"
+
+
+class ImportWorker(QObject):
+    """
+    Runs a bulk import of the BrillouinProject on a worker thread.
+
+    The import function must accept progress_callback and cancel_event keyword arguments, like
+    BrillouinProject.import_files(). While the worker runs it is the only thread writing to the HDF5 file.
+    """
+    progress = Signal(int, int)  # Files handled so far, total number of files
+    files_imported = Signal(list)  # Batch of report entries for files handled since the last emission
+    finished = Signal(list)  # The full import report
+    error = Signal(str)
+
+    BATCH_INTERVAL = 0.1  # Minimum number of seconds between two files_imported emissions
+
+    def __init__(self, import_function, file_paths):
+        super().__init__()
+        self._import_function = import_function
+        self._file_paths = file_paths
+        self._cancel_event = threading.Event()
+        self._batch = []
+        self._last_emit = 0.0
+
+    def run(self):
+        try:
+            report = self._import_function(self._file_paths, progress_callback=self._on_progress,
+                                           cancel_event=self._cancel_event)
+        except Exception as e:
+            self._emit_batch()
+            self.error.emit(str(e))
+            return
+        self._emit_batch()
+        self.finished.emit(report)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def _on_progress(self, done, total, entry):
+        self._batch.append(entry)
+        now = time.monotonic()
+        if now - self._last_emit >= self.BATCH_INTERVAL:
+            self._emit_batch()
+            self.progress.emit(done, total)
+            self._last_emit = now
+
+    def _emit_batch(self):
+        if self._batch:
+            self.files_imported.emit(self._batch)
+            self._batch = []
+
+
+class BackgroundImport(QObject):
+    """
+    Runs an ImportWorker on its own QThread, showing its progress in a non-modal dialog with a cancel button, so
+    the rest of the application stays usable. Callers disable what would read or change the project until it ends.
+
+    Report entries are forwarded through files_imported in batches as files arrive, so tables can be
+    updated incrementally, and the full report is delivered through finished once the thread is done.
+    """
+    files_imported = Signal(list)
+    finished = Signal(list)
+    error = Signal(str)
+
+    def __init__(self, import_function, file_paths, title="Importing files"):
+        super().__init__()
+        self._thread = QThread()
+        self._worker = ImportWorker(import_function, file_paths)
+        self._worker.moveToThread(self._thread)
+
+        self._progress_dialog = QProgressDialog(title, "Cancel", 0, len(file_paths))
+        self._progress_dialog.setWindowTitle(title)
+        self._progress_dialog.setWindowModality(Qt.NonModal)
+        self._progress_dialog.setMinimumDuration(0)
+        self._progress_dialog.setAutoClose(False)
+        self._progress_dialog.setAutoReset(False)
+        self._progress_dialog.canceled.connect(self.cancel)
+
+        self._thread.started.connect(self._worker.run)
+        self._worker.progress.connect(self._update_progress)
+        self._worker.files_imported.connect(self.files_imported)
+        self._worker.finished.connect(self._on_finished)
+        self._worker.error.connect(self._on_error)
+
+    def start(self):
+        self._progress_dialog.setValue(0)
+        self._progress_dialog.show()
+        self._thread.start()
+
+    def cancel(self):
+        self._progress_dialog.setLabelText("Cancelling...")
+        self._worker.cancel()
+
+    def is_running(self):
+        return self._thread.isRunning()
+
+    def _update_progress(self, done, total):
+        # The total can differ from the number of paths given, e.g. when archives are expanded into their members
+        self._progress_dialog.setMaximum(total)
+        self._progress_dialog.setValue(done)
+        self._progress_dialog.setLabelText(f"Imported {done} of {total} file(s)")
+
+    def _on_finished(self, report):
+        self._stop_thread()
+        self.finished.emit(report)
+
+    def _on_error(self, message):
+        self._stop_thread()
+        self.error.emit(message)
+
+    def _stop_thread(self):
+        self._thread.quit()
+        self._thread.wait()
+        self._progress_dialog.close()
@@ -3,6 +3,8 @@
 from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex
 import numpy as np
 
+from src.utils.fit_results import PEAK_FIT_FIELDS
+
 class PeakFitsTableModel(QAbstractTableModel):
     def __init__(self, project=None, parent=None):
         super(PeakFitsTableModel, self).__init__(parent)
@@ -30,6 +32,7 @@ class PeakFitsTableModel(QAbstractTableModel):
         ]
         self.current_file = None
         self._velocities = []
+        self._values = np.empty((0, len(PEAK_FIT_FIELDS)))  # [velocity, field] fit results of the current file
         self.update_data()
 
     def set_current_file(self, filename):
@@ -39,14 +42,41 @@ class PeakFitsTableModel(QAbstractTableModel):
     def update_data(self):
         self.beginResetModel()
         if self.project and self.current_file:
-            # Get velocities for the current file
-            self.project.update_file_velocities(self.current_file)
-            velocities_group = self.project.h5file['data'][self.current_file]['velocities']
-            self._velocities = list(velocities_group.keys())
+            # Read the results of the current file for all velocities at once
+            self._velocities, self._values = self.project.get_file_fit_results(self.current_file)
         else:
             self._velocities = []
+            self._values = np.empty((0, len(PEAK_FIT_FIELDS)))
         self.endResetModel()
 
+    def refresh(self):
+        """
+        Re-reads the results of the current file, e.g. after an undo, notifying the views of the rows removed,
+        inserted and changed only, so that their selection and scrolling are kept.
+        """
+        if not (self.project and self.current_file):
+            self.update_data()
+            return
+        velocities, values = self.project.get_file_fit_results(self.current_file)
+        kept = set(velocities)
+        for row in reversed(range(len(self._velocities))):
+            if self._velocities[row] not in kept:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._velocities[row]
+                self._values = np.delete(self._values, row, axis=0)
+                self.endRemoveRows()
+        # Both lists are sorted, so the velocities left are in place and the new ones are inserted between them
+        for row, velocity in enumerate(velocities):
+            if row == len(self._velocities) or self._velocities[row] != velocity:
+                self.beginInsertRows(QModelIndex(), row, row)
+                self._velocities.insert(row, velocity)
+                self._values = np.insert(self._values, row, values[row], axis=0)
+                self.endInsertRows()
+        changed = ~((self._values == values) | (np.isnan(self._values) & np.isnan(values))).all(axis=1)
+        self._values = values
+        for row in np.flatnonzero(changed).tolist():
+            self.dataChanged.emit(self.index(row, 1), self.index(row, self.columnCount() - 1), [Qt.DisplayRole])
+
     def rowCount(self, parent=QModelIndex()):
         return len(self._velocities)
 
@@ -67,10 +97,9 @@ class PeakFitsTableModel(QAbstractTableModel):
                 return velocity_name
             else:
                 data_key = self.column_to_data_key(column_name)
-                data_dict = self.project.get_peak_fit_data(self.current_file, velocity_name)
-                value = data_dict.get(data_key, np.nan)
-                if value is None or (isinstance(value, float) and np.isnan(value)):
-                    return ''  # Return empty string for None or np.nan
+                value = float(self._values[row, PEAK_FIT_FIELDS.index(data_key)])
+                if np.isnan(value):
+                    return ''  # Return empty string for np.nan
                 else:
                     return str(value)
         return None
@@ -132,6 +161,7 @@ class PeakFitsTableModel(QAbstractTableModel):
         # Update the data in the HDF5 file
         data_dict = {data_key: value}
         self.project.set_peak_fit_data(self.current_file, velocity_name, data_dict)
+        self._values[row, PEAK_FIT_FIELDS.index(data_key)] = value
         # Notify that data has changed
         self.dataChanged.emit(index, index, [Qt.DisplayRole])
         return True
@@ -1,23 +1,63 @@
 # src/analysis/project_manager.py
+import contextlib
+
 import numpy as np
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QKeySequence, QClipboard
 from PySide6.QtWidgets import QFileDialog, QMessageBox, QInputDialog, QAbstractItemView, QTableWidgetItem, QMenu, \
     QApplication, QTableView, QPlainTextEdit, QVBoxLayout, QWidget
 
-from .brillouin_project import BrillouinProject
+from .brillouin_project import BrillouinProject, IMPORT_IMPORTED, IMPORT_FAILED, IMPORT_CANCELLED, IMPORT_CONFLICT
+from .import_worker import BackgroundImport, IMPORT_FILE_FILTER
 from .file_table_model import FileTableModel  # Import the custom model
 from .calibration_file_table_model import CalibrationFileTableModel
 from ..utils.checkbox_lineedit_delegate import CheckboxLineEditDelegate
+from ..utils.spectrum_feed import DEFAULT_FEED_PORT
 from .peak_fits_table_model import PeakFitsTableModel
 import os
+import tempfile
+import time
+from functools import partial
 
 
 class ProjectManager:
+    LARGE_IMPORT_FILE_COUNT = 1000  # Above this many files, offer to register files instead of importing them
+    FEED_SPECTRA_PER_POLL = 200  # Maximum number of spectra written from the live feed per timer tick
+    AUTOSAVE_POLL_INTERVAL = 10000  # Milliseconds between two checks for a due autosave of an in-memory project
+    # Controls disabled while a background import runs, as they read or change the project the import writes
+    IMPORT_LOCKED_WIDGETS = ('pushButton_newProject', 'pushButton_loadProject', 'pushButton_saveProject',
+                             'pushButton_deleteProject', 'lineEdit_currentProject', 'pushButton_newPressure',
+                             'pushButton_deletePressure', 'pushButton_newCrystal', 'pushButton_deleteCrystal',
+                             'pushButton_newVelocity', 'pushButton_deleteVelocity', 'pushButton_renameVelocity',
+                             'pushButton_addFiles', 'pushButton_removeFiles', 'pushButton_watchFolder',
+                             'pushButton_liveFeed', 'comboBox_pressure', 'comboBox_crystal', 'tab_calib',
+                             'tableView_peakFits')
+
     def __init__(self, ui):
         self.ui = ui
         self.project = None
         self.unsaved_changes = False
+        self.import_job = None  # Background file import in progress, if any
+        self.deferred_metadata = []  # Table edits received while a background import was writing
+        self.in_memory = False  # Whether projects are created and loaded with their working copy in RAM (File menu)
+        self.overlay = False  # Whether projects are opened without copying them, changes in a delta file (File menu)
+        self.scratch_folder = None  # Folder of the temporary files, None for each project's 'temp' folder (File menu)
+
+        # Timer polling the watched folder for new files while the watch mode is on
+        self.watch_timer = QTimer()
+        self.watch_timer.setInterval(1000)
+        self.watch_timer.timeout.connect(self.poll_watch_folder)
+
+        # Timer writing the spectra received from the live feed while it is on
+        self.feed_timer = QTimer()
+        self.feed_timer.setInterval(200)
+        self.feed_timer.timeout.connect(self.poll_feed)
+
+        # Timer autosaving the working copy of projects held in memory, which changes do not write to disk
+        self.autosave_timer = QTimer()
+        self.autosave_timer.setInterval(self.AUTOSAVE_POLL_INTERVAL)
+        self.autosave_timer.timeout.connect(self.poll_autosave)
+        self.autosave_timer.start()
 
         # Create an instance of the custom model
         self.file_model = FileTableModel()
@@ -68,6 +108,8 @@ class ProjectManager:
         self.save_status()
 
     def file_double_clicked(self, index):
+        if self.import_job is not None:
+            return  # The fit results are read once the import has finished
         # Get the filename from the file model
         if index.isValid():
             row = index.row()
@@ -115,6 +157,9 @@ class ProjectManager:
         """Update project status based on whether there are unsaved changes."""
         if self.project is None:
             self.ui.label_projectStatus.setText("| No project loaded")
+        elif self.import_job is not None:
+            # The import thread is the only reader of the project while it runs, and it adds files
+            self.ui.label_projectStatus.setText("| Unsaved Changes")
         else:
             unsaved_changes = self.project.check_unsaved_changes()
             if unsaved_changes:
@@ -126,6 +171,7 @@ class ProjectManager:
         """Setup signal-slot connections."""
         # Connect model signal for metadata updates
         self.file_model.data_changed_signal.connect(self.update_metadata)
+        self.file_model.validation_failed.connect(self.last_action)
 
         # Connect UI buttons to methods
         self.ui.pushButton_newProject.clicked.connect(self.new_project_clicked)
@@ -141,6 +187,8 @@ class ProjectManager:
         self.ui.pushButton_renameVelocity.clicked.connect(self.rename_velocity_clicked)
         self.ui.pushButton_addFiles.clicked.connect(self.add_files_clicked)
         self.ui.pushButton_removeFiles.clicked.connect(self.remove_files_clicked)
+        self.ui.pushButton_watchFolder.toggled.connect(self.watch_folder_toggled)
+        self.ui.pushButton_liveFeed.toggled.connect(self.live_feed_toggled)
         self.ui.lineEdit_currentProject.editingFinished.connect(self.rename_project_clicked)
 
         # Connect comboboxes
@@ -160,6 +208,9 @@ class ProjectManager:
         copy_action = menu.addAction("Copy")
         paste_action = menu.addAction("Paste")
         fill_column_action = menu.addAction("Fill column")
+        materialize_action = menu.addAction("Load data of registered files")
+        materialize_action.setEnabled(bool(self.project) and self.import_job is None
+                                      and bool(self.project.list_registered_files()))
 
         action = menu.exec_(self.ui.tableView_files.viewport().mapToGlobal(pos))
 
@@ -167,11 +218,15 @@ class ProjectManager:
             self.copy_selection()
             self.last_action('Copied')
         elif action == paste_action:
-            self.paste_selection()
+            with self.history_step('Paste'):
+                self.paste_selection()
             self.last_action('Pasted')
         elif action == fill_column_action:
-            self.fill_column(index)  # Call fill_column method with the selected index
+            with self.history_step('Fill column'):
+                self.fill_column(index)  # Call fill_column method with the selected index
             self.last_action('Fill column')
+        elif action == materialize_action:
+            self.materialize_files()
 
         self.save_status()
 
@@ -242,14 +297,78 @@ class ProjectManager:
         if event.matches(QKeySequence.Copy):
             self.copy_selection()
         elif event.matches(QKeySequence.Paste):
-            self.paste_selection()
+            with self.history_step('Paste'):
+                self.paste_selection()
         else:
             QTableView.keyPressEvent(self.ui.tableView_files, event)
 
+    def history_step(self, label):
+        """Return a context gathering the project changes made in it into one step of the undo history."""
+        if self.project is None:
+            return contextlib.nullcontext()
+        return self.project.undo_group(label)
+
+    def undo_clicked(self):
+        """Undo the last change to the project."""
+        self.apply_history(redo=False)
+
+    def redo_clicked(self):
+        """Redo the last change undone."""
+        self.apply_history(redo=True)
+
+    def apply_history(self, redo):
+        """
+        Undo or redo a step of the project history, then update only the table rows and lists it changed, so that
+        the selection and scrolling of the tables are kept.
+        """
+        if self.project is None or self.import_job is not None:
+            return  # The import thread is the only writer while it runs
+        try:
+            changes = self.project.redo() if redo else self.project.undo()
+        except ValueError as e:
+            self.last_action(str(e))
+            return
+        if changes['attributes']:
+            self.populate_table_widgets()
+            if changes['attributes'] & {'pressures', 'crystals'}:
+                self.populate_dropdowns()
+        if changes['files']:
+            self.refresh_files(changes['files'])
+        if changes['peak_fits'] or 'velocities' in changes['attributes']:
+            self.peak_fits_model.refresh()
+        self.last_action(f"{'Redone' if redo else 'Undone'}: {changes['label']}")
+        self.save_status()
+
+    def refresh_files(self, filenames):
+        """
+        Update the rows of files whose metadata changed without the table being rebuilt: rows are updated in place,
+        and added or removed for files whose pressure or crystal now matches, or no longer matches, the selection.
+        """
+        selected_pressure = self.ui.comboBox_pressure.currentText()
+        selected_crystal = self.ui.comboBox_crystal.currentText()
+        if not (selected_pressure and selected_crystal):
+            return
+        matching = set(self.project.find_files_by_pressure_and_crystal(float(selected_pressure), selected_crystal))
+        shown = set(self.file_model.fileNames())
+        for filename in sorted(set(filenames) & shown - matching):
+            self.file_model.removeFileByName(filename)
+
+        filenames = sorted(set(filenames) & matching)
+        keys = ('chi_angle', 'pinhole', 'power', 'polarization', 'scans')
+        metadata = self.project.get_metadata_of_datasets(filenames, keys)
+        values = {filename: [metadata[key][i] for key in keys] for i, filename in enumerate(filenames)}
+        self.file_model.updateFiles(values)
+        default_calibration = self.ui.comboBox_calibration.currentText()
+        self.file_model.addFileRows([(filename, default_calibration, *values[filename])
+                                     for filename in filenames if filename not in shown])
+
     def check_unsaved_changes(self):
         """Check if there are unsaved changes and show a popup with the changes."""
         if self.project is None:
             return True  # No project open, safe to close
+        if self.import_job is not None:
+            QMessageBox.information(None, "Import Running", "Cancel or wait for the file import before closing.")
+            return False
 
         # Get the unsaved changes
         changes = self.project.check_unsaved_changes(detailed=True)
@@ -306,6 +425,8 @@ class ProjectManager:
             return False  # Cancel the close event
 
     def cleanup_project(self):
+        self.stop_watch_folder()
+        self.stop_feed()
         if self.project:
             self.project.cleanup_temp_file()
             self.project = None
@@ -344,25 +465,35 @@ class ProjectManager:
         """
         Slot to receive metadata changes from FileTableModel and update the HDF5 temp file.
         """
+        if self.import_job is not None:
+            # The import thread is the only writer while it runs; apply the change once it has finished
+            self.deferred_metadata.append((row, filename, metadata))
+            return
         if self.project:
             try:
-                # Ensure the file exists in the HDF5 file before updating metadata
-                if filename in self.project.h5file['data']:
-                    for key, value in metadata.items():
-                        if key == 'calibration':
-                            # Store the calibration name as metadata
-                            self.project.add_metadata_to_dataset(filename, key, value)
-                            continue
-                        if value is None and key in ['chi_angle', 'pinhole', 'power', 'polarization', 'scans']:
-                            value = np.nan  # Use np.nan for missing numeric values
-                        self.project.add_metadata_to_dataset(filename, key, value)
+                if self.write_metadata(filename, metadata):
                     self.last_action('Table modified')
-                else:
-                    print(f"Warning: Tried to update metadata for non-existent file: {filename}")
+            except ValueError as e:
+                self.last_action(f'Invalid value: {e}')  # Nothing was written
             except Exception as e:
                 QMessageBox.critical(None, "Error", f"Failed to update metadata in temp file: {e}")
         self.save_status()
 
+    def write_metadata(self, filename, metadata):
+        """Write one row of table metadata to the HDF5 temp file. Returns False if the file is not in the project."""
+        # Ensure the file exists in the HDF5 file before updating metadata
+        if filename not in self.project.h5file['data']:
+            print(f"Warning: Tried to update metadata for non-existent file: {filename}")
+            return False
+        values = {}
+        for key, value in metadata.items():
+            if value is None and key in ['chi_angle', 'pinhole', 'power', 'polarization', 'scans']:
+                value = np.nan  # Use np.nan for missing numeric values
+            values[key] = value
+        # Written in one go; rows added back to the table with unchanged values do not touch the file
+        self.project.set_dataset_metadata(filename, values)
+        return True
+
     def pressure_combobox_changed(self):
         """Handle pressure combobox change."""
         self.update_table()
@@ -399,17 +530,11 @@ class ProjectManager:
                 float(selected_pressure), selected_crystal
             )
 
+            keys = ('chi_angle', 'pinhole', 'power', 'polarization', 'scans')
+            metadata = self.project.get_metadata_of_datasets(matching_files, keys)
             files_with_metadata = [
-                (
-                    filename,
-                    default_calibration,  # Use current calibration
-                    self.project.get_metadata_from_dataset(filename, 'chi_angle'),
-                    self.project.get_metadata_from_dataset(filename, 'pinhole'),
-                    self.project.get_metadata_from_dataset(filename, 'power'),
-                    self.project.get_metadata_from_dataset(filename, 'polarization'),
-                    self.project.get_metadata_from_dataset(filename, 'scans')
-                )
-                for filename in matching_files
+                (filename, default_calibration) + tuple(metadata[key][i] for key in keys)  # Use current calibration
+                for i, filename in enumerate(matching_files)
             ]
 
             self.file_model.addFilesWithMetadata(files_with_metadata, default_calibration)
@@ -435,7 +560,10 @@ class ProjectManager:
 
     def create_new_project(self, folder_path, project_name):
         """Create a new project with the specified folder and name."""
-        self.project = BrillouinProject(folder_path, project_name)
+        self.stop_watch_folder()
+        self.stop_feed()
+        self.project = BrillouinProject(folder_path, project_name, in_memory=self.in_memory,
+                                        overlay=self.overlay, scratch_folder=self.scratch_folder)
         self.project.create_h5file()
         self.ui.lineEdit_currentProject.setText(project_name)
         self.update_file_count()
@@ -447,7 +575,14 @@ class ProjectManager:
         filepath = self.get_project_file()
         if filepath:
             self.load_project(filepath)
-            self.last_action('Project loaded')
+            usage = self.project.get_memory_usage()
+            size = f"{usage['file_bytes'] / 2 ** 20:.1f} MB"
+            if usage['in_memory']:
+                self.last_action(f'Project loaded in memory ({size})')
+            elif usage['fits_in_memory']:
+                self.last_action(f'Project loaded ({size}, fits in memory)')
+            else:
+                self.last_action('Project loaded')
             if hasattr(self, 'calibration_manager'):
                 self.calibration_manager.update_project()
             self.save_status()
@@ -459,15 +594,80 @@ class ProjectManager:
 
     def load_project(self, filepath):
         """Load the selected project."""
+        self.stop_watch_folder()
+        self.stop_feed()
         folder = os.path.dirname(filepath)
         project_name = os.path.basename(filepath).replace('.h5', '')
-        self.project = BrillouinProject(folder, project_name)
-        self.project.load_h5file()
+        self.project = BrillouinProject(folder, project_name, in_memory=self.in_memory,
+                                        overlay=self.overlay, scratch_folder=self.scratch_folder)
+        usage = self.project.get_memory_usage()
+        if usage['in_memory'] and usage['fits_in_memory'] is False:
+            QMessageBox.warning(None, "Load Project",
+                                f"This project needs {usage['required_bytes'] / 2 ** 20:.0f} MB of RAM to be held "
+                                f"in memory, more than is available: it is loaded with a temporary file instead.")
+            self.project.in_memory = False
+        recover = False
+        if self.project.has_recoverable_session():
+            answer = QMessageBox.question(
+                None, "Recover Project",
+                "This project was not closed properly. Recover the unsaved changes of the previous session?",
+                QMessageBox.Yes | QMessageBox.No
+            )
+            recover = answer == QMessageBox.Yes
+        try:
+            self.project.load_h5file(recover=recover)
+        except OSError as e:
+            QMessageBox.warning(None, "Recover Project", f"The previous session could not be recovered: {e}")
+            self.project.load_h5file()
         self.ui.lineEdit_currentProject.setText(project_name)
         self.populate_dropdowns()
         self.populate_table_widgets()  # Populate tables after loading project
         self.update_file_count()
 
+    def set_in_memory(self, in_memory):
+        """Set whether the projects created or loaded from now on hold their working copy in RAM."""
+        self.in_memory = in_memory
+        if in_memory:
+            self.last_action('Projects created or loaded from now on are held in memory')
+        else:
+            self.last_action('Projects created or loaded from now on use a temporary file')
+
+    def set_overlay(self, overlay):
+        """Set whether the projects created or loaded from now on are opened without being copied."""
+        self.overlay = overlay
+        if overlay:
+            self.last_action('Projects created or loaded from now on are opened without copying them')
+        else:
+            self.last_action('Projects created or loaded from now on are copied to a temporary file')
+
+    def choose_scratch_folder(self):
+        """Let the user pick the directory of the temporary files."""
+        folder = QFileDialog.getExistingDirectory(None, "Select Scratch Folder", self.scratch_folder or "")
+        if folder:
+            self.set_scratch_folder(folder)
+
+    def set_scratch_folder(self, folder):
+        """
+        Set the directory of the temporary files of the projects created or loaded from now on, or None for a 'temp'
+        folder in the folder of each project. The folder must exist and be writable.
+
+        Returns:
+            bool: False, leaving the setting unchanged, if temporary files cannot be written to the folder.
+        """
+        if folder is not None:
+            try:
+                with tempfile.TemporaryFile(dir=folder):
+                    pass
+            except OSError as e:
+                QMessageBox.warning(None, "Scratch Folder", f"Temporary files cannot be written to {folder}: {e}")
+                return False
+        self.scratch_folder = folder
+        if folder is None:
+            self.last_action('Temporary files go to the folder of each project')
+        else:
+            self.last_action(f'Temporary files go to {folder}')
+        return True
+
     def populate_dropdowns(self):
         """Populate pressure, crystal, and calibration comboboxes with unique values from the project."""
         if self.project:
@@ -494,7 +694,7 @@ class ProjectManager:
 
     def save_project_clicked(self):
         """Handle the save project button click."""
-        if self.project:
+        if self.project and self.import_job is None:
             self.save_project()
             self.last_action('Project saved')
             self.save_status()
@@ -647,25 +847,16 @@ class ProjectManager:
 
     def add_velocity(self, velocity_name):
         self.project.add_velocity(velocity_name)
-        # Update velocities under each file
-        for filename in self.project.list_datasets():
-            self.project.update_file_velocities(filename)
         self.populate_table_widgets()
         self.peak_fits_model.update_data()
 
     def delete_velocity(self, velocity_name):
         self.project.remove_velocity(velocity_name)
-        # Update velocities under each file
-        for filename in self.project.list_datasets():
-            self.project.update_file_velocities(filename)
         self.populate_table_widgets()
         self.peak_fits_model.update_data()
 
     def rename_velocity(self, old_velocity, new_velocity):
         self.project.rename_velocity(old_velocity, new_velocity)
-        # Update velocities under each file
-        for filename in self.project.list_datasets():
-            self.project.update_file_velocities(filename)
         self.populate_table_widgets()
         self.peak_fits_model.update_data()
 
@@ -675,22 +866,252 @@ class ProjectManager:
         crystal_name = self.ui.comboBox_crystal.currentText()
         default_calibration = self.ui.comboBox_calibration.currentText()
 
-        if pressure and crystal_name:
+        if pressure and crystal_name and self.import_job is None:
             self.add_files(float(pressure), crystal_name, default_calibration)
-            self.update_file_count()
-            self.last_action('Files added')
-            self.save_status()
 
     def add_files(self, pressure, crystal_name, default_calibration):
-        """Prompt the user to select files and add them to the project."""
-        filepaths, _ = QFileDialog.getOpenFileNames(None, "Add Files", "", "Data Files (*.DAT)")
+        """Prompt the user to select files and import them into the project in the background."""
+        filepaths, _ = QFileDialog.getOpenFileNames(None, "Add Files", "", IMPORT_FILE_FILTER)
         if filepaths:
-            try:
-                self.project.load_all_files_with_metadata(filepaths, pressure, crystal_name)
-                self.file_model.addFiles(filepaths, default_calibration=default_calibration)
-                self.peak_fits_model.update_data()
-            except Exception as e:
-                QMessageBox.critical(None, "Error", f"Failed to add files: {e}")
+            import_method = self.project.import_files
+            if len(filepaths) > self.LARGE_IMPORT_FILE_COUNT and self.ask_register_files(len(filepaths)):
+                import_method = self.project.register_files
+            import_function = partial(import_method, pressure=pressure, crystal=crystal_name)
+            import_job = BackgroundImport(import_function, filepaths, "Adding files")
+            import_job.files_imported.connect(
+                lambda entries: self.add_imported_files_to_table(entries, default_calibration))
+            import_job.finished.connect(self.import_finished)
+            import_job.error.connect(self.import_failed)
+            self.last_action('Adding files')
+            self.start_import(import_job)
+
+    def ask_register_files(self, file_count):
+        """Ask whether a large number of files should only be registered, deferring reading their data."""
+        answer = QMessageBox.question(
+            None, "Register Files",
+            f"Register the {file_count} files without reading them now?\n\n"
+            "Their data will be read when first needed, or with 'Load data of registered files'. "
+            "Registered files must not be moved or modified until then.",
+            QMessageBox.Yes | QMessageBox.No
+        )
+        return answer == QMessageBox.Yes
+
+    def materialize_files(self):
+        """Read the data of all registered files into the project in the background."""
+        file_names = self.project.list_registered_files()
+        if file_names and self.import_job is None:
+            import_job = BackgroundImport(self.project.materialize_files, file_names, "Loading registered files")
+            import_job.finished.connect(self.import_finished)
+            import_job.error.connect(self.import_failed)
+            self.last_action('Loading registered files')
+            self.start_import(import_job)
+
+    def start_import(self, import_job):
+        """
+        Start a background import, the only reader and writer of the project until end_import(): the controls
+        that would read or change the project are disabled meanwhile, and table edits are deferred.
+        """
+        self.import_job = import_job
+        self.set_import_locked(True)
+        import_job.start()
+
+    def set_import_locked(self, locked):
+        """Disable, or enable again, the controls listed in IMPORT_LOCKED_WIDGETS."""
+        for name in self.IMPORT_LOCKED_WIDGETS:
+            getattr(self.ui, name).setEnabled(not locked)
+
+    def add_imported_files_to_table(self, entries, default_calibration):
+        """Add the rows of newly imported files to the table while the import is running."""
+        imported = [entry for entry in entries if entry['status'] == IMPORT_IMPORTED]
+        if imported:
+            # Fill the columns known from the file headers, given by the report entries: the import thread is the
+            # only reader of the project while it runs
+            file_metadata = [{'scans': entry.get('scans')} for entry in imported]
+            file_paths = [entry['file_path'] for entry in imported]
+            self.file_model.addFiles(file_paths, default_calibration=default_calibration, file_metadata=file_metadata)
+            self.update_file_count()
+
+    def import_finished(self, report):
+        """Slot called once a background import has finished or was cancelled."""
+        self.end_import()
+        self.show_import_failures(report)
+        cancelled = any(entry['status'] == IMPORT_CANCELLED for entry in report)
+        self.last_action('File import cancelled' if cancelled else 'Files added')
+        self.save_status()
+
+    def import_failed(self, message):
+        """Slot called if a background import raised an error."""
+        self.end_import()
+        QMessageBox.critical(None, "Error", f"Failed to add files: {message}")
+        self.save_status()
+
+    def end_import(self):
+        """Apply the table edits deferred during a background import and refresh the views."""
+        self.import_job = None
+        self.set_import_locked(False)
+        deferred_metadata, self.deferred_metadata = self.deferred_metadata, []
+        try:
+            for row, filename, metadata in deferred_metadata:
+                self.write_metadata(filename, metadata)
+        except Exception as e:
+            QMessageBox.critical(None, "Error", f"Failed to update metadata in temp file: {e}")
+        self.peak_fits_model.update_data()
+        self.update_file_count()
+
+    def show_import_failures(self, report):
+        """Show a warning listing the files of an import report that could not be imported."""
+        failed = [f"{entry['name']}: {entry['message']}" for entry in report
+                  if entry['status'] in (IMPORT_FAILED, IMPORT_CONFLICT)]
+        if failed:
+            msg_box = QMessageBox()
+            msg_box.setIcon(QMessageBox.Warning)
+            msg_box.setWindowTitle("Import Errors")
+            msg_box.setText(f"{len(failed)} of {len(report)} file(s) could not be imported.")
+            msg_box.setDetailedText("\n".join(failed))
+            msg_box.exec()
+
+    def watch_folder_toggled(self, checked):
+        """Handle the watch folder button toggle."""
+        if checked:
+            self.start_watch_folder()
+        else:
+            self.stop_watch_folder()
+            self.last_action('Stopped watching folder')
+
+    def start_watch_folder(self):
+        """Prompt for a folder and start importing the .DAT files written to it."""
+        pressure = self.ui.comboBox_pressure.currentText()
+        crystal_name = self.ui.comboBox_crystal.currentText()
+        folder = None
+        if self.project and pressure and crystal_name:
+            folder = QFileDialog.getExistingDirectory(None, "Select Folder to Watch")
+        if not folder:
+            self.stop_watch_folder()
+            return
+
+        try:
+            self.project.start_watch_folder(folder)
+        except ValueError as e:
+            QMessageBox.critical(None, "Error", f"Failed to watch folder: {e}")
+            self.stop_watch_folder()
+            return
+        self.watch_timer.start()
+        self.last_action(f'Watching {folder}')
+
+    def stop_watch_folder(self):
+        """Stop the watch mode and release the watch folder button."""
+        self.watch_timer.stop()
+        if self.project:
+            self.project.stop_watch_folder()
+        self.ui.pushButton_watchFolder.blockSignals(True)
+        self.ui.pushButton_watchFolder.setChecked(False)
+        self.ui.pushButton_watchFolder.blockSignals(False)
+
+    def poll_watch_folder(self):
+        """Import the completely written files of the watched folder with the current pressure and crystal."""
+        if self.project is None or not self.project.is_watching_folder() or self.import_job is not None:
+            return
+        pressure = self.ui.comboBox_pressure.currentText()
+        crystal_name = self.ui.comboBox_crystal.currentText()
+        if not (pressure and crystal_name):
+            return
+
+        try:
+            report = self.project.poll_watch_folder(float(pressure), crystal_name)
+        except Exception as e:
+            self.stop_watch_folder()
+            QMessageBox.critical(None, "Error", f"Failed to add files from the watched folder: {e}")
+            return
+        if not report:
+            return
+
+        # Only the new rows are appended; the rest of the table is left untouched
+        self.add_imported_files_to_table(report, self.ui.comboBox_calibration.currentText())
+        imported = sum(entry['status'] == IMPORT_IMPORTED for entry in report)
+        failed = [entry['name'] for entry in report if entry['status'] in (IMPORT_FAILED, IMPORT_CONFLICT)]
+        message = f'Added {imported} file(s) from watched folder'
+        if failed:
+            message += f", failed: {', '.join(failed)}"
+        self.last_action(message)
+        self.save_status()
+
+    def live_feed_toggled(self, checked):
+        """Handle the live feed button toggle."""
+        if checked:
+            self.start_feed()
+        else:
+            self.stop_feed()
+            self.last_action('Live feed stopped')
+
+    def start_feed(self):
+        """Ask for a port and start receiving spectra pushed by the acquisition PC."""
+        pressure = self.ui.comboBox_pressure.currentText()
+        crystal_name = self.ui.comboBox_crystal.currentText()
+        port, ok = None, False
+        if self.project and pressure and crystal_name:
+            port, ok = QInputDialog.getInt(None, "Live Feed", "Local port to listen on:", DEFAULT_FEED_PORT, 1, 65535)
+        if not ok:
+            self.stop_feed()
+            return
+
+        try:
+            self.project.start_feed(('127.0.0.1', port))
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(None, "Error", f"Failed to start the live feed: {e}")
+            self.stop_feed()
+            return
+        self.feed_timer.start()
+        self.last_action(f'Live feed listening on port {port}')
+
+    def stop_feed(self):
+        """Stop the live feed and release the live feed button."""
+        self.feed_timer.stop()
+        if self.project:
+            self.project.stop_feed()
+        self.ui.pushButton_liveFeed.blockSignals(True)
+        self.ui.pushButton_liveFeed.setChecked(False)
+        self.ui.pushButton_liveFeed.blockSignals(False)
+
+    def poll_autosave(self):
+        """Autosave the working copy of a project held in memory when its autosave interval has elapsed."""
+        if self.project is None or self.import_job is not None:
+            return
+        try:
+            self.project.poll_autosave()
+        except OSError as e:
+            self.last_action(f'Autosave failed: {e}')
+
+    def poll_feed(self):
+        """Write the spectra received from the live feed with the current pressure and crystal."""
+        if self.project is None or self.project.feed is None or self.import_job is not None:
+            return
+        pressure = self.ui.comboBox_pressure.currentText()
+        crystal_name = self.ui.comboBox_crystal.currentText()
+        if not (pressure and crystal_name):
+            return
+
+        try:
+            report = self.project.poll_feed(float(pressure), crystal_name, self.FEED_SPECTRA_PER_POLL)
+        except Exception as e:
+            self.stop_feed()
+            QMessageBox.critical(None, "Error", f"Failed to add spectra from the live feed: {e}")
+            return
+        if not report:
+            return
+
+        self.add_imported_files_to_table(report, self.ui.comboBox_calibration.currentText())
+        shown_at = time.time()
+        imported = [entry for entry in report if entry['status'] == IMPORT_IMPORTED]
+        message = f'Live feed: added {len(imported)} spectra'
+        if imported:
+            latency = max(shown_at - entry['sent_at'] for entry in imported)
+            message += f', latency {latency * 1000:.0f} ms'
+        failed = [entry['name'] for entry in report if entry['status'] in (IMPORT_FAILED, IMPORT_CONFLICT)]
+        if failed:
+            message += f", failed: {', '.join(failed)}"
+        self.last_action(message)
+        # Comparing the whole project with the saved file on every tick would dominate the feed latency
+        self.ui.label_projectStatus.setText("| Unsaved Changes")
 
     def remove_files_clicked(self):
         """Handle the remove files button click."""
@@ -751,6 +1172,5 @@ class ProjectManager:
                         'polarization': self.file_model.data(self.file_model.index(row, 5), Qt.DisplayRole),
                         'scans': self.file_model.data(self.file_model.index(row, 6), Qt.DisplayRole)
                     }
-                    for key, value in metadata.items():
-                        if value is not None:
-                            self.project.add_metadata_to_dataset(filename, key, value)
+                    self.project.set_dataset_metadata(
+                        filename, {key: value for key, value in metadata.items() if value is not None})
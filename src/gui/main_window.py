@@ -960,6 +960,18 @@ class Ui_MainWindow(object):
 
         self.horizontalLayout_9.addWidget(self.pushButton_removeFiles)
 
+        self.pushButton_watchFolder = QPushButton(self.frame_filesBrowserToolbar)
+        self.pushButton_watchFolder.setObjectName(u"pushButton_watchFolder")
+        self.pushButton_watchFolder.setCheckable(True)
+
+        self.horizontalLayout_9.addWidget(self.pushButton_watchFolder)
+
+        self.pushButton_liveFeed = QPushButton(self.frame_filesBrowserToolbar)
+        self.pushButton_liveFeed.setObjectName(u"pushButton_liveFeed")
+        self.pushButton_liveFeed.setCheckable(True)
+
+        self.horizontalLayout_9.addWidget(self.pushButton_liveFeed)
+
         self.horizontalSpacer_18 = QSpacerItem(40, 20, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
 
         self.horizontalLayout_9.addItem(self.horizontalSpacer_18)
@@ -1190,6 +1202,8 @@ class Ui_MainWindow(object):
         self.label_8.setText(QCoreApplication.translate("MainWindow", u"Calibration:", None))
         self.pushButton_addFiles.setText(QCoreApplication.translate("MainWindow", u"Add files", None))
         self.pushButton_removeFiles.setText(QCoreApplication.translate("MainWindow", u"Remove files", None))
+        self.pushButton_watchFolder.setText(QCoreApplication.translate("MainWindow", u"Watch folder", None))
+        self.pushButton_liveFeed.setText(QCoreApplication.translate("MainWindow", u"Live feed", None))
         self.pushButton_peakfitNewFit.setText(QCoreApplication.translate("MainWindow", u"New peak", None))
         self.pushButton_peakfitRemoveFit.setText(QCoreApplication.translate("MainWindow", u"Remove peak", None))
         self.tabWidget_sideBar.setTabText(self.tabWidget_sideBar.indexOf(self.tab), QCoreApplication.translate("MainWindow", u"Main", None))
@@ -0,0 +1,194 @@
+# archive_reader.py
+import os
+import tarfile
+import threading
+import zipfile
+import zlib
+
+from .dat_parser import parse_dat_bytes
+
+
+# Extensions of the archives that can be imported directly
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Bytes of the members of a compressed tar archive kept while it is listed, so that archives up to this size are
+# decompressed once; larger ones are streamed again as the import reads them
+TAR_BUFFER_BYTES = 128 << 20
+
+# Errors raised by the zip, tar and decompression modules for damaged archives
+_ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, OSError)
+
+
+def is_archive(path):
+    """Returns True if the path has the extension of a zip or tar (optionally compressed) archive."""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class ArchiveReader:
+    """
+    Reads the .DAT members of a zip or tar archive without extracting them to disk.
+
+    Iterating over the reader yields one path per member, made of the archive path followed by the member
+    name (e.g. 'run.zip/run/scan_001.DAT'), and read() parses the member with such a path. The two are meant
+    to be used as the file paths and the read function of the bulk import pipeline:
+
+    - zip members are compressed individually, so read() can be called from several threads at once; each
+      thread decompresses through its own handle on the archive.
+    - uncompressed tar archives are listed from the member headers alone, skipping the data, and read() reads
+      each member at its offset; reads are serialized but cost no decompression.
+    - compressed tar archives (gzip, bzip2 or xz) are a single stream that can only be read in order. Listing
+      them keeps the bytes of the members read on the way, up to TAR_BUFFER_BYTES, until read() parses them, so
+      the archive is decompressed once. Larger archives are streamed again while iterating, keeping the bytes
+      of each member until read() parses it; the number of members then held in memory is bounded by how far
+      iteration runs ahead of read().
+
+    Damaged archives and members make read() raise ValueError, like an invalid loose file. If a tar stream
+    breaks while iterating, the archive path itself is yielded last and reading it raises the error.
+    """
+
+    def __init__(self, archive_path, extensions=('.dat',)):
+        """
+        Parameters:
+            archive_path (str): The path of the zip or tar archive.
+            extensions (tuple of str): Case-insensitive extensions of the members to read.
+
+        Raises:
+            ValueError: If the file is not a zip or tar archive.
+        """
+        self.archive_path = archive_path
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._zip_files = []  # Per-thread zip handles, closed by close()
+        self._contents = {}  # Member path -> bytes of tar members streamed but not read yet
+        self._tar_file = None  # Open uncompressed tar archive, whose members are read at their offset
+        self._tar_members = {}  # Member path -> TarInfo of the members of an uncompressed tar archive
+        self._buffered = False  # Whether listing a compressed tar archive kept the bytes of all its members
+        self._error = None  # Error that interrupted streaming a tar archive
+
+        try:
+            if zipfile.is_zipfile(archive_path):
+                self.kind = 'zip'
+                with zipfile.ZipFile(archive_path) as zip_file:
+                    # The member list comes from the central directory and costs no decompression
+                    self._members = [info.filename for info in zip_file.infolist()
+                                     if not info.is_dir() and self._is_wanted(info.filename)]
+            elif tarfile.is_tarfile(archive_path):
+                self.kind = 'tar'
+                self._list_tar()
+            else:
+                raise ValueError(f"{archive_path} is not a zip or tar archive.")
+        except _ARCHIVE_ERRORS as e:
+            raise ValueError(f"{os.path.basename(archive_path)} could not be read: {e}")
+
+    def _list_tar(self):
+        """Lists the members of a tar archive, keeping the bytes of those of a compressed archive that fit."""
+        try:
+            self._tar_file = tarfile.open(self.archive_path, 'r:')
+        except tarfile.ReadError:
+            pass  # Compressed
+        else:
+            # The headers are read by seeking from one to the next, without reading the data of the members
+            try:
+                members = self._tar_file.getmembers()
+            except _ARCHIVE_ERRORS:
+                self._tar_file.close()
+                raise
+            self._tar_members = {self._member_path(member.name): member for member in members
+                                 if member.isfile() and self._is_wanted(member.name)}
+            self._members = [self._member_name(member_path) for member_path in self._tar_members]
+            return
+
+        self._members = []
+        buffered_bytes = 0
+        self._buffered = True
+        with tarfile.open(self.archive_path, 'r|*') as tar_file:
+            for member in tar_file:
+                if not (member.isfile() and self._is_wanted(member.name)):
+                    continue
+                self._members.append(member.name)
+                buffered_bytes += member.size
+                if self._buffered and buffered_bytes <= TAR_BUFFER_BYTES:
+                    self._contents[self._member_path(member.name)] = tar_file.extractfile(member).read()
+                elif self._buffered:
+                    self._buffered = False  # Streamed again while iterating
+                    self._contents.clear()
+
+    def _is_wanted(self, member_name):
+        return member_name.lower().endswith(self.extensions)
+
+    def _member_path(self, member_name):
+        return os.path.join(self.archive_path, member_name)
+
+    def _member_name(self, member_path):
+        return member_path[len(self.archive_path) + 1:]
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        if self.kind == 'zip' or self._tar_file is not None or self._buffered:
+            for member_name in self._members:
+                yield self._member_path(member_name)
+            return
+
+        try:
+            with tarfile.open(self.archive_path, 'r|*') as tar_file:
+                for member in tar_file:
+                    if member.isfile() and self._is_wanted(member.name):
+                        member_path = self._member_path(member.name)
+                        self._contents[member_path] = tar_file.extractfile(member).read()
+                        yield member_path
+        except _ARCHIVE_ERRORS as e:
+            self._error = ValueError(f"{os.path.basename(self.archive_path)} could not be read: {e}")
+            yield self.archive_path
+
+    def read(self, member_path):
+        """
+        Reads and parses a member, given a path yielded by iterating over the reader.
+
+        Returns:
+            DatFile: The parsed member, named after the basename of the member.
+        """
+        if member_path == self.archive_path and self._error is not None:
+            raise self._error
+        if self.kind == 'zip':
+            try:
+                zip_file = getattr(self._local, 'zip_file', None)
+                if zip_file is None:
+                    zip_file = zipfile.ZipFile(self.archive_path)
+                    self._local.zip_file = zip_file
+                    with self._lock:
+                        self._zip_files.append(zip_file)
+                raw_content = zip_file.read(self._member_name(member_path))
+            except _ARCHIVE_ERRORS as e:
+                raise ValueError(f"{os.path.basename(member_path)} could not be read: {e}")
+        elif self._tar_file is not None:
+            try:
+                with self._lock:
+                    raw_content = self._tar_file.extractfile(self._tar_members[member_path]).read()
+            except _ARCHIVE_ERRORS as e:
+                raise ValueError(f"{os.path.basename(member_path)} could not be read: {e}")
+        else:
+            raw_content = self._contents.pop(member_path)
+        return parse_dat_bytes(raw_content, os.path.basename(member_path))
+
+    def discard(self, member_path):
+        """Drops the bytes of a streamed tar member that will not be read, e.g. because the import was cancelled."""
+        self._contents.pop(member_path, None)
+
+    def close(self):
+        """Closes the archive handles opened by read() and the uncompressed tar archive."""
+        with self._lock:
+            for zip_file in self._zip_files:
+                zip_file.close()
+            self._zip_files = []
+            if self._tar_file is not None:
+                self._tar_file.close()
+        self._contents.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,203 @@
+# dat_parser.py
+import hashlib
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+
+HEADER_LINES = 12  # Number of header lines preceding the channel counts in a .DAT file
+
+# Bytes that may appear in the body of a well-formed .DAT file (digits and line endings only)
+_WELL_FORMED_BYTES = b'0123456789\r\n'
+
+# Header keys (after normalization) holding the number of scans and the acquisition time, in order of preference
+SCANS_KEYS = ('scans', 'number_of_scans', 'no_of_scans', 'num_scans', 'n_scans', 'scan_count')
+ACQUISITION_TIME_KEYS = ('acquisition_time', 'date_time', 'datetime', 'timestamp', 'start_time')
+
+# Date and time layouts recognized in header values; matching values are stored as ISO 8601 strings
+_DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y/%m/%d %H:%M:%S', '%d.%m.%Y %H:%M:%S',
+                     '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%a %b %d %H:%M:%S %Y', '%Y-%m-%d', '%m/%d/%Y',
+                     '%d.%m.%Y')
+
+# A header line of the form "key: value", "key = value" or "key<TAB>value"
+_HEADER_FIELD = re.compile(r'^\s*([A-Za-z][^:=\t]*?)\s*(?::|=|\t)\s*(.*?)\s*$')
+
+
+class DatFile:
+    """
+    The contents of a single .DAT spectrum, read in one pass.
+
+    Attributes:
+        name (str): The file name (basename) used as the dataset name in the project.
+        raw_content (bytes): The unmodified bytes of the file.
+        header (list of str): The header lines, stripped of surrounding whitespace.
+        counts (numpy.ndarray): The channel counts as a 1-D int64 array.
+        content_hash (str): The SHA-256 hex digest of raw_content, identifying the payload.
+        metadata (dict): The typed "key: value" fields of the header, see parse_header().
+    """
+
+    __slots__ = ('name', 'raw_content', 'header', 'counts', 'content_hash', 'metadata')
+
+    def __init__(self, name, raw_content, header, counts, content_hash=None, metadata=None):
+        self.name = name
+        self.raw_content = raw_content
+        self.header = header
+        self.counts = counts
+        self.content_hash = content_hash if content_hash is not None else hash_content(raw_content)
+        self.metadata = metadata if metadata is not None else parse_header(header)
+
+    @property
+    def scans(self):
+        """The number of scans recorded in the header, or None if the header does not give it."""
+        for key in SCANS_KEYS:
+            value = self.metadata.get(key)
+            if isinstance(value, (int, float)):
+                return value
+        return None
+
+    @property
+    def acquisition_time(self):
+        """The acquisition time recorded in the header as an ISO 8601 string, or None if it is not given."""
+        for key in ACQUISITION_TIME_KEYS:
+            value = self.metadata.get(key)
+            if value is not None:
+                return str(value)
+        # Date and time given on separate lines
+        if 'date' in self.metadata and 'time' in self.metadata:
+            combined = _convert_header_value(f"{self.metadata['date']} {self.metadata['time']}")
+            return str(combined)
+        if 'date' in self.metadata:
+            return str(self.metadata['date'])
+        return None
+
+    def __repr__(self):
+        return f"DatFile(name={self.name!r}, channels={len(self.counts)})"
+
+
+def hash_content(raw_content):
+    """
+    Returns the SHA-256 hex digest identifying the raw bytes of a .DAT file.
+    """
+    return hashlib.sha256(raw_content).hexdigest()
+
+
+def _normalize_header_key(key):
+    """Normalizes a header key to lower snake case, dropping units in brackets, e.g. 'No. of Scans' -> 'no_of_scans'."""
+    key = re.sub(r'[\(\[].*?[\)\]]', '', key)
+    return re.sub(r'[^a-z0-9]+', '_', key.lower()).strip('_')
+
+
+def _convert_header_value(text):
+    """Converts a header value to an int, a float, an ISO 8601 date/time string, or leaves it as a string."""
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    for datetime_format in _DATETIME_FORMATS:
+        try:
+            value = datetime.strptime(text, datetime_format)
+        except ValueError:
+            continue
+        return value.date().isoformat() if '%H' not in datetime_format and '%I' not in datetime_format \
+            else value.isoformat()
+    return text
+
+
+def parse_header(header):
+    """
+    Extracts the "key: value" (or "key = value", or tab separated) fields of the header lines of a .DAT file.
+
+    Keys are normalized to lower snake case and values are converted to int, float or ISO 8601 date/time
+    strings where possible. Lines that are not key/value pairs are ignored; the first occurrence of a key wins.
+
+    Parameters:
+        header (list of str): The decoded header lines.
+
+    Returns:
+        dict: The typed header fields.
+    """
+    metadata = {}
+    for line in header:
+        match = _HEADER_FIELD.match(line)
+        if match is None or not match.group(2):
+            continue
+        key = _normalize_header_key(match.group(1))
+        if key and key not in metadata:
+            metadata[key] = _convert_header_value(match.group(2))
+    return metadata
+
+
+def split_header(raw_content, header_lines=HEADER_LINES):
+    """
+    Splits the raw bytes of a .DAT file into its header lines and the remaining body.
+
+    Parameters:
+        raw_content (bytes): The raw bytes of the file.
+        header_lines (int): The number of header lines to split off.
+
+    Returns:
+        tuple: (list of bytes header lines, bytes body). The body is empty if the file is shorter than the header.
+    """
+    parts = raw_content.split(b'\n', header_lines)
+    if len(parts) <= header_lines:
+        return parts, b''
+    return parts[:header_lines], parts[header_lines]
+
+
+def decode_counts(body):
+    """
+    Decodes the channel counts (one non-negative integer per line) from the body of a .DAT file.
+
+    Well-formed bodies are decoded with a single NumPy call. Bodies containing anything other than
+    digits and line endings fall back to the line-by-line rules used historically: lines that are
+    not purely digits after stripping are skipped.
+
+    Parameters:
+        body (bytes): The body of the file following the header.
+
+    Returns:
+        numpy.ndarray: The channel counts as a 1-D int64 array.
+    """
+    if not body.translate(None, _WELL_FORMED_BYTES):
+        if not body.strip():
+            return np.array([], dtype=np.int64)
+        # Fast path: one integer per line, decoded in C
+        return np.fromstring(body, dtype=np.int64, sep=' ')
+
+    lines = body.decode('ascii', errors='replace').splitlines()
+    return np.array([int(line.strip()) for line in lines if line.strip().isdigit()], dtype=np.int64)
+
+
+def parse_dat_bytes(raw_content, name='', header_lines=HEADER_LINES):
+    """
+    Parses the raw bytes of a .DAT file.
+
+    Parameters:
+        raw_content (bytes): The raw bytes of the file.
+        name (str): The name to give the parsed file.
+        header_lines (int): The number of header lines preceding the channel counts.
+
+    Returns:
+        DatFile: The parsed file.
+    """
+    header, body = split_header(raw_content, header_lines)
+    header = [line.decode('latin-1').strip() for line in header]
+    return DatFile(name, raw_content, header, decode_counts(body))
+
+
+def read_dat_file(file_path, header_lines=HEADER_LINES):
+    """
+    Reads a .DAT file into memory with a single read and parses it.
+
+    Parameters:
+        file_path (str): The path to the .DAT file.
+        header_lines (int): The number of header lines preceding the channel counts.
+
+    Returns:
+        DatFile: The parsed file, named after the basename of the path.
+    """
+    with open(file_path, 'rb') as file:
+        raw_content = file.read()
+    return parse_dat_bytes(raw_content, os.path.basename(file_path), header_lines)
@@ -0,0 +1,356 @@
+# fit_results.py
+import heapq
+
+import h5py
+import numpy as np
+
+from .h5_storage import make_resizable
+
+FIT_RESULTS_GROUP = 'fit_results'  # Group holding the peak fit results of the files of the 'data' group
+
+# The fields stored for each file and velocity, in the order of the last axis of the values dataset
+PEAK_FIT_FIELDS = ('left_center_mps', 'right_center_mps', 'offset_mps',
+                   'left_center_ch', 'right_center_ch', 'offset_ch',
+                   'left_goodness_of_fit', 'left_amplitude', 'left_sigma',
+                   'left_gamma', 'left_fwhm', 'left_area',
+                   'right_goodness_of_fit', 'right_amplitude', 'right_sigma',
+                   'right_gamma', 'right_fwhm', 'right_area')
+
+_GROW_ROWS = 256  # File rows added at once when all are used; freed rows are reused before growing again
+_CHUNKS = (128, 4, len(PEAK_FIT_FIELDS))  # About 72 KB: whole results of 128 files for 4 velocities
+
+
+def legacy_fit_results(attrs):
+    """
+    Returns the fit results stored as attributes of a 'velocities/<name>' group by projects written before the
+    array existed, ignoring values that are NaN or not numbers. Attributes that are not fields are not read,
+    see unknown_fit_fields().
+
+    Parameters:
+        attrs (h5py.AttributeManager): The attributes of the velocity group.
+
+    Returns:
+        dict: field -> float, for the fields holding a result.
+    """
+    results = {}
+    for key in PEAK_FIT_FIELDS:
+        try:
+            value = float(attrs.get(key, np.nan))
+        except (TypeError, ValueError):
+            continue
+        if not np.isnan(value):
+            results[key] = value
+    return results
+
+
+def unknown_fit_fields(attrs):
+    """Returns the attributes of a 'velocities/<name>' group that are not fields, sorted, e.g. to keep them."""
+    return sorted(key for key in attrs if key not in PEAK_FIT_FIELDS)
+
+
+class FitResults:
+    """
+    The peak fit results of the files of the 'data' group, stored as a single [file, velocity, field] float64
+    dataset instead of a group with one attribute per field for every file and velocity.
+
+    The group holds three datasets:
+
+    - 'values': the results, NaN where no fit was stored. The fill value of the dataset is NaN, so the rows
+      and columns added by resizing cost no writes, and adding a velocity is a single resize.
+    - 'files': the file of each row, empty for rows that are free. Files get a row when a result is first
+      stored for them.
+    - 'velocities': the velocity of each column, empty for columns that are free.
+
+    Both name indices are loaded into memory when the object is created. Rows and columns freed by
+    remove_file() and remove_velocity() are reused before the dataset grows.
+
+    Attributes:
+        h5file (h5py.File): The project file the results are stored in.
+    """
+
+    def __init__(self, h5file):
+        """
+        Parameters:
+            h5file (h5py.File): The open project file.
+        """
+        self.h5file = h5file
+        self._rows = {}  # file -> row index
+        self._free_rows = []  # Heap of the indices of unused rows, so the lowest is reused first
+        self._columns = {}  # velocity -> column index
+        self._free_columns = []  # Heap of the indices of unused columns
+        self._datasets = None  # Open (values, files, velocities) datasets, kept so their chunk cache is reused
+
+        group = h5file.get(FIT_RESULTS_GROUP)
+        if group is not None:
+            # Datasets copied without their unlimited dimensions or fill value, e.g. by a save, are recreated
+            make_resizable(group, 'values', _CHUNKS, maxshape=(None, None, len(PEAK_FIT_FIELDS)),
+                           fillvalue=np.nan)
+            make_resizable(group, 'files', (_GROW_ROWS,))
+            make_resizable(group, 'velocities', (16,))
+            _, files, velocities = self._open()
+            for row, name in enumerate(files.asstr()[()]):
+                if name:
+                    self._rows[name] = row
+                else:
+                    self._free_rows.append(row)
+            for column, name in enumerate(velocities.asstr()[()]):
+                if name:
+                    self._columns[name] = column
+                else:
+                    self._free_columns.append(column)
+
+    def __contains__(self, file_name):
+        return file_name in self._rows
+
+    def velocities(self):
+        """Returns the velocities with a column, in column order."""
+        return sorted(self._columns, key=self._columns.get)
+
+    def _open(self):
+        """Returns the (values, files, velocities) datasets, creating them if needed and opening them once."""
+        if self._datasets is None:
+            group = self.h5file.get(FIT_RESULTS_GROUP)
+            if group is None:
+                group = self.h5file.create_group(FIT_RESULTS_GROUP)
+                group.create_dataset('values', shape=(0, 0, len(PEAK_FIT_FIELDS)),
+                                     maxshape=(None, None, len(PEAK_FIT_FIELDS)), dtype=np.float64,
+                                     chunks=_CHUNKS, fillvalue=np.nan)
+                group.create_dataset('files', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                     chunks=(_GROW_ROWS,))
+                group.create_dataset('velocities', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                     chunks=(16,))
+            self._datasets = (group['values'], group['files'], group['velocities'])
+        return self._datasets
+
+    def add_velocity(self, velocity):
+        """Adds a column of NaN for a velocity, unless it has one. Does not flush."""
+        if velocity in self._columns:
+            return
+        values, _, velocities = self._open()
+        if self._free_columns:
+            column = heapq.heappop(self._free_columns)
+        else:
+            column = velocities.shape[0]
+            velocities.resize((column + 1,))
+            values.resize((values.shape[0], column + 1, len(PEAK_FIT_FIELDS)))
+        velocities[column] = velocity
+        self._columns[velocity] = column
+
+    def remove_velocity(self, velocity):
+        """Clears and frees the column of a velocity, if it has one. Does not flush."""
+        column = self._columns.pop(velocity, None)
+        if column is None:
+            return
+        values, _, velocities = self._open()
+        velocities[column] = ''
+        if values.shape[0]:
+            values[:, column, :] = np.nan
+        heapq.heappush(self._free_columns, column)
+
+    def rename_velocity(self, old_velocity, new_velocity):
+        """
+        Renames the column of a velocity, keeping its results. Does not flush.
+
+        Raises:
+            ValueError: If the new velocity already has a column.
+        """
+        column = self._columns.get(old_velocity)
+        if column is None or old_velocity == new_velocity:
+            return
+        if new_velocity in self._columns:
+            raise ValueError(f"Velocity {new_velocity} already exists.")
+        self._open()[2][column] = new_velocity
+        self._columns[new_velocity] = self._columns.pop(old_velocity)
+
+    def remove_file(self, file_name):
+        """Clears and frees the row of a file, if it has one. Does not flush."""
+        row = self._rows.pop(file_name, None)
+        if row is None:
+            return
+        values, files, _ = self._open()
+        files[row] = ''
+        values[row] = np.nan
+        heapq.heappush(self._free_rows, row)
+
+    def _row(self, file_name):
+        """Returns the row of a file, giving it a free row if it has none."""
+        row = self._rows.get(file_name)
+        if row is None:
+            values, files, _ = self._open()
+            if not self._free_rows:
+                rows = files.shape[0]
+                files.resize((rows + _GROW_ROWS,))
+                values.resize((rows + _GROW_ROWS, values.shape[1], len(PEAK_FIT_FIELDS)))
+                self._free_rows.extend(range(rows, rows + _GROW_ROWS))
+            row = heapq.heappop(self._free_rows)
+            files[row] = file_name
+            self._rows[file_name] = row
+        return row
+
+    def set(self, file_name, velocity, results):
+        """
+        Stores fit results of a file for a velocity, adding the velocity if it has no column. Fields not given
+        keep their value, and None clears a field. Does not flush.
+
+        Parameters:
+            file_name (str): The name of the file.
+            velocity (str): The name of the velocity.
+            results (dict): Field -> number, with fields from PEAK_FIT_FIELDS.
+
+        Raises:
+            ValueError: If a field is unknown or a value is not a number.
+        """
+        updates = self._field_updates(results)
+        if not updates:
+            return
+        self.add_velocity(velocity)
+        row, column = self._row(file_name), self._columns[velocity]
+        values = self._open()[0]
+        current = values[row, column]
+        for index, value in updates.items():
+            current[index] = value
+        values[row, column] = current
+
+    @staticmethod
+    def _field_updates(results):
+        """Returns the field index -> float of fit results, raising ValueError for unknown fields or values."""
+        updates = {}
+        for field, value in results.items():
+            if field not in PEAK_FIT_FIELDS:
+                raise ValueError(f"Unknown peak fit field '{field}'.")
+            try:
+                updates[PEAK_FIT_FIELDS.index(field)] = np.nan if value is None else float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"The {field} must be a number, got {value!r}.")
+        return updates
+
+    def update_many(self, results):
+        """
+        Stores fit results of several files and velocities like set(), reading and writing the span of the rows
+        changed once per velocity. Does not flush.
+
+        Parameters:
+            results (dict): (file_name, velocity) -> dict field -> number, as for set().
+
+        Raises:
+            ValueError: If a field is unknown or a value is not a number. No result is stored in that case.
+        """
+        by_velocity = {}  # velocity -> file -> field index -> value
+        for (file_name, velocity), fields in results.items():
+            updates = self._field_updates(fields)
+            if updates:
+                by_velocity.setdefault(velocity, {}).setdefault(file_name, {}).update(updates)
+
+        for velocity, files in by_velocity.items():
+            self.add_velocity(velocity)
+            rows = {file_name: self._row(file_name) for file_name in files}
+            column = self._columns[velocity]
+            values = self._open()[0]
+            first, last = min(rows.values()), max(rows.values()) + 1
+            block = values[first:last, column, :]
+            for file_name, updates in files.items():
+                for index, value in updates.items():
+                    block[rows[file_name] - first, index] = value
+            values[first:last, column, :] = block
+
+    def set_many(self, file_names, velocity, values):
+        """
+        Replaces the fit results of several files for a velocity, adding the velocity if it has no column.
+        The rows are written with a single selection. Does not flush.
+
+        Parameters:
+            file_names (list of str): The names of the files, without repetitions.
+            velocity (str): The name of the velocity.
+            values (array-like): A [len(file_names), len(PEAK_FIT_FIELDS)] array, NaN for fields without a result.
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(len(file_names), len(PEAK_FIT_FIELDS))
+        if not file_names:
+            return
+        self.add_velocity(velocity)
+        dataset, files, _ = self._open()
+        new_names = [name for name in file_names if name not in self._rows]
+        while len(self._free_rows) < len(new_names):
+            rows = files.shape[0]
+            files.resize((rows + _GROW_ROWS,))
+            dataset.resize((rows + _GROW_ROWS, dataset.shape[1], len(PEAK_FIT_FIELDS)))
+            self._free_rows.extend(range(rows, rows + _GROW_ROWS))
+        for name in new_names:
+            self._rows[name] = heapq.heappop(self._free_rows)
+
+        rows = np.array([self._rows[name] for name in file_names], dtype=np.int64)
+        first, last = int(rows.min()), int(rows.max()) + 1
+        if new_names:
+            names = files.asstr()[first:last].astype(object)
+            for name in new_names:
+                names[self._rows[name] - first] = name
+            files[first:last] = names
+        column = self._columns[velocity]
+        block = dataset[first:last, column, :]
+        block[rows - first] = values
+        dataset[first:last, column, :] = block
+
+    def get(self, file_name, velocity):
+        """
+        Returns the fit results of a file for a velocity as a dict field -> float, NaN for fields not stored.
+
+        Raises:
+            KeyError: If the velocity has no column.
+        """
+        column = self._columns[velocity]
+        row = self._rows.get(file_name)
+        current = self._open()[0][row, column] if row is not None else np.full(len(PEAK_FIT_FIELDS), np.nan)
+        return dict(zip(PEAK_FIT_FIELDS, current.tolist()))
+
+    def file_results(self, file_name, velocities):
+        """
+        Reads the results of a file for several velocities with a single selection.
+
+        Returns:
+            numpy.ndarray: A [len(velocities), len(PEAK_FIT_FIELDS)] float64 array, NaN where nothing is stored.
+
+        Raises:
+            KeyError: If a velocity has no column.
+        """
+        columns = [self._columns[velocity] for velocity in velocities]
+        row = self._rows.get(file_name)
+        if row is None or not columns:
+            return np.full((len(columns), len(PEAK_FIT_FIELDS)), np.nan)
+        return self._open()[0][row][columns]
+
+    def stored_results(self, velocity):
+        """
+        Reads the results of all the files holding one for a velocity, e.g. before the velocity is removed.
+
+        Returns:
+            tuple: (file_names, values) where values is a [len(file_names), len(PEAK_FIT_FIELDS)] float64 array.
+
+        Raises:
+            KeyError: If the velocity has no column.
+        """
+        column = self._columns[velocity]
+        if not self._rows:
+            return [], np.empty((0, len(PEAK_FIT_FIELDS)))
+        stored = self._open()[0][:, column, :]
+        names = sorted(self._rows, key=self._rows.get)
+        rows = np.array([self._rows[name] for name in names], dtype=np.int64)
+        keep = ~np.isnan(stored[rows]).all(axis=1)
+        return [name for name, kept in zip(names, keep) if kept], stored[rows[keep]]
+
+    def velocity_results(self, velocity, file_names):
+        """
+        Reads the results of several files for a velocity with a single selection.
+
+        Returns:
+            numpy.ndarray: A [len(file_names), len(PEAK_FIT_FIELDS)] float64 array in the order of file_names,
+                           NaN where nothing is stored.
+
+        Raises:
+            KeyError: If the velocity has no column.
+        """
+        column = self._columns[velocity]
+        result = np.full((len(file_names), len(PEAK_FIT_FIELDS)), np.nan)
+        positions = [position for position, name in enumerate(file_names) if name in self._rows]
+        if positions:
+            stored = self._open()[0][:, column, :]
+            result[positions] = stored[[self._rows[file_names[position]] for position in positions]]
+        return result
@@ -0,0 +1,88 @@
+# folder_watcher.py
+import os
+import time
+
+
+class FolderWatcher:
+    """
+    Detects new files in a directory once they have been completely written.
+
+    The spectrometer software writes a .DAT file over several seconds, so a file is only reported when its
+    size and modification time have not changed for settle_time seconds. The watcher is polled rather than
+    driven by OS notifications, which keeps it portable and works on network shares.
+
+    Each file is reported once. A file that is rewritten after being reported (different size or
+    modification time) is reported again, which lets callers retry files that failed to import.
+    """
+
+    def __init__(self, folder, settle_time=2.0, extensions=('.dat',), include_existing=False):
+        """
+        Parameters:
+            folder (str): The directory to watch.
+            settle_time (float): Seconds a file must stay unchanged before it is considered complete.
+            extensions (tuple of str): Case-insensitive file extensions to watch.
+            include_existing (bool): Whether files already present when watching starts are reported.
+
+        Raises:
+            ValueError: If the folder does not exist.
+        """
+        if not os.path.isdir(folder):
+            raise ValueError(f"The folder '{folder}' does not exist.")
+        self.folder = folder
+        self.settle_time = settle_time
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self._pending = {}  # path -> (signature, time the signature was first seen)
+        self._handled = {}  # path -> signature when it was reported
+        if not include_existing:
+            self._handled = dict(self._scan())
+
+    def _scan(self):
+        """Yields (path, (size, mtime_ns)) for every watched file in the folder."""
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(self.extensions):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    # The file was removed between listing and stat
+                    continue
+                yield entry.path, (stat.st_size, stat.st_mtime_ns)
+
+    def poll(self, now=None):
+        """
+        Checks the folder and returns the files that became complete since the last poll.
+
+        Parameters:
+            now (float, optional): The current time.monotonic() value, for testing.
+
+        Returns:
+            list of str: The paths of the complete files, sorted by name.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        ready = []
+        seen = set()
+        for path, signature in self._scan():
+            seen.add(path)
+            if self._handled.get(path) == signature:
+                continue
+            pending = self._pending.get(path)
+            if pending is None or pending[0] != signature:
+                # New or still being written: restart the settle timer
+                self._pending[path] = (signature, now)
+            elif now - pending[1] >= self.settle_time and signature[0] > 0:
+                ready.append(path)
+
+        for path in ready:
+            self._handled[path] = self._pending.pop(path)[0]
+        # Forget files that were deleted so they are picked up again if recreated
+        for path in set(self._pending) - seen:
+            del self._pending[path]
+        for path in set(self._handled) - seen:
+            del self._handled[path]
+
+        return sorted(ready)
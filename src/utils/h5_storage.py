@@ -0,0 +1,289 @@
+# h5_storage.py
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+
+# Project-level options controlling how spectra and raw file contents are stored
+DEFAULT_STORAGE_OPTIONS = {
+    'compression': 'gzip',  # None, 'gzip' or 'lzf'
+    'compression_opts': 4,  # gzip level (0-9); ignored for other filters
+    'shuffle': True,  # Apply the byte shuffle filter before compression
+    'chunks': None,  # Chunk length in elements, or None to let h5py choose
+    'narrow_dtype': True,  # Store integer counts in the smallest integer dtype that fits
+    'spectra_layout': 'groups',  # 'groups' (counts linked from each file group), 'matrix' (one 2-D dataset)
+                                 # or 'shards' (one file per shard next to the project)
+    'shard_by': 'pressure',  # How the 'shards' layout splits the spectra: 'pressure' or 'day'
+}
+
+# File-space settings of project files: the free space is tracked across sessions, so that the space of objects
+# replaced or deleted in place (see BrillouinProject.save_project()) is reused when the file is written again
+PROJECT_FILE_SPACE = {'fs_strategy': 'fsm', 'fs_persist': True}
+
+# Options reproducing the layout used before storage options existed
+LEGACY_STORAGE_OPTIONS = {
+    'compression': None,
+    'compression_opts': None,
+    'shuffle': False,
+    'chunks': None,
+    'narrow_dtype': False,
+    'spectra_layout': 'groups',
+    'shard_by': 'pressure',
+}
+
+
+def validate_storage_options(options):
+    """
+    Completes a dictionary of storage options with the defaults and checks the values.
+
+    Parameters:
+        options (dict): Storage options, possibly partial.
+
+    Returns:
+        dict: The complete storage options.
+
+    Raises:
+        ValueError: If an option is unknown or has an invalid value.
+    """
+    unknown = set(options) - set(DEFAULT_STORAGE_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown storage option(s): {', '.join(sorted(unknown))}.")
+
+    options = {**DEFAULT_STORAGE_OPTIONS, **options}
+    if options['compression'] not in (None, 'gzip', 'lzf'):
+        raise ValueError(f"Unsupported compression '{options['compression']}'. Use None, 'gzip' or 'lzf'.")
+    if options['compression'] == 'gzip':
+        if options['compression_opts'] is None:
+            options['compression_opts'] = DEFAULT_STORAGE_OPTIONS['compression_opts']
+        if not 0 <= int(options['compression_opts']) <= 9:
+            raise ValueError("The gzip compression level must be between 0 and 9.")
+        options['compression_opts'] = int(options['compression_opts'])
+    else:
+        options['compression_opts'] = None
+    if options['chunks'] is not None:
+        if int(options['chunks']) < 1:
+            raise ValueError("The chunk length must be a positive number of elements.")
+        options['chunks'] = int(options['chunks'])
+    if options['spectra_layout'] not in ('groups', 'matrix', 'shards'):
+        raise ValueError(f"Unsupported spectra layout '{options['spectra_layout']}'. "
+                         f"Use 'groups', 'matrix' or 'shards'.")
+    if options['shard_by'] not in ('pressure', 'day'):
+        raise ValueError(f"Unsupported shard key '{options['shard_by']}'. Use 'pressure' or 'day'.")
+    options['shuffle'] = bool(options['shuffle'])
+    options['narrow_dtype'] = bool(options['narrow_dtype'])
+    return options
+
+
+def storage_options_to_attr(options):
+    """Serializes storage options for storage as an HDF5 attribute."""
+    return json.dumps(validate_storage_options(options), sort_keys=True)
+
+
+def storage_options_from_attr(value):
+    """Deserializes storage options stored with storage_options_to_attr()."""
+    return validate_storage_options(json.loads(value))
+
+
+def narrow_integer_dtype(array):
+    """
+    Returns the array converted to the smallest integer dtype able to hold all its values.
+
+    Non-integer and empty arrays are returned unchanged.
+    """
+    array = np.asarray(array)
+    if array.size == 0 or not np.issubdtype(array.dtype, np.integer):
+        return array
+    dtype = np.result_type(np.min_scalar_type(array.min()), np.min_scalar_type(array.max()))
+    return array.astype(dtype, copy=False)
+
+
+def create_array_dataset(group, name, data, options):
+    """
+    Creates a 1-D dataset applying the storage options (chunking, shuffle, compression and dtype narrowing).
+
+    Parameters:
+        group (h5py.Group): The group in which to create the dataset.
+        name (str): The name of the dataset.
+        data (array-like): The 1-D data to store.
+        options (dict): Complete storage options, see validate_storage_options().
+
+    Returns:
+        h5py.Dataset: The new dataset.
+    """
+    data = np.asarray(data)
+    if options['narrow_dtype']:
+        data = narrow_integer_dtype(data)
+
+    kwargs = {}
+    if options['compression'] is not None:
+        kwargs['compression'] = options['compression']
+        kwargs['compression_opts'] = options['compression_opts']
+    if options['shuffle']:
+        kwargs['shuffle'] = True
+    if kwargs or options['chunks'] is not None:
+        # Explicit chunks may not exceed the data length; let h5py choose for empty arrays
+        kwargs['chunks'] = (min(options['chunks'], len(data)),) if options['chunks'] and len(data) else True
+
+    return group.create_dataset(name, data=data, **kwargs)
+
+
+def create_bytes_dataset(group, name, raw_content, options):
+    """
+    Stores raw file bytes. With compression or shuffle enabled the bytes are stored as a compressible
+    1-D uint8 array, otherwise as a scalar byte string like projects written before storage options existed.
+    Read back with read_bytes_dataset().
+    """
+    if options['compression'] is None and not options['shuffle'] and options['chunks'] is None:
+        return group.create_dataset(name, data=raw_content)
+    return create_array_dataset(group, name, np.frombuffer(raw_content, dtype=np.uint8),
+                                {**options, 'narrow_dtype': False})
+
+
+def make_resizable(group, name, chunks, maxshape=None, fillvalue=None):
+    """
+    Recreates a dataset with unlimited dimensions if it was copied without them (e.g. by a save), keeping
+    its data, dtype and filters, so it can be resized again.
+
+    Parameters:
+        group (h5py.Group): The group holding the dataset.
+        name (str): The name of the dataset.
+        chunks (tuple): The chunk shape to use if the dataset is not chunked.
+        maxshape (tuple or None): The maximum shape, by default unlimited in every dimension.
+        fillvalue (float or None): The value that regions added by resizing must read as. The dataset is also
+                                   recreated if it was copied without it.
+
+    Returns:
+        h5py.Dataset: The resizable dataset.
+    """
+    dataset = group[name]
+    maxshape = maxshape or (None,) * dataset.ndim
+    same_fill = fillvalue is None or np.array_equal(dataset.fillvalue, fillvalue, equal_nan=True)
+    if tuple(dataset.maxshape) == tuple(maxshape) and same_fill:
+        return dataset
+    data = dataset[()]
+    kwargs = {'dtype': dataset.dtype, 'maxshape': maxshape, 'chunks': dataset.chunks or chunks}
+    if fillvalue is not None:
+        kwargs['fillvalue'] = fillvalue
+    if dataset.compression is not None:
+        kwargs['compression'] = dataset.compression
+        kwargs['compression_opts'] = dataset.compression_opts
+    if dataset.shuffle:
+        kwargs['shuffle'] = True
+    del group[name]
+    return group.create_dataset(name, data=data, **kwargs)
+
+
+def copy_member(source_group, name, target_group):
+    """Copies a member of a group to another file, keeping soft and external links as links."""
+    link = source_group.get(name, getlink=True)
+    if isinstance(link, h5py.SoftLink):
+        target_group[name] = h5py.SoftLink(link.path)
+    elif isinstance(link, h5py.ExternalLink):
+        target_group[name] = h5py.ExternalLink(link.filename, link.path)
+    else:
+        # Native object copy: datasets keep their chunking, filters and fill value, and are copied chunk by chunk
+        source_group.copy(source_group[name], target_group, name=name)
+
+
+def read_bytes_dataset(dataset):
+    """Returns the raw bytes stored by create_bytes_dataset(), in either layout."""
+    if dataset.shape == ():
+        return bytes(dataset[()])
+    return dataset[()].tobytes()
+
+
+def read_counts_dataset(dataset):
+    """Returns channel counts as an int64 array, whatever integer dtype they are stored in."""
+    data = dataset[()]
+    if np.issubdtype(data.dtype, np.integer):
+        return data.astype(np.int64, copy=False)
+    return data
+
+
+def benchmark_storage_options(dat_files, options_list, folder, repeat=1):
+    """
+    Measures the file size and the write and read times of storing spectra with several storage options.
+
+    Each setting writes the raw contents and counts of every parsed file to a fresh HDF5 file in the given
+    folder, reads them all back, and then deletes the file.
+
+    Parameters:
+        dat_files (list of DatFile): The parsed .DAT files to store.
+        options_list (list of dict): The storage options to compare; partial options are completed with defaults.
+        folder (str): A directory for the temporary benchmark files.
+        repeat (int): The number of times each setting is measured; the fastest run is reported.
+
+    Returns:
+        list of dict: One entry per setting with keys 'options', 'file_size', 'write_seconds' and 'read_seconds'.
+    """
+    report = []
+    for index, options in enumerate(options_list):
+        options = validate_storage_options(options)
+        path = os.path.join(folder, f"storage_benchmark_{index}.h5")
+        write_seconds = read_seconds = float('inf')
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                with h5py.File(path, 'w') as h5file:
+                    for dat_file in dat_files:
+                        group = h5file.create_group(dat_file.name)
+                        create_bytes_dataset(group, 'raw_content', dat_file.raw_content, options)
+                        create_array_dataset(group, 'original_data', dat_file.counts, options)
+                write_seconds = min(write_seconds, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                with h5py.File(path, 'r') as h5file:
+                    for group in h5file.values():
+                        read_bytes_dataset(group['raw_content'])
+                        read_counts_dataset(group['original_data'])
+                read_seconds = min(read_seconds, time.perf_counter() - start)
+
+            report.append({'options': options, 'file_size': os.path.getsize(path),
+                           'write_seconds': write_seconds, 'read_seconds': read_seconds})
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    return report
+
+
+def main():
+    """Prints a storage benchmark report for the .DAT files of a folder."""
+    import argparse
+    import glob
+    import tempfile
+
+    from .dat_parser import read_dat_file
+
+    parser = argparse.ArgumentParser(description="Compare HDF5 storage options on a folder of .DAT files.")
+    parser.add_argument('folder', help="Folder containing .DAT files")
+    parser.add_argument('--limit', type=int, default=None, help="Maximum number of files to use")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs per setting")
+    args = parser.parse_args()
+
+    file_paths = sorted(glob.glob(os.path.join(args.folder, '*.DAT')) + glob.glob(os.path.join(args.folder, '*.dat')))
+    dat_files = [read_dat_file(file_path) for file_path in file_paths[:args.limit]]
+
+    options_list = [
+        LEGACY_STORAGE_OPTIONS,
+        {**LEGACY_STORAGE_OPTIONS, 'narrow_dtype': True},
+        {'compression': 'lzf', 'shuffle': True},
+        {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+        DEFAULT_STORAGE_OPTIONS,
+        {'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        report = benchmark_storage_options(dat_files, options_list, folder, repeat=args.repeat)
+
+    print(f"{len(dat_files)} files")
+    print(f"{'compression':<12}{'level':>6}{'shuffle':>9}{'narrow':>8}{'size (MB)':>12}{'write (s)':>11}{'read (s)':>10}")
+    for entry in report:
+        options = entry['options']
+        print(f"{str(options['compression']):<12}{str(options['compression_opts'] or ''):>6}"
+              f"{str(options['shuffle']):>9}{str(options['narrow_dtype']):>8}"
+              f"{entry['file_size'] / 1e6:>12.2f}{entry['write_seconds']:>11.3f}{entry['read_seconds']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
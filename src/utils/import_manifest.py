@@ -0,0 +1,128 @@
+# import_manifest.py
+import h5py
+import numpy as np
+
+MANIFEST_GROUP = 'import_manifest'  # Group holding the manifest columns in the project file
+
+# Column name -> HDF5 dtype. One row per (target, path) pair; a re-import updates the row in place.
+_COLUMNS = {
+    'target': h5py.string_dtype(),  # HDF5 path of the group the file was imported into, e.g. '/data'
+    'path': h5py.string_dtype(),  # Absolute path of the original file
+    'name': h5py.string_dtype(),  # Name of the file group
+    'size': np.int64,  # File size in bytes when imported, -1 if unknown
+    'mtime': np.float64,  # File modification time when imported, NaN if unknown
+    'content_hash': h5py.string_dtype(),  # SHA-256 of the contents, empty if the file could not be read
+    'status': h5py.string_dtype(),  # Status of the last import of the file
+    'message': h5py.string_dtype(),
+}
+
+_NUMERIC_COLUMNS = ('size', 'mtime')
+_CHUNK_ROWS = 1024
+
+
+def _column_array(column, values):
+    """Converts a list of column values to an array h5py can write to the column dataset."""
+    return np.array(values, dtype=_COLUMNS[column] if column in _NUMERIC_COLUMNS else object)
+
+
+class ImportManifest:
+    """
+    Per-file record of the bulk imports of a project, stored as resizable column datasets in the project file.
+
+    The manifest is loaded into memory when created. Recorded rows are buffered and written by flush(), so
+    callers can checkpoint it together with the data they import.
+    """
+
+    def __init__(self, h5file):
+        """
+        Parameters:
+            h5file (h5py.File): The open project file.
+        """
+        self._h5file = h5file
+        self._columns = {column: [] for column in _COLUMNS}
+        self._rows = {}  # (target, path) -> row index
+        self._stored = 0  # Number of rows already written to the file
+        self._dirty = set()  # Indices of written rows modified since the last flush
+
+        if MANIFEST_GROUP in h5file:
+            group = h5file[MANIFEST_GROUP]
+            for column in _COLUMNS:
+                dataset = group[column]
+                values = dataset[()] if column in _NUMERIC_COLUMNS else dataset.asstr()[()]
+                self._columns[column] = values.tolist()
+            self._stored = len(self._columns['path'])
+            for index, key in enumerate(zip(self._columns['target'], self._columns['path'])):
+                self._rows[key] = index
+
+    def __len__(self):
+        return len(self._columns['path'])
+
+    def lookup(self, target, path):
+        """
+        Returns the manifest entry of a file as a dict with one key per column, or None if it was never imported.
+        """
+        index = self._rows.get((target, path))
+        if index is None:
+            return None
+        return {column: values[index] for column, values in self._columns.items()}
+
+    def is_unchanged(self, target, path, size, mtime, statuses):
+        """
+        Returns True if the file was last imported into target with one of the given statuses and has the
+        same size and modification time as then.
+        """
+        index = self._rows.get((target, path))
+        return (index is not None and self._columns['status'][index] in statuses
+                and self._columns['size'][index] == size and self._columns['mtime'][index] == mtime)
+
+    def record(self, target, path, name, size, mtime, content_hash, status, message=''):
+        """
+        Records the outcome of importing a file, replacing any earlier entry for the same target and path.
+        The entry is written to the project file by the next flush().
+        """
+        row = {'target': target, 'path': path, 'name': name, 'size': size, 'mtime': mtime,
+               'content_hash': content_hash, 'status': status, 'message': message}
+        index = self._rows.get((target, path))
+        if index is None:
+            self._rows[(target, path)] = len(self)
+            for column, values in self._columns.items():
+                values.append(row[column])
+        else:
+            for column, values in self._columns.items():
+                values[index] = row[column]
+            if index < self._stored:
+                self._dirty.add(index)
+
+    def entries(self, target=None):
+        """
+        Returns the manifest entries as a list of dicts, optionally only those of one target.
+        """
+        return [{column: values[index] for column, values in self._columns.items()}
+                for index in range(len(self)) if target is None or self._columns['target'][index] == target]
+
+    def flush(self):
+        """
+        Writes the rows recorded since the last flush to the project file. Does not flush the file itself.
+        """
+        if self._stored == len(self) and not self._dirty:
+            return
+
+        group = self._h5file.require_group(MANIFEST_GROUP)
+        for column, dtype in _COLUMNS.items():
+            values = self._columns[column]
+            dataset = group.get(column)
+            if dataset is None or dataset.maxshape[0] is not None:
+                # Missing, or copied without its unlimited dimension: rewrite the whole column
+                if dataset is not None:
+                    del group[column]
+                group.create_dataset(column, data=_column_array(column, values), dtype=dtype, maxshape=(None,),
+                                     chunks=(_CHUNK_ROWS,))
+                continue
+            dataset.resize((len(values),))
+            if len(values) > self._stored:
+                dataset[self._stored:] = _column_array(column, values[self._stored:])
+            for index in self._dirty:
+                dataset[index] = values[index]
+
+        self._stored = len(self)
+        self._dirty.clear()
@@ -0,0 +1,396 @@
+# metadata_table.py
+import heapq
+
+import h5py
+import numpy as np
+
+from .h5_storage import make_resizable
+
+METADATA_GROUP = 'file_metadata'  # Group holding the metadata columns of the files of the 'data' group
+
+NUMERIC_COLUMNS = ('pressure', 'chi_angle', 'pinhole', 'power', 'polarization', 'scans')  # float64, NaN if unset
+CATEGORICAL_COLUMNS = ('crystal', 'calibration')  # Strings stored as int32 codes into a list of categories
+METADATA_COLUMNS = NUMERIC_COLUMNS + CATEGORICAL_COLUMNS
+
+_GROW_ROWS = 1024  # Rows added at once when the table is full; unused rows are reused before growing again
+
+
+def legacy_metadata(attrs):
+    """
+    Returns the metadata column values stored as attributes of a dataset group by projects written before the
+    table existed, ignoring numeric values that are not numbers.
+
+    Parameters:
+        attrs (h5py.AttributeManager): The attributes of the group.
+
+    Returns:
+        dict: column -> value, for the columns present.
+    """
+    values = {}
+    for key in METADATA_COLUMNS:
+        if key not in attrs:
+            continue
+        value = attrs[key]
+        if key in NUMERIC_COLUMNS:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+        values[key] = value
+    return values
+
+
+class MetadataTable:
+    """
+    The per-file metadata of the 'data' group (pressure, crystal, chi angle, pinhole, power, polarization,
+    scans and calibration), stored as one resizable dataset per column instead of attributes on each group.
+
+    Crystal and calibration names are stored as int32 codes into a '<column>_categories' dataset, so selecting
+    files compares integers. A 'name' dataset gives the file of each row, empty for rows that are free.
+
+    The whole table is loaded into NumPy arrays when the object is created; select() and columns() then work
+    in memory without touching the file, and every change is written through to the file immediately.
+
+    Attributes:
+        h5file (h5py.File): The project file the table is stored in.
+    """
+
+    def __init__(self, h5file):
+        """
+        Parameters:
+            h5file (h5py.File): The open project file.
+        """
+        self.h5file = h5file
+        self._rows = {}  # name -> row index
+        self._names = []  # row index -> name, '' for free rows
+        self._used = np.zeros(0, dtype=bool)  # row index -> whether the row belongs to a file
+        self._free = []  # Heap of the indices of unused rows, so the lowest is reused first
+        self._values = {}  # column -> array of values (float64) or category codes (int32), one per row
+        self._categories = {column: [''] for column in CATEGORICAL_COLUMNS}  # column -> names; code 0 is ''
+        self._codes = {column: {'': 0} for column in CATEGORICAL_COLUMNS}  # column -> name -> code
+        self._datasets = {}  # Open datasets, by name
+
+        group = h5file.get(METADATA_GROUP)
+        if group is None:
+            for column in NUMERIC_COLUMNS:
+                self._values[column] = np.zeros(0, dtype=np.float64)
+            for column in CATEGORICAL_COLUMNS:
+                self._values[column] = np.zeros(0, dtype=np.int32)
+            return
+
+        # Datasets copied without their unlimited dimensions, e.g. by a save, are made resizable again
+        for name in group:
+            self._datasets[name] = make_resizable(group, name, (_GROW_ROWS,))
+        self._names = self._datasets['name'].asstr()[()].tolist()
+        for column in METADATA_COLUMNS:
+            self._values[column] = self._datasets[column][()]
+        for column in CATEGORICAL_COLUMNS:
+            self._categories[column] = self._datasets[f'{column}_categories'].asstr()[()].tolist()
+            self._codes[column] = {category: code for code, category in enumerate(self._categories[column])}
+        for row, name in enumerate(self._names):
+            if name:
+                self._rows[name] = row
+            else:
+                self._free.append(row)
+        self._used = np.array([bool(name) for name in self._names], dtype=bool)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def _create(self):
+        """Creates the empty datasets."""
+        group = self.h5file.create_group(METADATA_GROUP)
+        string_dtype = h5py.string_dtype()
+        datasets = {'name': group.create_dataset('name', shape=(0,), maxshape=(None,), dtype=string_dtype,
+                                                 chunks=(_GROW_ROWS,))}
+        for column in NUMERIC_COLUMNS:
+            datasets[column] = group.create_dataset(column, shape=(0,), maxshape=(None,), dtype=np.float64,
+                                                    chunks=(_GROW_ROWS,))
+        for column in CATEGORICAL_COLUMNS:
+            datasets[column] = group.create_dataset(column, shape=(0,), maxshape=(None,), dtype=np.int32,
+                                                    chunks=(_GROW_ROWS,))
+            datasets[f'{column}_categories'] = group.create_dataset(
+                f'{column}_categories', data=np.array(self._categories[column], dtype=object), dtype=string_dtype,
+                maxshape=(None,), chunks=(64,))
+        self._datasets = datasets
+
+    def _grow(self):
+        """Adds _GROW_ROWS free rows at the end of the columns."""
+        if not self._datasets:
+            self._create()
+        rows = len(self._names)
+        for name, dataset in self._datasets.items():
+            if not name.endswith('_categories'):
+                dataset.resize((rows + _GROW_ROWS,))
+        for column in NUMERIC_COLUMNS:
+            self._datasets[column][rows:] = np.nan
+            self._values[column] = np.concatenate([self._values[column], np.full(_GROW_ROWS, np.nan)])
+        for column in CATEGORICAL_COLUMNS:
+            self._values[column] = np.concatenate([self._values[column], np.zeros(_GROW_ROWS, dtype=np.int32)])
+        self._names.extend([''] * _GROW_ROWS)
+        self._used = np.concatenate([self._used, np.zeros(_GROW_ROWS, dtype=bool)])
+        self._free.extend(range(rows, rows + _GROW_ROWS))
+
+    def _encode(self, column, value):
+        """Returns the code of a category, adding it to the categories of the column if it is new."""
+        value = '' if value is None else str(value)
+        code = self._codes[column].get(value)
+        if code is None:
+            code = len(self._categories[column])
+            self._categories[column].append(value)
+            self._codes[column][value] = code
+            categories = self._datasets[f'{column}_categories']
+            categories.resize((code + 1,))
+            categories[code] = value
+        return code
+
+    @classmethod
+    def check(cls, column, value):
+        """
+        Checks that a value can be stored in a column, e.g. before writing several values that must all be set.
+
+        Raises:
+            ValueError: If the column is unknown or a numeric value is not a number.
+        """
+        if column not in METADATA_COLUMNS:
+            raise ValueError(f"Unknown metadata column '{column}'.")
+        if column in NUMERIC_COLUMNS:
+            cls._to_float(column, value)
+
+    @staticmethod
+    def _to_float(column, value):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return np.nan  # Empty cells of the files table are shown as ''
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"The {column} must be a number, got {value!r}.")
+
+    def add(self, name, **values):
+        """
+        Adds a row for a file, with NaN or '' for the columns not given. Does not flush.
+
+        Raises:
+            ValueError: If the file already has a row, a column is unknown or a numeric value is not a number.
+        """
+        if name in self._rows:
+            raise ValueError(f"{name} already has metadata.")
+        unknown = set(values) - set(METADATA_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown metadata column(s): {', '.join(sorted(unknown))}.")
+        if not self._free:
+            self._grow()
+        row = heapq.heappop(self._free)
+        self._rows[name] = row
+        self._names[row] = name
+        self._used[row] = True
+        self._datasets['name'][row] = name
+        for column in METADATA_COLUMNS:
+            self._write(row, column, values.get(column))
+        return row
+
+    def add_many(self, rows):
+        """
+        Adds rows for several files like add(), writing each column once for all of them. Does not flush.
+
+        Parameters:
+            rows (list of tuple): (name, values) pairs, values being a dict column -> value.
+
+        Raises:
+            ValueError: If a file already has a row or appears twice, a column is unknown or a numeric value
+                        is not a number. No row is added in that case.
+        """
+        names = [name for name, _ in rows]
+        if len(set(names)) != len(names) or any(name in self._rows for name in names):
+            raise ValueError("Files already have metadata or appear twice.")
+        converted = []
+        for name, values in rows:
+            unknown = set(values) - set(METADATA_COLUMNS)
+            if unknown:
+                raise ValueError(f"Unknown metadata column(s): {', '.join(sorted(unknown))}.")
+            converted.append({column: self._to_float(column, values[column])
+                              for column in NUMERIC_COLUMNS if column in values})
+        if not rows:
+            return
+
+        while len(self._free) < len(rows):
+            self._grow()
+        indices = [heapq.heappop(self._free) for _ in rows]
+        for row, (name, values), numbers in zip(indices, rows, converted):
+            self._rows[name] = row
+            self._names[row] = name
+            self._used[row] = True
+            for column in NUMERIC_COLUMNS:
+                self._values[column][row] = numbers.get(column, np.nan)
+            for column in CATEGORICAL_COLUMNS:
+                self._values[column][row] = self._encode(column, values.get(column))
+
+        # The in-memory columns mirror the file, so the span of the new rows is written from them in one go
+        first, last = min(indices), max(indices) + 1
+        self._datasets['name'][first:last] = np.array(self._names[first:last], dtype=object)
+        for column in METADATA_COLUMNS:
+            self._datasets[column][first:last] = self._values[column][first:last]
+
+    def remove(self, name):
+        """Frees the row of a file, if it has one. Does not flush."""
+        row = self._rows.pop(name, None)
+        if row is None:
+            return
+        self._names[row] = ''
+        self._used[row] = False
+        self._datasets['name'][row] = ''
+        for column in METADATA_COLUMNS:
+            self._write(row, column, None)
+        heapq.heappush(self._free, row)
+
+    def _write(self, row, column, value):
+        """Writes a value unless the row already holds it, e.g. NaN in a new row. Returns True if written."""
+        current = self._values[column][row]
+        if column in NUMERIC_COLUMNS:
+            value = self._to_float(column, value)
+            if current == value or (np.isnan(current) and np.isnan(value)):
+                return False
+        else:
+            value = self._encode(column, value)
+            if current == value:
+                return False
+        self._values[column][row] = value
+        self._datasets[column][row] = value
+        return True
+
+    def get(self, name, column):
+        """
+        Returns the value of a column for a file: a float (NaN if unset) or a string ('' if unset).
+
+        Raises:
+            KeyError: If the file has no row.
+        """
+        value = self._values[column][self._rows[name]]
+        if column in CATEGORICAL_COLUMNS:
+            return self._categories[column][value]
+        return float(value)
+
+    def set(self, name, column, value):
+        """
+        Sets the value of a column for a file. None clears it. Does not flush.
+
+        Returns:
+            bool: False if the file already had this value, in which case nothing is written.
+
+        Raises:
+            KeyError: If the file has no row.
+            ValueError: If the column is unknown or a numeric value is not a number.
+        """
+        if column not in METADATA_COLUMNS:
+            raise ValueError(f"Unknown metadata column '{column}'.")
+        return self._write(self._rows[name], column, value)
+
+    def differs(self, name, column, value):
+        """
+        Returns True if set() would change the value of a column for a file.
+
+        Raises:
+            KeyError: If the file has no row.
+            ValueError: If the column is unknown or a numeric value is not a number.
+        """
+        if column not in METADATA_COLUMNS:
+            raise ValueError(f"Unknown metadata column '{column}'.")
+        current = self.get(name, column)
+        if column in CATEGORICAL_COLUMNS:
+            return ('' if value is None else str(value)) != current
+        value = self._to_float(column, value)
+        return not (current == value or (np.isnan(current) and np.isnan(value)))
+
+    def set_many(self, values):
+        """
+        Sets values of several files and columns like successive calls of set(), writing each column changed
+        once, over the span of the rows changed. Does not flush.
+
+        Parameters:
+            values (iterable): (name, column, value) tuples, in order: the last value of a cell wins, and new
+                               categories are added in that order.
+
+        Returns:
+            bool: False if the files already had these values, in which case nothing is written.
+
+        Raises:
+            KeyError: If a file has no row.
+            ValueError: If a column is unknown or a numeric value is not a number. No value is set in that case.
+        """
+        converted = []
+        for name, column, value in values:
+            if column not in METADATA_COLUMNS:
+                raise ValueError(f"Unknown metadata column '{column}'.")
+            if column in NUMERIC_COLUMNS:
+                value = self._to_float(column, value)
+            converted.append((self._rows[name], column, value))
+
+        cells = {}  # (row, column) -> last value
+        for row, column, value in converted:
+            cells[row, column] = self._encode(column, value) if column in CATEGORICAL_COLUMNS else value
+
+        spans = {}  # column -> (first, last) rows changed
+        for (row, column), value in cells.items():
+            current = self._values[column][row]
+            if current == value or (column in NUMERIC_COLUMNS and np.isnan(current) and np.isnan(value)):
+                continue
+            self._values[column][row] = value
+            first, last = spans.get(column, (row, row + 1))
+            spans[column] = (min(first, row), max(last, row + 1))
+
+        # The in-memory columns mirror the file, so the span of the rows changed is written from them in one go
+        for column, (first, last) in spans.items():
+            self._datasets[column][first:last] = self._values[column][first:last]
+        return bool(spans)
+
+    def select(self, **criteria):
+        """
+        Returns the names of the files whose columns equal all the given values, sorted by name.
+        NaN never matches, nor do values that are not numbers in numeric columns.
+
+        Raises:
+            ValueError: If a column is unknown.
+        """
+        unknown = set(criteria) - set(METADATA_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown metadata column(s): {', '.join(sorted(unknown))}.")
+        mask = self._used.copy()
+        for column, value in criteria.items():
+            if column in CATEGORICAL_COLUMNS:
+                code = self._codes[column].get('' if value is None else str(value))
+                if code is None:
+                    return []
+                mask &= self._values[column] == code
+            else:
+                try:
+                    mask &= self._values[column] == self._to_float(column, value)
+                except ValueError:
+                    return []
+        return sorted(self._names[row] for row in np.flatnonzero(mask))
+
+    def columns(self, names, columns=METADATA_COLUMNS):
+        """
+        Returns the values of several columns for several files.
+
+        Parameters:
+            names (list of str): The names of files with a row.
+            columns (tuple of str): The columns to return.
+
+        Returns:
+            dict: column -> array in the order of names; float64 arrays for numeric columns,
+                  object arrays of strings for crystal and calibration.
+
+        Raises:
+            KeyError: If a file has no row.
+        """
+        rows = np.array([self._rows[name] for name in names], dtype=np.int64)
+        result = {}
+        for column in columns:
+            values = self._values[column][rows]
+            if column in CATEGORICAL_COLUMNS:
+                values = np.array(self._categories[column], dtype=object)[values]
+            result[column] = values
+        return result
@@ -0,0 +1,220 @@
+# mutation_journal.py
+import json
+import os
+import struct
+import zlib
+
+import h5py
+import numpy as np
+
+JOURNAL_MAGIC = b'BAJRN001'  # First bytes of a journal file
+
+_HEADER = struct.Struct('<8sqq')  # Magic, size and modification time (ns) of the project file the journal follows
+_RECORD = struct.Struct('<II')  # Length and CRC-32 of the payload written before each record
+_JSON_LENGTH = struct.Struct('<I')  # Length of the JSON part of a payload, followed by the binary buffers
+_DECODER = json.JSONDecoder()  # Shared by decode_call(), json.loads() creating one per call
+
+
+def _encode_value(value, buffers):
+    """
+    Returns a JSON-compatible form of an argument, appending the bytes of numeric arrays and byte strings to
+    buffers, which the form refers to by offset. HDF5 objects are stored by path, but for datasets no longer
+    linked in the file, e.g. held by the undo history, which are stored by contents.
+    """
+    if isinstance(value, (str, bool, int, float)) or value is None:
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind not in 'biufc':
+            return {'__list__': value.tolist()}
+        offset = sum(map(len, buffers))
+        buffers.append(np.ascontiguousarray(value).tobytes())
+        return {'__array__': [value.dtype.str, list(value.shape), offset]}
+    if isinstance(value, (bytes, bytearray)):
+        offset = sum(map(len, buffers))
+        buffers.append(bytes(value))
+        return {'__bytes__': [offset, len(value)]}
+    if isinstance(value, h5py.Dataset) and value.name is None:
+        return _encode_value(value[()], buffers)
+    if isinstance(value, (h5py.Group, h5py.Dataset)):
+        return {'__h5__': value.name}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item, buffers) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _encode_value(item, buffers) for key, item in value.items()}
+    raise TypeError(f"Values of type {type(value).__name__} cannot be journaled.")
+
+
+def encode_call(operation, args, kwargs):
+    """
+    Returns the payload of a journal record: the name of a method and its arguments.
+
+    Parameters:
+        operation (str): The name of the method.
+        args (tuple): The positional arguments.
+        kwargs (dict): The keyword arguments.
+
+    Raises:
+        TypeError: If an argument is not a number, string, numpy array, byte string, HDF5 object, list or dict.
+    """
+    buffers = []
+    text = json.dumps([operation, _encode_value(list(args), buffers), _encode_value(kwargs, buffers)],
+                      separators=(',', ':')).encode()
+    return b''.join([_JSON_LENGTH.pack(len(text)), text] + buffers)
+
+
+def _decode_value(value, buffers, h5file):
+    """Returns an argument from the form written by _encode_value()."""
+    if isinstance(value, list):
+        return [_decode_value(item, buffers, h5file) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        key, item = next(iter(value.items()))
+        if key == '__array__':
+            dtype, shape, offset = item
+            dtype = np.dtype(dtype)
+            size = dtype.itemsize * int(np.prod(shape))
+            return np.frombuffer(buffers[offset:offset + size], dtype=dtype).reshape(shape).copy()
+        if key == '__bytes__':
+            offset, length = item
+            return bytes(buffers[offset:offset + length])
+        if key == '__list__':
+            return np.array(item)
+        if key == '__h5__':
+            return h5file[item]
+    return {key: _decode_value(item, buffers, h5file) for key, item in value.items()}
+
+
+def decode_call(payload, h5file=None):
+    """
+    Returns the (operation, args, kwargs) of a payload written by encode_call(). Tuples come back as lists.
+
+    Parameters:
+        payload (bytes): The payload.
+        h5file (h5py.File or None): The file in which the paths of HDF5 objects are opened.
+    """
+    json_length, = _JSON_LENGTH.unpack_from(payload)
+    start = _JSON_LENGTH.size + json_length
+    text = payload[_JSON_LENGTH.size:start].decode()
+    (operation, args, kwargs), _ = _DECODER.raw_decode(text)  # The text is compact JSON, without whitespace
+    if '"__' in text:  # Only arguments written as markers need a second pass, most edits have none
+        buffers = memoryview(payload)[start:]
+        args, kwargs = _decode_value(args, buffers, h5file), _decode_value(kwargs, buffers, h5file)
+    return operation, args, kwargs
+
+
+class MutationJournal:
+    """
+    An append-only file of the changes made to a project since it was last saved, each recorded as the call of
+    a method with its arguments, so that they can be replayed on the saved project after a crash.
+
+    The journal starts with a header identifying the project file it follows by its size and modification time,
+    so that it is not replayed over another version of it. Each record is its length and CRC-32 followed by the
+    payload of encode_call(). Records are written without buffering, so they survive a crash of the
+    application as soon as they are appended; a record torn by a crash of the system fails its CRC, and it and
+    everything after it is dropped when the journal is reopened.
+
+    Attributes:
+        path (str): The journal file.
+        record_count (int): The number of records in the journal.
+    """
+
+    def __init__(self, path, base_path, resume=False):
+        """
+        Parameters:
+            path (str): The journal file, created or replaced unless resume is True.
+            base_path (str): The project file the journal follows.
+            resume (bool): Whether to reopen an existing journal to append to it, keeping its valid records.
+
+        Raises:
+            OSError: If the journal cannot be written, or resume is True and it cannot be opened, is damaged, or
+                     follows another version of the project file.
+        """
+        self.path = path
+        self.record_count = 0
+        self._offsets = []  # Offsets of the valid records, read back by records()
+        if resume:
+            self._fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            try:
+                self._load(base_path)
+            except (OSError, ValueError) as e:
+                os.close(self._fd)
+                raise e if isinstance(e, OSError) else OSError(str(e))
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+            self.reset(base_path)
+
+    @staticmethod
+    def _base_id(base_path):
+        stat = os.stat(base_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load(self, base_path):
+        """Checks the header, finds the valid records and drops what follows them."""
+        with open(self._fd, 'rb', closefd=False) as file:
+            data = file.read()
+        if len(data) < _HEADER.size:
+            raise ValueError(f"{self.path} is damaged.")
+        magic, base_size, base_mtime = _HEADER.unpack_from(data)
+        if magic != JOURNAL_MAGIC:
+            raise ValueError(f"{self.path} is not a journal.")
+        if (base_size, base_mtime) != self._base_id(base_path):
+            raise ValueError(f"{self.path} follows another version of {os.path.basename(base_path)}.")
+        position = _HEADER.size
+        while position + _RECORD.size <= len(data):
+            length, crc = _RECORD.unpack_from(data, position)
+            start = position + _RECORD.size
+            if start + length > len(data) or zlib.crc32(data[start:start + length]) != crc:
+                break
+            self._offsets.append(position)
+            position = start + length
+        self.record_count = len(self._offsets)
+        os.ftruncate(self._fd, position)
+        os.lseek(self._fd, position, os.SEEK_SET)
+
+    def records(self, h5file=None):
+        """
+        Yields the (operation, args, kwargs) of the records the journal held when it was reopened, in order.
+
+        Parameters:
+            h5file (h5py.File or None): The file in which the paths of HDF5 objects are opened, as each record is
+                                        decoded, so that they refer to the objects left by the records before.
+        """
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        for position in self._offsets:
+            length, _ = _RECORD.unpack_from(data, position)
+            start = position + _RECORD.size
+            yield decode_call(data[start:start + length], h5file)
+
+    def append(self, operation, args=(), kwargs=None):
+        """
+        Appends the call of a method to the journal.
+
+        Raises:
+            TypeError: If an argument cannot be journaled, see encode_call().
+        """
+        self.append_payload(encode_call(operation, args, kwargs or {}))
+
+    def append_payload(self, payload):
+        """Appends a payload of encode_call(), e.g. encoded before the call it records changed its arguments."""
+        record = memoryview(_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        while record:
+            record = record[os.write(self._fd, record):]
+        self.record_count += 1
+
+    def reset(self, base_path):
+        """Empties the journal once its changes are saved, making it follow the new version of the project file."""
+        os.ftruncate(self._fd, 0)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, _HEADER.pack(JOURNAL_MAGIC, *self._base_id(base_path)))
+        self._offsets = []
+        self.record_count = 0
+
+    def close(self):
+        """Closes the journal, leaving the file in place."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
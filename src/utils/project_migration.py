@@ -0,0 +1,346 @@
+# project_migration.py
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+
+from .fit_results import FIT_RESULTS_GROUP, PEAK_FIT_FIELDS, FitResults, legacy_fit_results, unknown_fit_fields
+from .h5_storage import copy_member
+from .metadata_table import CATEGORICAL_COLUMNS, METADATA_COLUMNS, METADATA_GROUP, MetadataTable, legacy_metadata
+
+# Version of the on-disk layout written by this version of BrillouinProject, stored in the 'schema_version'
+# root attribute. Projects without the attribute are version 1.
+#
+# 1: the metadata of each file is stored as attributes of its group under 'data', and its fit results as
+#    attributes of one 'velocities/<name>' group per velocity.
+# 2: the metadata is stored in the 'file_metadata' table and the fit results in the 'fit_results' array;
+#    the groups under 'data' hold neither.
+SCHEMA_VERSION = 2
+
+MIGRATION_BATCH = 1024  # Files whose metadata and fit results are written to the new file at once
+
+BACKUP_SUFFIX = '.v1.h5'  # Appended to the name of a project, without its extension, for the copy kept by migration
+
+# Per-project statuses reported by migrate_projects()
+MIGRATION_MIGRATED = 'migrated'
+MIGRATION_SKIPPED = 'skipped'
+MIGRATION_FAILED = 'failed'
+
+
+def read_schema_version(h5file):
+    """
+    Returns the layout version of a project.
+
+    Parameters:
+        h5file (h5py.File or str): The open project file, or its path.
+
+    Returns:
+        int: The value of the 'schema_version' root attribute, 1 if it is missing.
+    """
+    if isinstance(h5file, str):
+        with h5py.File(h5file, 'r') as file:
+            return read_schema_version(file)
+    return int(h5file.attrs.get('schema_version', 1))
+
+
+class _SourceTables:
+    """
+    Read-only access to the metadata table and fit results array of a project being migrated, for projects
+    opened by a version that already wrote them. Only the name indices and metadata columns are held in
+    memory; the fit results are read one file at a time.
+    """
+
+    def __init__(self, h5file):
+        self.metadata = {}  # file -> {column: value}
+        group = h5file.get(METADATA_GROUP)
+        if group is not None:
+            columns = {column: group[column][()] for column in METADATA_COLUMNS}
+            categories = {column: group[f'{column}_categories'].asstr()[()] for column in CATEGORICAL_COLUMNS}
+            for row, name in enumerate(group['name'].asstr()[()]):
+                if name:
+                    self.metadata[name] = {
+                        column: categories[column][columns[column][row]] if column in categories
+                        else columns[column][row] for column in METADATA_COLUMNS}
+
+        self._values = None
+        self._rows = {}  # file -> row of the fit results array
+        self._columns = {}  # velocity -> column of the fit results array
+        group = h5file.get(FIT_RESULTS_GROUP)
+        if group is not None:
+            self._values = group['values']
+            self._rows = {name: row for row, name in enumerate(group['files'].asstr()[()]) if name}
+            self._columns = {name: column for column, name in enumerate(group['velocities'].asstr()[()]) if name}
+
+    def fit_results(self, file_name, velocities):
+        """
+        Returns the [len(velocities), len(PEAK_FIT_FIELDS)] results stored for a file, NaN for velocities without
+        a column, or None if the file has no row.
+        """
+        row = self._rows.get(file_name)
+        if row is None:
+            return None
+        stored = self._values[row]
+        results = np.full((len(velocities), len(PEAK_FIT_FIELDS)), np.nan)
+        for index, velocity in enumerate(velocities):
+            if velocity in self._columns:
+                results[index] = stored[self._columns[velocity]]
+        return results
+
+
+def _legacy_fit_results(group, velocities):
+    """Returns the [len(velocities), len(PEAK_FIT_FIELDS)] results stored in the 'velocities' groups of a file."""
+    results = np.full((len(velocities), len(PEAK_FIT_FIELDS)), np.nan)
+    velocity_groups = group.get('velocities')
+    if velocity_groups is not None:
+        for index, velocity in enumerate(velocities):
+            if velocity in velocity_groups:
+                for field, value in legacy_fit_results(velocity_groups[velocity].attrs).items():
+                    results[index, PEAK_FIT_FIELDS.index(field)] = value
+    return results
+
+
+def _migrate_v1(source, target, progress_callback=None, cancel_event=None):
+    """
+    Streams a version 1 project into an empty file with the version 2 layout. The groups under 'data' are
+    copied one at a time without their metadata attributes and 'velocities' groups, whose values go to the
+    metadata table and the fit results array in batches of MIGRATION_BATCH files; attributes of the velocity
+    groups that are not peak fit fields are kept in groups of the same name. Everything else is copied as is.
+
+    Returns:
+        int: The number of files under 'data', or None if cancelled.
+    """
+    for key, value in source.attrs.items():
+        target.attrs[key] = value
+    for name in source:
+        if name not in ('data', METADATA_GROUP, FIT_RESULTS_GROUP):
+            copy_member(source, name, target)
+
+    tables = _SourceTables(source)
+    velocities = [str(velocity) for velocity in source.attrs.get('velocities', [])]
+    metadata_table = MetadataTable(target)
+    fit_results = FitResults(target)
+    for velocity in velocities:
+        fit_results.add_velocity(velocity)
+
+    source_data = source.get('data')
+    target_data = target.create_group('data')
+    if source_data is None:
+        return 0
+    for key, value in source_data.attrs.items():
+        target_data.attrs[key] = value
+
+    names = list(source_data.keys())
+    for start in range(0, len(names), MIGRATION_BATCH):
+        batch = names[start:start + MIGRATION_BATCH]
+        metadata_rows = []
+        batch_results = np.full((len(batch), len(velocities), len(PEAK_FIT_FIELDS)), np.nan)
+        for index, name in enumerate(batch):
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            source_group = source_data[name]
+            target_group = target_data.create_group(name)
+            for key, value in source_group.attrs.items():
+                if key not in METADATA_COLUMNS:
+                    target_group.attrs[key] = value
+            for member in source_group:
+                if member != 'velocities':
+                    copy_member(source_group, member, target_group)
+            for velocity, velocity_group in source_group.get('velocities', {}).items():
+                unknown = unknown_fit_fields(velocity_group.attrs)
+                if unknown:
+                    kept = target_group.require_group('velocities').create_group(velocity)
+                    for key in unknown:
+                        kept.attrs[key] = velocity_group.attrs[key]
+
+            metadata = tables.metadata.get(name)
+            metadata_rows.append((name, metadata if metadata is not None else legacy_metadata(source_group.attrs)))
+            results = tables.fit_results(name, velocities)
+            batch_results[index] = results if results is not None else _legacy_fit_results(source_group, velocities)
+
+        metadata_table.add_many(metadata_rows)
+        # Only files with a result get a row of the fit results array, as in projects written from scratch
+        stored = ~np.isnan(batch_results).all(axis=(1, 2))
+        for index, velocity in enumerate(velocities):
+            fit_results.set_many([name for name, keep in zip(batch, stored) if keep], velocity,
+                                 batch_results[stored, index])
+        if progress_callback is not None:
+            progress_callback(start + len(batch), len(names))
+    return len(names)
+
+
+def migrate_project(source_path, target_path=None, backup=True, progress_callback=None, cancel_event=None):
+    """
+    Converts a project to the current layout (SCHEMA_VERSION).
+
+    The project is streamed into a new file next to the target: groups are copied one at a time with native
+    HDF5 object copies, so memory use does not depend on the size of the spectra, and the unused space left
+    in the old file is not carried over. The new file replaces the target only once it is complete.
+
+    Close the project in the application first: a session still open on it would overwrite the migrated
+    file with the old layout when saved.
+
+    Parameters:
+        source_path (str): The path of the project file.
+        target_path (str or None): Where to write the migrated project. Defaults to source_path.
+        backup (bool): When migrating in place, whether to keep the original file as '<name>.v1.h5'.
+        progress_callback (callable or None): Called as progress_callback(done, total) after each file of the
+                                              project.
+        cancel_event (threading.Event or None): When set, the migration stops and the source is left untouched.
+
+    Returns:
+        dict: 'from_version', 'to_version', 'files' (number of files under 'data'), 'seconds' and 'migrated'
+              (False if the project already had the current layout or the migration was cancelled).
+
+    Raises:
+        ValueError: If the project was written by a newer version, or the backup file already exists.
+        OSError: If a file cannot be read or written.
+    """
+    start = time.perf_counter()
+    target_path = target_path or source_path
+    in_place = os.path.abspath(target_path) == os.path.abspath(source_path)
+    backup_path = os.path.splitext(source_path)[0] + BACKUP_SUFFIX
+    partial_path = target_path + '.migrating'
+
+    with h5py.File(source_path, 'r') as source:
+        from_version = read_schema_version(source)
+        report = {'from_version': from_version, 'to_version': SCHEMA_VERSION, 'files': len(source.get('data', {})),
+                  'seconds': 0.0, 'migrated': False}
+        if from_version > SCHEMA_VERSION:
+            raise ValueError(f"{os.path.basename(source_path)} was written by a newer version "
+                             f"(layout version {from_version}).")
+        if from_version == SCHEMA_VERSION:
+            report['seconds'] = time.perf_counter() - start
+            return report
+        if in_place and backup and os.path.exists(backup_path):
+            raise ValueError(f"The backup {os.path.basename(backup_path)} already exists.")
+
+        try:
+            with h5py.File(partial_path, 'w') as target:
+                files = _migrate_v1(source, target, progress_callback, cancel_event)
+                if files is not None:
+                    target.attrs['schema_version'] = SCHEMA_VERSION
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+    if files is None:
+        os.remove(partial_path)
+    else:
+        if in_place and backup:
+            os.replace(source_path, backup_path)
+        os.replace(partial_path, target_path)
+        report['migrated'] = True
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def find_projects(paths):
+    """
+    Returns the project files among paths, listing the .h5 files directly inside the directories. Temporary
+    session files and backups kept by migration are left out.
+    """
+    projects = []
+    for path in paths:
+        if os.path.isdir(path):
+            projects.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                            if name.lower().endswith('.h5') and not name.endswith(('_temp.h5', BACKUP_SUFFIX)))
+        else:
+            projects.append(path)
+    return projects
+
+
+def _open_session_paths(project_path):
+    """
+    Returns the files BrillouinProject keeps in the default scratch folder for an open or interrupted session on a
+    project: the temporary file, or the delta file of the overlay mode, and the journal of its changes.
+    """
+    folder, name = os.path.split(project_path)
+    session_path = os.path.join(folder, 'temp', f"{os.path.splitext(name)[0]}_temp")
+    return session_path + '.h5', session_path + '.delta', session_path + '.journal'
+
+
+def _migrate_entry(project_path, backup):
+    """Migrates one project in place and returns its report entry; runs in a worker process."""
+    entry = {'path': project_path, 'status': MIGRATION_FAILED, 'message': '', 'from_version': None,
+             'files': 0, 'seconds': 0.0}
+    if any(os.path.exists(path) for path in _open_session_paths(project_path)):
+        entry['status'] = MIGRATION_SKIPPED
+        entry['message'] = "The project has an open or recoverable session."
+        return entry
+    try:
+        report = migrate_project(project_path, backup=backup)
+    except (OSError, ValueError) as e:
+        entry['message'] = str(e)
+        return entry
+    entry.update(from_version=report['from_version'], files=report['files'], seconds=report['seconds'])
+    if report['migrated']:
+        entry['status'] = MIGRATION_MIGRATED
+    else:
+        entry['status'] = MIGRATION_SKIPPED
+        entry['message'] = "Already up to date."
+    return entry
+
+
+def migrate_projects(project_paths, max_workers=None, backup=True, progress_callback=None):
+    """
+    Migrates several projects in place, each in its own worker process.
+
+    Parameters:
+        project_paths (list of str): The project files.
+        max_workers (int or None): The number of worker processes. Defaults to the number of CPUs.
+        backup (bool): Whether to keep the original of each migrated project as '<name>.v1.h5'.
+        progress_callback (callable or None): Called as progress_callback(done, total, entry) after each project.
+
+    Returns:
+        list of dict: One entry per project, in input order, with 'path', 'status' (MIGRATION_MIGRATED,
+                      MIGRATION_SKIPPED or MIGRATION_FAILED), 'message', 'from_version', 'files' and 'seconds'.
+    """
+    entries = {}
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(project_paths) or 1))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_migrate_entry, path, backup): path for path in project_paths}
+        for future in as_completed(futures):
+            entry = future.result()
+            entries[futures[future]] = entry
+            if progress_callback is not None:
+                progress_callback(len(entries), len(project_paths), entry)
+    return [entries[path] for path in project_paths]
+
+
+def main():
+    """Migrates project files, or all the projects of directories, to the current layout."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert Brillouin projects to the current file layout.")
+    parser.add_argument('paths', nargs='+', help="Project files, or directories whose .h5 projects are converted")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPUs)")
+    parser.add_argument('--no-backup', action='store_true', help="Do not keep the original of migrated projects")
+    parser.add_argument('--dry-run', action='store_true', help="Only report the layout version of each project")
+    args = parser.parse_args()
+
+    project_paths = find_projects(args.paths)
+    if args.dry_run:
+        for path in project_paths:
+            try:
+                print(f"{path}: version {read_schema_version(path)}")
+            except OSError as e:
+                print(f"{path}: {e}")
+        return
+
+    def report(done, total, entry):
+        message = f" ({entry['message']})" if entry['message'] else ''
+        print(f"[{done}/{total}] {entry['status']}: {entry['path']}, {entry['files']} files "
+              f"in {entry['seconds']:.1f} s{message}")
+
+    entries = migrate_projects(project_paths, args.workers, not args.no_backup, report)
+    counts = {status: sum(entry['status'] == status for entry in entries)
+              for status in (MIGRATION_MIGRATED, MIGRATION_SKIPPED, MIGRATION_FAILED)}
+    print(f"{counts[MIGRATION_MIGRATED]} migrated, {counts[MIGRATION_SKIPPED]} skipped, "
+          f"{counts[MIGRATION_FAILED]} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# project_repack.py
+import os
+import time
+
+import h5py
+import numpy as np
+
+from .h5_storage import (DEFAULT_STORAGE_OPTIONS, PROJECT_FILE_SPACE, copy_member, storage_options_from_attr,
+                         storage_options_to_attr, validate_storage_options)
+from .working_copy import replace_file
+
+REPACK_THRESHOLD = 0.25  # Free fraction of the working copy above which BrillouinProject.save_project() compacts it
+REPACK_BLOCK_BYTES = 8 << 20  # Bytes of a dataset read and written at once when it is re-chunked or recompressed
+REPACK_MIN_BYTES = 8 << 10  # Smaller datasets keep their layout, the chunk index costing more than filters save
+REPACK_OPTIONS = ('compression', 'compression_opts', 'shuffle', 'chunks')  # Storage options a repack can apply
+
+
+def free_space_ratio(h5file):
+    """
+    Returns the fraction of an open file that HDF5 knows to be free and has not reused. For files created with
+    PROJECT_FILE_SPACE, this includes the space freed in earlier sessions; for others, only the space freed since
+    the file was opened.
+
+    Parameters:
+        h5file (h5py.File): The open file.
+
+    Returns:
+        float: Free bytes divided by the size of the file, 0.0 for an empty file.
+    """
+    size = h5file.id.get_filesize()
+    return h5file.id.get_freespace() / size if size else 0.0
+
+
+def _rewrite_options(dataset, options):
+    """
+    Returns the create_dataset() keywords storing a dataset with the chunking, shuffle and compression of the
+    storage options, or None if it is copied as is: it already has them, or is virtual, scalar, not numeric or
+    smaller than REPACK_MIN_BYTES. Only 1-D datasets are re-chunked; the others keep the chunk shape chosen by
+    their class.
+    """
+    if (dataset.is_virtual or dataset.ndim == 0 or dataset.dtype.kind not in 'biuf'
+            or dataset.size * dataset.dtype.itemsize < REPACK_MIN_BYTES):
+        return None
+    if dataset.ndim == 1 and options['chunks'] is not None:
+        chunks = (min(options['chunks'], dataset.shape[0]),)
+    elif options['compression'] is None and not options['shuffle']:
+        chunks = dataset.chunks  # Contiguous datasets stay contiguous
+    else:
+        chunks = dataset.chunks or True
+    compression_opts = options['compression_opts'] if options['compression'] == 'gzip' else None
+    if (chunks == dataset.chunks and dataset.compression == options['compression']
+            and dataset.compression_opts == compression_opts and dataset.shuffle == options['shuffle']):
+        return None
+    kwargs = {'shape': dataset.shape, 'dtype': dataset.dtype, 'maxshape': dataset.maxshape, 'chunks': chunks,
+              'fillvalue': dataset.fillvalue}
+    if options['compression'] is not None:
+        kwargs['compression'] = options['compression']
+        kwargs['compression_opts'] = compression_opts
+    if options['shuffle']:
+        kwargs['shuffle'] = True
+    return kwargs
+
+
+def _copy_blocks(source, target):
+    """Copies a dataset into another of the same shape in blocks of about REPACK_BLOCK_BYTES of whole chunks."""
+    row_bytes = source.dtype.itemsize * int(np.prod(source.shape[1:]))
+    step = max(1, REPACK_BLOCK_BYTES // max(row_bytes, 1))
+    if source.chunks:
+        step = max(1, step // source.chunks[0]) * source.chunks[0]
+    for start in range(0, source.shape[0], step):
+        target[start:start + step] = source[start:start + step]
+
+
+def repack_file(source, target, options=None, progress_callback=None, cancel_event=None):
+    """
+    Streams the objects of a file into an empty file, keeping soft and external links as links.
+
+    Without storage options, the members of each top-level group are copied with native HDF5 object copies,
+    which keep the chunking, filters and fill value of the datasets and copy whole subtrees in the library. With
+    storage options, the groups are walked and each numeric dataset is rewritten with them in blocks of
+    REPACK_BLOCK_BYTES; the other datasets are copied natively.
+
+    Parameters:
+        source (h5py.File): The file to read.
+        target (h5py.File): The empty file to write.
+        options (dict or None): Complete storage options to apply, or None to keep the layout of every dataset.
+        progress_callback (callable or None): Called as progress_callback(done, total) after each member of a
+                                              top-level group, or with options after each dataset.
+        cancel_event (threading.Event or None): When set, the copy stops.
+
+    Returns:
+        dict: 'datasets' (number of datasets copied one by one, 0 without options) and 'rewritten' (number of
+              them rewritten with the storage options), or None if cancelled.
+    """
+    counts = {'datasets': 0, 'rewritten': 0}
+    for key, value in source.attrs.items():
+        target.attrs[key] = value
+
+    if options is None:
+        members = []  # (source group, name, target group) of the members of the top-level groups, and the others
+        for name in source:
+            if isinstance(source.get(name, getlink=True), h5py.HardLink) and isinstance(source[name], h5py.Group):
+                group = target.create_group(name)
+                for key, value in source[name].attrs.items():
+                    group.attrs[key] = value
+                members.extend((source[name], member, group) for member in source[name])
+            else:
+                members.append((source, name, target))
+        for done, (source_group, name, target_group) in enumerate(members, 1):
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            copy_member(source_group, name, target_group)
+            if progress_callback is not None:
+                progress_callback(done, len(members))
+        return counts
+
+    datasets = []
+    source.visititems(lambda name, obj: datasets.append(name) if isinstance(obj, h5py.Dataset) else None)
+
+    def copy_group(source_group, target_group):
+        for name in source_group:
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            if not isinstance(source_group.get(name, getlink=True), h5py.HardLink):
+                copy_member(source_group, name, target_group)
+                continue
+            item = source_group[name]
+            if isinstance(item, h5py.Group):
+                group = target_group.create_group(name)
+                for key, value in item.attrs.items():
+                    group.attrs[key] = value
+                if not copy_group(item, group):
+                    return False
+                continue
+            kwargs = _rewrite_options(item, options)
+            if kwargs is None:
+                copy_member(source_group, name, target_group)
+            else:
+                dataset = target_group.create_dataset(name, **kwargs)
+                _copy_blocks(item, dataset)
+                for key, value in item.attrs.items():
+                    dataset.attrs[key] = value
+                counts['rewritten'] += 1
+            counts['datasets'] += 1
+            if progress_callback is not None:
+                progress_callback(counts['datasets'], len(datasets))
+        return True
+
+    return counts if copy_group(source, target) else None
+
+
+def repack_project(source_path, target_path=None, options=None, progress_callback=None, cancel_event=None):
+    """
+    Rewrites a project into a fresh file, reclaiming the space HDF5 leaves unused when objects are removed or
+    replaced, and optionally applying storage options to the data already stored.
+
+    The project is streamed with repack_file(), so memory use does not depend on the size of the datasets. The
+    new file replaces the target only once it is complete and synced to the disk. When options are given, they
+    are also saved with the project, so new data uses them too.
+
+    Close the project in the application first, or use BrillouinProject.repack(): a session still open on it
+    would overwrite the repacked file when saved.
+
+    Parameters:
+        source_path (str): The path of the project file.
+        target_path (str or None): Where to write the repacked project. Defaults to source_path.
+        options (dict or None): Values of the storage options in REPACK_OPTIONS, the others being those of the
+                                project, or None to keep the layout of every dataset.
+        progress_callback (callable or None): Called as progress_callback(done, total), see repack_file().
+        cancel_event (threading.Event or None): When set, the repack stops and the source is left untouched.
+
+    Returns:
+        dict: 'bytes_before', 'bytes_after', 'bytes_reclaimed', 'datasets', 'rewritten', 'seconds' and
+              'repacked' (False if cancelled).
+
+    Raises:
+        ValueError: If an option is not in REPACK_OPTIONS or has an invalid value.
+        OSError: If a file cannot be read or written.
+    """
+    start = time.perf_counter()
+    if options is not None:
+        unknown = set(options) - set(REPACK_OPTIONS)
+        if unknown:
+            raise ValueError(f"Storage option(s) {', '.join(sorted(unknown))} cannot be changed by a repack.")
+    target_path = target_path or source_path
+    partial_path = target_path + '.repacking'
+    bytes_before = os.path.getsize(source_path)
+    report = {'bytes_before': bytes_before, 'bytes_after': bytes_before, 'bytes_reclaimed': 0, 'datasets': 0,
+              'rewritten': 0, 'seconds': 0.0, 'repacked': False}
+
+    with h5py.File(source_path, 'r') as source:
+        if options is not None:
+            stored = source.attrs.get('storage_options')
+            current = storage_options_from_attr(stored) if stored is not None else dict(DEFAULT_STORAGE_OPTIONS)
+            options = validate_storage_options({**current, **options})
+        try:
+            with h5py.File(partial_path, 'w', **PROJECT_FILE_SPACE) as target:
+                counts = repack_file(source, target, options, progress_callback, cancel_event)
+                if counts is not None and options is not None:
+                    target.attrs['storage_options'] = storage_options_to_attr(options)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+    if counts is None:
+        os.remove(partial_path)
+    else:
+        replace_file(partial_path, target_path)
+        bytes_after = os.path.getsize(target_path)
+        report.update(counts, bytes_after=bytes_after, bytes_reclaimed=bytes_before - bytes_after, repacked=True)
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def main():
+    """Repacks project files, or all the projects of directories, printing the space reclaimed."""
+    import argparse
+
+    from .project_migration import find_projects
+
+    parser = argparse.ArgumentParser(description="Compact Brillouin projects, reclaiming their unused space.")
+    parser.add_argument('paths', nargs='+', help="Project files, or directories whose .h5 projects are repacked")
+    parser.add_argument('--compression', choices=('none', 'gzip', 'lzf'), default=None,
+                        help="Recompress the numeric datasets with this filter")
+    parser.add_argument('--level', type=int, default=None, help="gzip compression level (0-9)")
+    parser.add_argument('--shuffle', action=argparse.BooleanOptionalAction, default=None,
+                        help="Apply the byte shuffle filter before compression")
+    parser.add_argument('--chunks', type=int, default=None, help="Chunk length of the 1-D datasets, in elements")
+    args = parser.parse_args()
+
+    options = {}
+    if args.compression is not None:
+        options['compression'] = None if args.compression == 'none' else args.compression
+    if args.level is not None:
+        options['compression_opts'] = args.level
+    if args.shuffle is not None:
+        options['shuffle'] = args.shuffle
+    if args.chunks is not None:
+        options['chunks'] = args.chunks
+
+    total = 0
+    for path in find_projects(args.paths):
+        try:
+            report = repack_project(path, options=options or None)
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}")
+            continue
+        total += report['bytes_reclaimed']
+        print(f"{path}: {report['bytes_before'] / 2 ** 20:.1f} MB -> {report['bytes_after'] / 2 ** 20:.1f} MB, "
+              f"{report['rewritten']} of {report['datasets']} datasets rewritten in {report['seconds']:.1f} s")
+    print(f"{total / 2 ** 20:.1f} MB reclaimed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# spectra_matrix.py
+import heapq
+
+import h5py
+import numpy as np
+
+from .h5_storage import make_resizable
+
+SPECTRA_GROUP = 'spectra'  # Group holding the consolidated spectra of the 'data' group
+
+_GROW_ROWS = 256  # Rows added at once when the matrix is full; unused rows are reused before growing again
+_CHUNK_BYTES = 128 * 1024  # Target size of a chunk of the counts dataset; a chunk spans whole rows
+
+
+def _counts_chunks(channels):
+    """Returns the chunk shape of a counts matrix: whole rows, about _CHUNK_BYTES per chunk."""
+    channels = max(channels, 1)
+    return max(1, _CHUNK_BYTES // (channels * np.dtype(np.int64).itemsize)), channels
+
+
+def read_rows(counts, lengths, rows):
+    """
+    Reads rows of a counts matrix and its lengths with a single selection.
+
+    Parameters:
+        counts (h5py.Dataset): A [rows, channels] counts matrix.
+        lengths (h5py.Dataset): The number of channels of each row.
+        rows (numpy.ndarray): The int64 indices of the rows to read, in any order and possibly repeated.
+
+    Returns:
+        tuple: (counts, lengths) arrays in the order of rows.
+    """
+    if rows.size == 0:
+        return np.zeros((0, counts.shape[1]), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    first, last = int(unique_rows[0]), int(unique_rows[-1]) + 1
+    if last - first <= 2 * unique_rows.size:
+        # Dense selection: one contiguous hyperslab, then pick the rows in memory
+        selected_counts = counts[first:last][unique_rows - first]
+        selected_lengths = lengths[first:last][unique_rows - first]
+    else:
+        selected_counts = counts[unique_rows, :]
+        selected_lengths = lengths[unique_rows]
+    return selected_counts[inverse], selected_lengths[inverse]
+
+
+class SpectraMatrix:
+    """
+    The channel counts of many spectra stored as the rows of a single chunked, resizable 2-D dataset.
+
+    The group holds three datasets:
+
+    - 'counts': the [rows, channels] int64 matrix. Spectra shorter than the widest one are padded with zeros,
+      and the matrix widens when a longer spectrum is added.
+    - 'names': the name of the spectrum in each row, empty for rows that are free.
+    - 'lengths': the number of channels of the spectrum in each row.
+
+    The name index is loaded into memory when the object is created, so finding the row of a spectrum costs
+    no HDF5 access, and reading many spectra is a single selection of the matrix rather than one read per group.
+    Rows freed by remove() are reused by later writes.
+
+    Attributes:
+        h5file (h5py.File): The project file the matrix is stored in.
+    """
+
+    def __init__(self, h5file):
+        """
+        Parameters:
+            h5file (h5py.File): The open project file.
+        """
+        self.h5file = h5file
+        self._rows = {}  # name -> row index
+        self._free = []  # Heap of the indices of unused rows, so the lowest is reused first
+        self._datasets = None  # Open (counts, names, lengths) datasets, kept so their chunk cache is reused
+
+        group = h5file.get(SPECTRA_GROUP)
+        if group is not None:
+            # Datasets copied without their unlimited dimensions, e.g. by a save, are made resizable again
+            channels = group['counts'].shape[1]
+            make_resizable(group, 'counts', _counts_chunks(channels))
+            make_resizable(group, 'names', (_GROW_ROWS,))
+            make_resizable(group, 'lengths', (_GROW_ROWS,))
+            names = self._open()[1].asstr()[()]
+            for row, name in enumerate(names):
+                if name:
+                    self._rows[name] = row
+                else:
+                    self._free.append(row)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def names(self):
+        """Returns the names of the stored spectra, in row order."""
+        return sorted(self._rows, key=self._rows.get)
+
+    def row(self, name):
+        """Returns the row of a spectrum, or None if it is not stored."""
+        return self._rows.get(name)
+
+    def _open(self):
+        """Returns the (counts, names, lengths) datasets, opening them once."""
+        if self._datasets is None:
+            group = self.h5file[SPECTRA_GROUP]
+            self._datasets = (group['counts'], group['names'], group['lengths'])
+        return self._datasets
+
+    def write(self, name, counts, options):
+        """
+        Stores the counts of a spectrum, replacing any spectrum of the same name. Does not flush.
+
+        Parameters:
+            name (str): The name of the spectrum.
+            counts (array-like): The 1-D channel counts.
+            options (dict): Complete storage options, used for the compression of a new matrix.
+
+        Returns:
+            int: The row the spectrum is stored in.
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        if SPECTRA_GROUP not in self.h5file:
+            self._create(counts.size, options)
+        matrix, names, lengths = self._open()
+        if counts.size > matrix.shape[1]:
+            matrix.resize((matrix.shape[0], counts.size))
+
+        row = self._rows.get(name)
+        if row is None:
+            if not self._free:
+                self._grow()
+            row = heapq.heappop(self._free)
+            self._rows[name] = row
+            names[row] = name
+
+        padded = np.zeros(matrix.shape[1], dtype=np.int64)
+        padded[:counts.size] = counts
+        matrix[row] = padded
+        lengths[row] = counts.size
+        return row
+
+    def _create(self, channels, options):
+        """Creates the empty datasets, applying the compression and shuffle storage options to the matrix."""
+        group = self.h5file.create_group(SPECTRA_GROUP)
+        kwargs = {}
+        if options['compression'] is not None:
+            kwargs['compression'] = options['compression']
+            kwargs['compression_opts'] = options['compression_opts']
+        if options['shuffle']:
+            kwargs['shuffle'] = True
+        channels = max(channels, 1)
+        group.create_dataset('counts', shape=(0, channels), maxshape=(None, None), dtype=np.int64,
+                             chunks=_counts_chunks(channels), **kwargs)
+        group.create_dataset('names', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                             chunks=(_GROW_ROWS,))
+        group.create_dataset('lengths', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(_GROW_ROWS,))
+        return group
+
+    def _grow(self):
+        """Adds _GROW_ROWS free rows at the end of the datasets."""
+        matrix, names, lengths = self._open()
+        rows = names.shape[0]
+        matrix.resize((rows + _GROW_ROWS, matrix.shape[1]))
+        names.resize((rows + _GROW_ROWS,))
+        lengths.resize((rows + _GROW_ROWS,))
+        self._free.extend(range(rows, rows + _GROW_ROWS))
+
+    def remove(self, name):
+        """Frees the row of a spectrum, if it is stored. Does not flush."""
+        row = self._rows.pop(name, None)
+        if row is None:
+            return
+        matrix, names, lengths = self._open()
+        names[row] = ''
+        lengths[row] = 0
+        matrix[row] = 0
+        heapq.heappush(self._free, row)
+
+    def read(self, name):
+        """
+        Returns the counts of a spectrum as an int64 array.
+
+        Raises:
+            KeyError: If the spectrum is not stored.
+        """
+        row = self._rows[name]
+        matrix, _, lengths = self._open()
+        return matrix[row, :lengths[row]]
+
+    def read_many(self, names):
+        """
+        Reads the counts of several spectra with a single selection of the matrix.
+
+        Parameters:
+            names (list of str): The names of stored spectra.
+
+        Returns:
+            tuple: (counts, lengths) where counts is a [len(names), channels] int64 array in the order of names,
+                   zero-padded beyond each spectrum's length, and lengths holds the number of channels of each.
+
+        Raises:
+            KeyError: If a spectrum is not stored.
+        """
+        rows = np.array([self._rows[name] for name in names], dtype=np.int64)
+        if rows.size == 0:
+            channels = self._open()[0].shape[1] if SPECTRA_GROUP in self.h5file else 0
+            return np.zeros((0, channels), dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        matrix, _, lengths = self._open()
+        return read_rows(matrix, lengths, rows)
@@ -0,0 +1,314 @@
+# spectra_shards.py
+import os
+import re
+import time
+
+import h5py
+import numpy as np
+
+from .h5_storage import create_bytes_dataset
+from .spectra_matrix import SPECTRA_GROUP, SpectraMatrix, read_rows
+
+SHARDS_GROUP = 'shards'  # Group of the project holding an external link to the root of each shard file
+SHARDED_SPECTRA_GROUP = 'sharded_spectra'  # Virtual datasets presenting the spectra of all shards as one array
+SHARD_RAW_GROUP = 'raw_content'  # Group of a shard file holding the raw contents of its files, by file name
+
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+def shard_key(shard_by, pressure=np.nan, acquisition_time=None):
+    """
+    Returns the name of the shard a spectrum belongs to, also used as the name of the shard file.
+
+    Parameters:
+        shard_by (str): 'pressure' for one shard per pressure, or 'day' for one shard per acquisition day.
+        pressure (float): The pressure of the file; NaN goes to a shard of its own.
+        acquisition_time (str or None): The ISO 8601 acquisition time from the header. Files without a date
+                                        go to the shard of the day they are written.
+    """
+    if shard_by == 'pressure':
+        return 'pressure_unknown' if np.isnan(pressure) else f"pressure_{pressure:g}"
+    if acquisition_time and _DATE.match(acquisition_time):
+        return f"day_{acquisition_time[:10]}"
+    return f"day_{time.strftime('%Y-%m-%d')}"
+
+
+class SpectraShards:
+    """
+    The spectra of a campaign split across several HDF5 files, one per shard (e.g. per pressure or per day),
+    stored in a folder next to the project.
+
+    Each shard file holds the counts of its spectra in the SpectraMatrix layout and their raw contents under
+    'raw_content/<entry>'. A spectrum is stored under an entry named after its file, or '<name>@<n>' if an
+    entry of that name is already in a shard: entries are written once and never overwritten, so the spectra
+    the saved project refers to stay intact whatever the session does until it is saved. Shards are written in
+    place, so writing a spectrum only touches its shard, and only shards that were written are opened for
+    writing. The project file is the catalog, recording the entry of each file: entries no file of the project
+    refers to are freed by release_orphans(), which the project calls once it has replaced the project file
+    when it is saved, and when it is loaded, so removing or re-importing a file and discarding the change
+    leaves the saved spectrum intact.
+
+    write_views() gives the project file an external link to each shard and virtual datasets gathering the
+    counts, lengths and names of all the shards into single arrays, readable by any HDF5 reader.
+
+    Attributes:
+        folder (str): The folder of the shard files.
+        views_stale (bool): Whether shards were written since the views of the working file were written.
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters:
+            folder (str): The folder of the shard files; it is created by the first write.
+        """
+        self.folder = folder
+        self.views_stale = True
+        self._rows = {}  # shard -> {entry: row}
+        self._shapes = {}  # shard -> shape of the counts matrix
+        self._locations = {}  # entry -> shard holding it, for the entries not discarded
+        self._writable = {}  # shard -> (h5py.File, SpectraMatrix) of the shards opened for writing
+        self._offsets = {}  # shard -> first row in the virtual datasets of the working file
+        self._pending = set()  # Entries that may have become orphans since the last release_orphans()
+
+        if os.path.isdir(folder):
+            for file_name in sorted(os.listdir(folder)):
+                if file_name.endswith('.h5'):
+                    self._load_index(file_name[:-3])
+
+    def __contains__(self, entry):
+        return entry in self._locations
+
+    def keys(self):
+        """Returns the names of the shards, sorted."""
+        return sorted(self._rows)
+
+    def path(self, key):
+        """Returns the path of the file of a shard."""
+        return os.path.join(self.folder, f"{key}.h5")
+
+    def location(self, entry):
+        """Returns the shard holding an entry, or None."""
+        return self._locations.get(entry)
+
+    def _load_index(self, key):
+        """Reads the name index of a shard without opening it for writing."""
+        with h5py.File(self.path(key), 'r') as shard:
+            group = shard.get(SPECTRA_GROUP)
+            names = group['names'].asstr()[()] if group is not None else []
+            self._shapes[key] = group['counts'].shape if group is not None else (0, 0)
+        self._rows[key] = {name: row for row, name in enumerate(names) if name}
+        for name in self._rows[key]:
+            self._locations[name] = key
+
+    def _open(self, key):
+        """Returns the (file, SpectraMatrix) of a shard opened for writing, creating the shard if needed."""
+        if key not in self._writable:
+            os.makedirs(self.folder, exist_ok=True)
+            shard = h5py.File(self.path(key), 'a')
+            self._writable[key] = (shard, SpectraMatrix(shard))
+            self._rows.setdefault(key, {})
+        return self._writable[key]
+
+    def _new_entry(self, name):
+        """Returns the entry a new spectrum of a file is stored under: its name, unless a shard holds it."""
+        entry, count = name, 0
+        while any(entry in rows for rows in self._rows.values()):
+            count += 1
+            entry = f"{name}@{count}"
+        return entry
+
+    def write(self, name, key, counts, raw_content, options):
+        """
+        Stores the counts and raw contents of a spectrum in a shard, under a new entry: spectra already stored,
+        e.g. of a file of the same name that was removed, are left until release_orphans(). Does not flush.
+
+        Parameters:
+            name (str): The name of the file.
+            key (str): The shard, see shard_key().
+            counts (array-like): The 1-D channel counts.
+            raw_content (bytes): The contents of the .DAT file.
+            options (dict): Complete storage options, applied to new shards and raw contents.
+
+        Returns:
+            str: The entry of the spectrum, to be recorded by the project for reading and releasing it.
+        """
+        entry = self._new_entry(name)
+        shard, spectra_matrix = self._open(key)
+        row = spectra_matrix.write(entry, counts, options)
+        create_bytes_dataset(shard.require_group(SHARD_RAW_GROUP), entry, raw_content, options)
+        self._rows[key][entry] = row
+        self._shapes[key] = shard[SPECTRA_GROUP]['counts'].shape
+        self._locations[entry] = key
+        self.views_stale = True
+        return entry
+
+    def discard(self, entry):
+        """
+        Forgets the spectrum of a file removed from the project. The spectrum stays in its shard until
+        release_orphans() finds that the saved project no longer refers to it.
+        """
+        if self._locations.pop(entry, None) is not None:
+            self._pending.add(entry)
+
+    def release_orphans(self, is_live, all_spectra=False):
+        """
+        Frees the spectra that no longer belong to a file of the project. Only shards holding such spectra
+        are opened for writing. Call it once the project no longer refers to them on disk, i.e. after the project
+        file is replaced when it is saved. Does not flush.
+
+        Parameters:
+            is_live (callable): Called as is_live(entry, key); returns True if a file of the project has its
+                                spectrum stored under that entry of that shard.
+            all_spectra (bool): Whether to check every spectrum, e.g. after spectra were written by a session
+                                that was not saved, or only those discarded since the last call.
+
+        Returns:
+            int: The number of spectra freed.
+        """
+        pending, self._pending = self._pending, set()
+        released = 0
+        for key in self.keys():
+            orphans = [entry for entry in self._rows[key]
+                       if (all_spectra or entry in pending) and not is_live(entry, key)]
+            if not orphans:
+                continue
+            shard, spectra_matrix = self._open(key)
+            raw_group = shard.get(SHARD_RAW_GROUP, {})
+            for entry in orphans:
+                spectra_matrix.remove(entry)
+                if entry in raw_group:
+                    del raw_group[entry]
+                del self._rows[key][entry]
+                if self._locations.get(entry) == key:
+                    # Projects written before entries were unique may hold the live spectrum in another shard
+                    holders = [other for other in self.keys() if entry in self._rows[other]]
+                    if holders:
+                        self._locations[entry] = holders[0]
+                    else:
+                        del self._locations[entry]
+            released += len(orphans)
+            self.views_stale = True
+        return released
+
+    def write_views(self, h5file, file_path):
+        """
+        Replaces the external links and virtual datasets of a project file with ones covering the current
+        shards. Paths are stored relative to the folder of the project file, so they stay valid when the
+        project folder is moved, or absolute if there is no relative path, e.g. to another drive. Does not flush.
+
+        Parameters:
+            h5file (h5py.File): The open project file.
+            file_path (str): The path of that file, used to compute the relative paths.
+
+        Returns:
+            dict: shard -> first row of its spectra in the virtual datasets.
+        """
+        for group_name in (SHARDS_GROUP, SHARDED_SPECTRA_GROUP):
+            if group_name in h5file:
+                del h5file[group_name]
+        keys = self.keys()
+        if not keys:
+            return {}
+        folder = os.path.dirname(os.path.abspath(file_path))
+        paths = {}
+        for key in keys:
+            try:
+                paths[key] = os.path.relpath(self.path(key), folder)
+            except ValueError:
+                paths[key] = os.path.abspath(self.path(key))
+
+        links = h5file.create_group(SHARDS_GROUP)
+        for key in keys:
+            links[key] = h5py.ExternalLink(paths[key], '/')
+
+        offsets, rows = {}, 0
+        for key in keys:
+            offsets[key] = rows
+            rows += self._shapes[key][0]
+        channels = max(max(self._shapes[key][1] for key in keys), 1)
+        counts = h5py.VirtualLayout(shape=(rows, channels), dtype=np.int64)
+        lengths = h5py.VirtualLayout(shape=(rows,), dtype=np.int64)
+        names = h5py.VirtualLayout(shape=(rows,), dtype=h5py.string_dtype())
+        for key in keys:
+            shard_rows, shard_channels = self._shapes[key]
+            if shard_rows == 0:
+                continue
+            first, last = offsets[key], offsets[key] + shard_rows
+            counts[first:last, :shard_channels] = h5py.VirtualSource(
+                paths[key], f'{SPECTRA_GROUP}/counts', shape=(shard_rows, shard_channels))
+            lengths[first:last] = h5py.VirtualSource(paths[key], f'{SPECTRA_GROUP}/lengths', shape=(shard_rows,))
+            names[first:last] = h5py.VirtualSource(paths[key], f'{SPECTRA_GROUP}/names', shape=(shard_rows,),
+                                                   dtype=h5py.string_dtype())
+        group = h5file.create_group(SHARDED_SPECTRA_GROUP)
+        group.create_virtual_dataset('counts', counts, fillvalue=0)
+        group.create_virtual_dataset('lengths', lengths, fillvalue=0)
+        group.create_virtual_dataset('names', names)
+        group.attrs['shards'] = keys
+        group.attrs['offsets'] = [offsets[key] for key in keys]
+        return offsets
+
+    def refresh_views(self, h5file, file_path):
+        """Rewrites the views of the working project file if shards were written since. Does not flush."""
+        if self.views_stale:
+            self._offsets = self.write_views(h5file, file_path)
+            self.views_stale = False
+
+    def read_many(self, h5file, names):
+        """
+        Reads the counts of several spectra with a single selection of the virtual counts dataset of the working
+        file, whose views must be up to date (see refresh_views()). Without a working file, e.g. one opened
+        through a file-like object, which cannot resolve the views, the shards are read with one selection each.
+
+        Parameters:
+            h5file (h5py.File or None): The working project file, or None to read the shard files.
+            names (list of str): The entries of the spectra.
+
+        Returns:
+            tuple: (counts, lengths) as returned by SpectraMatrix.read_many().
+
+        Raises:
+            KeyError: If a spectrum is not stored.
+        """
+        if h5file is None:
+            return self._read_shards(names)
+        rows = np.array([self._offsets[self._locations[name]] + self._rows[self._locations[name]][name]
+                         for name in names], dtype=np.int64)
+        if SHARDED_SPECTRA_GROUP not in h5file:
+            return np.zeros((0, 0), dtype=np.int64), np.zeros(0, dtype=np.int64)
+        group = h5file[SHARDED_SPECTRA_GROUP]
+        return read_rows(group['counts'], group['lengths'], rows)
+
+    def _read_shards(self, names):
+        """Reads the counts of several spectra from the shard files, with one selection per shard."""
+        positions = {}  # shard -> positions in names of its spectra
+        for position, name in enumerate(names):
+            positions.setdefault(self._locations[name], []).append(position)
+        parts = []
+        for key, key_positions in positions.items():
+            rows = np.array([self._rows[key][names[position]] for position in key_positions], dtype=np.int64)
+            if key in self._writable:
+                group = self._writable[key][0][SPECTRA_GROUP]
+                parts.append((key_positions, *read_rows(group['counts'], group['lengths'], rows)))
+                continue
+            with h5py.File(self.path(key), 'r') as shard:
+                group = shard[SPECTRA_GROUP]
+                parts.append((key_positions, *read_rows(group['counts'], group['lengths'], rows)))
+
+        channels = max([part_counts.shape[1] for _, part_counts, _ in parts] + [0])
+        counts = np.zeros((len(names), channels), dtype=np.int64)
+        lengths = np.zeros(len(names), dtype=np.int64)
+        for key_positions, part_counts, part_lengths in parts:
+            counts[key_positions, :part_counts.shape[1]] = part_counts
+            lengths[key_positions] = part_lengths
+        return counts, lengths
+
+    def flush(self):
+        """Flushes the shards opened for writing."""
+        for shard, _ in self._writable.values():
+            shard.flush()
+
+    def close(self):
+        """Closes the shards opened for writing."""
+        for shard, _ in self._writable.values():
+            shard.close()
+        self._writable = {}
@@ -0,0 +1,297 @@
+# spectrum_feed.py
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from .dat_parser import parse_dat_bytes
+
+DEFAULT_FEED_PORT = 5555
+FEED_QUEUE_SIZE = 256  # Spectra received but not yet written; a full queue stops reading from the senders
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Larger frames are rejected and the connection is closed
+
+# Frame layout: payload length (uint32), then the payload: send time (float64, seconds since the epoch),
+# name length (uint16), the UTF-8 name and the raw bytes of the .DAT file (header lines and counts).
+_LENGTH = struct.Struct('>I')
+_PAYLOAD_HEADER = struct.Struct('>dH')
+
+
+def encode_frame(name, raw_content, sent_at=None):
+    """
+    Encodes a spectrum as a length-prefixed frame.
+
+    Parameters:
+        name (str): The name of the spectrum, used as the dataset name in the project.
+        raw_content (bytes): The contents of the .DAT file.
+        sent_at (float or None): The send time as time.time(); defaults to now.
+
+    Returns:
+        bytes: The frame.
+    """
+    name = name.encode('utf-8')
+    payload_length = _PAYLOAD_HEADER.size + len(name) + len(raw_content)
+    header = _LENGTH.pack(payload_length) + _PAYLOAD_HEADER.pack(time.time() if sent_at is None else sent_at, len(name))
+    return header + name + raw_content
+
+
+def read_frame(stream):
+    """
+    Reads one frame from a binary stream.
+
+    Returns:
+        tuple or None: (name, raw_content, sent_at), or None if the stream ended cleanly before a frame.
+
+    Raises:
+        ValueError: If the frame is truncated, too large or malformed.
+    """
+    length = stream.read(_LENGTH.size)
+    if not length:
+        return None
+    if len(length) < _LENGTH.size:
+        raise ValueError("Truncated frame length.")
+    payload_length, = _LENGTH.unpack(length)
+    if not _PAYLOAD_HEADER.size <= payload_length <= MAX_FRAME_SIZE:
+        raise ValueError(f"Invalid frame length {payload_length}.")
+    payload = stream.read(payload_length)
+    if len(payload) < payload_length:
+        raise ValueError("Truncated frame.")
+    sent_at, name_length = _PAYLOAD_HEADER.unpack_from(payload)
+    name_end = _PAYLOAD_HEADER.size + name_length
+    if name_end > payload_length:
+        raise ValueError("Invalid frame name length.")
+    name = payload[_PAYLOAD_HEADER.size:name_end].decode('utf-8', errors='replace')
+    return name, payload[name_end:], sent_at
+
+
+class FeedItem:
+    """
+    A spectrum received from the feed, parsed on the connection thread.
+
+    Attributes:
+        name (str): The name given by the sender.
+        dat_file (DatFile or None): The parsed spectrum, None if the frame could not be used.
+        error (str): Why the frame could not be used, empty otherwise.
+        sent_at (float): The send time given by the sender (time.time()).
+        received_at (float): The time the frame was received (time.time()).
+    """
+
+    __slots__ = ('name', 'dat_file', 'error', 'sent_at', 'received_at')
+
+    def __init__(self, name, dat_file, error, sent_at, received_at):
+        self.name = name
+        self.dat_file = dat_file
+        self.error = error
+        self.sent_at = sent_at
+        self.received_at = received_at
+
+
+class _FeedHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        feed = self.server.feed
+        feed._add_connection(self.request)
+        try:
+            while not feed.stopping.is_set():
+                try:
+                    frame = read_frame(self.rfile)
+                except (OSError, ValueError):
+                    return  # Malformed stream or connection reset: drop the connection
+                if frame is None:
+                    return
+                name, raw_content, sent_at = frame
+                try:
+                    item = FeedItem(name, parse_dat_bytes(raw_content, name), '', sent_at, time.time())
+                except ValueError as e:
+                    item = FeedItem(name, None, str(e), sent_at, time.time())
+                # Blocks while the queue is full, which stops reading the socket and throttles the sender
+                while not feed.stopping.is_set():
+                    try:
+                        feed.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        finally:
+            feed._remove_connection(self.request)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    _UnixServer = None
+
+
+class SpectrumFeed:
+    """
+    Receives spectra pushed by the acquisition PC over a local TCP or Unix socket.
+
+    Each connection is served by its own thread, which reads length-prefixed frames (see encode_frame()),
+    parses them and puts them in a bounded queue. The project takes spectra from the queue with get_items();
+    while the queue is full the connection threads stop reading, so TCP flow control slows the senders down
+    instead of letting memory grow.
+    """
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_FEED_PORT), max_queue=FEED_QUEUE_SIZE):
+        """
+        Parameters:
+            address (tuple or str): (host, port) to listen on over TCP, or the path of a Unix socket.
+                                    Port 0 picks a free port, see the address attribute.
+            max_queue (int): The number of received spectra that may wait to be written.
+
+        Raises:
+            OSError: If the socket cannot be opened.
+            ValueError: If Unix sockets are not available on this platform.
+        """
+        if isinstance(address, str):
+            if _UnixServer is None:
+                raise ValueError("Unix sockets are not available on this platform.")
+            if os.path.exists(address):
+                os.remove(address)  # Stale socket left by a previous run
+            self._server = _UnixServer(address, _FeedHandler)
+        else:
+            self._server = _TCPServer(tuple(address), _FeedHandler)
+        self._server.feed = self
+        self.address = self._server.server_address
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopping = threading.Event()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _add_connection(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def _remove_connection(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def get_items(self, max_items=None):
+        """
+        Returns the spectra received so far without waiting, oldest first.
+
+        Parameters:
+            max_items (int or None): The maximum number of spectra to return.
+
+        Returns:
+            list of FeedItem: The received spectra.
+        """
+        items = []
+        while max_items is None or len(items) < max_items:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def stop(self):
+        """Stops listening, closes the open connections and discards spectra not taken from the queue yet."""
+        self.stopping.set()
+        self._server.shutdown()
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self._server.server_close()
+        self._thread.join()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def replay_folder(folder, address=('127.0.0.1', DEFAULT_FEED_PORT), rate=None, limit=None):
+    """
+    Stand-in for the acquisition PC: sends the .DAT files of a folder to a feed, in name order.
+
+    Parameters:
+        folder (str): The folder containing the .DAT files.
+        address (tuple or str): The (host, port) or Unix socket path of the feed.
+        rate (float or None): Spectra per second to send, or None to send as fast as the feed accepts them.
+        limit (int or None): The maximum number of files to send.
+
+    Returns:
+        dict: 'sent' (number of spectra), 'seconds' (time spent sending) and 'rate' (spectra per second
+              actually sustained, lower than requested if the feed applied backpressure).
+    """
+    file_names = sorted(name for name in os.listdir(folder) if name.lower().endswith('.dat'))[:limit]
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    start = time.perf_counter()
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        for index, file_name in enumerate(file_names):
+            if rate:
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            with open(os.path.join(folder, file_name), 'rb') as file:
+                raw_content = file.read()
+            sock.sendall(encode_frame(file_name, raw_content))
+    seconds = time.perf_counter() - start
+    return {'sent': len(file_names), 'seconds': seconds, 'rate': len(file_names) / seconds if seconds else 0.0}
+
+
+def main():
+    """Replays a folder of .DAT files into a feed, or measures the ingest throughput and latency of a project."""
+    import argparse
+    import tempfile
+
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description="Send .DAT files to a live acquisition feed.")
+    parser.add_argument('folder', help="Folder containing .DAT files")
+    parser.add_argument('--host', default='127.0.0.1', help="Host of the feed")
+    parser.add_argument('--port', type=int, default=DEFAULT_FEED_PORT, help="TCP port of the feed")
+    parser.add_argument('--unix', default=None, help="Unix socket path of the feed, instead of TCP")
+    parser.add_argument('--rate', type=float, default=None, help="Spectra per second (default: as fast as possible)")
+    parser.add_argument('--limit', type=int, default=None, help="Maximum number of files to send")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Ingest into a temporary project through a local feed and report throughput and latency")
+    args = parser.parse_args()
+
+    address = args.unix if args.unix else (args.host, args.port)
+    if not args.benchmark:
+        stats = replay_folder(args.folder, address, args.rate, args.limit)
+        print(f"Sent {stats['sent']} spectra in {stats['seconds']:.2f} s ({stats['rate']:.1f} spectra/s)")
+        return
+
+    from src.analysis.brillouin_project import BrillouinProject
+
+    with tempfile.TemporaryDirectory() as project_folder:
+        project = BrillouinProject(project_folder, "feed_benchmark")
+        project.create_h5file()
+        project.start_feed(('127.0.0.1', 0) if not args.unix else args.unix)
+        sender_stats = {}
+        sender = threading.Thread(target=lambda: sender_stats.update(
+            replay_folder(args.folder, project.feed.address, args.rate, args.limit)))
+        start = time.perf_counter()
+        sender.start()
+
+        latencies = []
+        while sender.is_alive() or not project.feed.queue.empty():
+            report = project.poll_feed()
+            latencies.extend(entry['written_at'] - entry['sent_at'] for entry in report)
+            if not report:
+                time.sleep(0.01)
+        seconds = time.perf_counter() - start
+        project.stop_feed()
+        project.cleanup_temp_file()
+
+    latencies = np.array(latencies) * 1000
+    print(f"Sender: {sender_stats['sent']} spectra at {sender_stats['rate']:.1f} spectra/s")
+    print(f"Ingest: {len(latencies)} spectra in {seconds:.2f} s ({len(latencies) / seconds:.1f} spectra/s)")
+    if len(latencies):
+        print(f"Latency to project (ms): median {np.median(latencies):.1f}, "
+              f"p95 {np.percentile(latencies, 95):.1f}, max {latencies.max():.1f}")
+
+
+if __name__ == '__main__':
+    main()
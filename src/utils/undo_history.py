@@ -0,0 +1,158 @@
+# undo_history.py
+import sys
+from collections import deque
+
+import h5py
+import numpy as np
+
+UNDO_MEMORY_LIMIT = 16 << 20  # Bytes of inverse calls kept by an UndoHistory, the oldest steps being forgotten beyond
+_HANDLE_BYTES = 64  # Memory counted for an HDF5 object held by an inverse call, its data staying in the file
+
+
+def estimate_size(value):
+    """
+    Returns an estimate of the memory held by an argument of an inverse call, in bytes. Arrays count their data;
+    HDF5 objects, e.g. datasets removed from the file but kept so that they can be linked back, only their handle.
+    """
+    if isinstance(value, np.ndarray):
+        return sys.getsizeof(value) + (value.nbytes if value.base is not None else 0)
+    if isinstance(value, (h5py.Group, h5py.Dataset)):
+        return _HANDLE_BYTES
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class HistoryStep:
+    """
+    A step of an UndoHistory: the inverse calls of a change, or of a group of changes.
+
+    Attributes:
+        label (str): What the step does, e.g. 'Fill column'.
+        calls (list): (operation, args, kwargs) of the inverse calls, operation being the name of a method, in the
+                      reverse of the order they are made: undoing the step makes them from the last.
+        size (int): The estimated memory held by the calls, in bytes.
+    """
+
+    __slots__ = ('label', 'calls', 'size')
+
+    def __init__(self, label):
+        self.label = label
+        self.calls = []
+        self.size = 0
+
+    def add(self, calls):
+        """Adds the inverse calls of a change, given in the order they are made."""
+        self.calls.extend(reversed(calls))
+        self.size += sum(estimate_size(call) for call in calls)
+
+
+class UndoHistory:
+    """
+    The undo and redo stacks of a project, as steps holding the calls that undo them (see HistoryStep).
+
+    Steps are recorded with record(), or gathered between begin() and end(). A new step empties the redo stack.
+    Undoing a step is making its calls between begin(label, replay='undo') and end(): the inverses of those calls,
+    recorded meanwhile, make the step that redoes it, and conversely for redo.
+
+    The steps of both stacks hold at most limit bytes together: beyond, the oldest undo steps are forgotten first,
+    then the redo steps furthest from the current state. A step larger than the limit cannot be undone.
+
+    Attributes:
+        limit (int): The memory the steps may hold, in bytes; 0 keeps no history.
+        size (int): The memory the steps hold, in bytes.
+    """
+
+    def __init__(self, limit=UNDO_MEMORY_LIMIT):
+        """
+        Parameters:
+            limit (int): The memory the steps may hold, in bytes.
+        """
+        self.limit = limit
+        self.size = 0
+        self._undo = deque()  # Steps that can be undone, the last made on the right
+        self._redo = deque()  # Steps that can be redone, the last undone on the right
+        self._step = None  # Step being gathered between begin() and end(), None if it cannot be undone
+        self._depth = 0  # Number of begin() calls not yet ended
+        self._replay = None  # Whether the step gathered is the inverse of an 'undo' or a 'redo', None for a change
+
+    def undo_label(self):
+        """Returns the label of the step undo would undo, or None."""
+        return self._undo[-1].label if self._undo else None
+
+    def redo_label(self):
+        """Returns the label of the step redo would redo, or None."""
+        return self._redo[-1].label if self._redo else None
+
+    def __len__(self):
+        return len(self._undo) + len(self._redo)
+
+    def begin(self, label, replay=None):
+        """
+        Starts gathering the changes made until the matching end() into a single step. Nested calls are part of
+        the outermost one.
+
+        Parameters:
+            label (str): The label of the step.
+            replay (str or None): 'undo' while a step is undone, or 'redo' while it is redone, see the class.
+        """
+        if not self._depth:
+            self._step = HistoryStep(label)
+            self._replay = replay
+        self._depth += 1
+
+    def end(self):
+        """Ends the step started by begin(), pushing it if it changed anything and can be undone."""
+        self._depth -= 1
+        if self._depth:
+            return
+        step, self._step = self._step, None
+        if step is not None and step.calls:
+            self._push(step, self._replay)
+
+    def record(self, label, calls):
+        """
+        Records the inverse calls of a change, as a step of its own or as part of the step being gathered.
+
+        Parameters:
+            label (str): The label of the step, if the change is a step of its own.
+            calls (list): (operation, args, kwargs) of the inverse calls, in the order they are made.
+        """
+        if self._depth:
+            if self._step is not None:
+                self._step.add(calls)
+        elif calls:
+            step = HistoryStep(label)
+            step.add(calls)
+            self._push(step, None)
+
+    def clear(self):
+        """Forgets all the steps, e.g. after a change that cannot be undone. A step being gathered is dropped."""
+        self._undo.clear()
+        self._redo.clear()
+        self._step = None
+        self.size = 0
+
+    def pop(self, redo=False):
+        """Removes and returns the step to undo, or to redo, or None if there is none."""
+        stack = self._redo if redo else self._undo
+        if not stack:
+            return None
+        step = stack.pop()
+        self.size -= step.size
+        return step
+
+    def _push(self, step, replay):
+        """Pushes a step, emptying the redo stack if it is a new change, and forgets steps beyond the limit."""
+        if replay == 'undo':
+            self._redo.append(step)
+        else:
+            if replay is None:
+                self.size -= sum(redo_step.size for redo_step in self._redo)
+                self._redo.clear()
+            self._undo.append(step)
+        self.size += step.size
+        while self.size > self.limit and (self._undo or self._redo):
+            self.size -= (self._undo or self._redo).popleft().size
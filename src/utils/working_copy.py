@@ -0,0 +1,424 @@
+# working_copy.py
+import errno
+import heapq
+import os
+import shutil
+import struct
+import sys
+
+OVERLAY_PAGE_SIZE = 4096  # Bytes of the base file copied into the delta file when they are first written
+OVERLAY_MAGIC = b'BAOVL001'  # First bytes of a delta file
+
+COPY_REFLINK = 'reflink'  # The copy shares the blocks of the source until either is written
+COPY_SPARSE = 'sparse'  # The data extents were copied by the kernel, and the holes of the source kept as holes
+COPY_FULL = 'copy'
+
+_FICLONE = 0x40049409  # Linux ioctl cloning a file, on filesystems with reflinks (Btrfs, XFS, bcachefs)
+_HEADER = struct.Struct('<8sqqqq')  # Magic, base size, base mtime (ns), size of the overlay, bytes of the base kept
+_RECORD = struct.Struct('<q')  # Page number written before each page of the delta; -1 for a free slot
+_SLOT_SIZE = _RECORD.size + OVERLAY_PAGE_SIZE
+
+
+def _reflink(source, target):
+    """Clones the source into the empty target; returns False if the platform or filesystem cannot."""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def _sparse_copy(source, target):
+    """Copies the data extents of the source with copy_file_range(); returns False if it is not supported."""
+    if not (hasattr(os, 'copy_file_range') and hasattr(os, 'SEEK_DATA')):
+        return False
+    source_fd, target_fd = source.fileno(), target.fileno()
+    size = os.fstat(source_fd).st_size
+    position = 0
+    try:
+        while position < size:
+            try:
+                start = os.lseek(source_fd, position, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # Only a hole is left
+                raise
+            end = os.lseek(source_fd, start, os.SEEK_HOLE)
+            while start < end:
+                copied = os.copy_file_range(source_fd, target_fd, end - start, start, start)
+                if copied == 0:
+                    return False
+                start += copied
+            position = end
+        os.ftruncate(target_fd, size)
+    except OSError:
+        return False
+    return True
+
+
+def reflink_file(source_path, target_path):
+    """
+    Copies a file as a reflink, sharing the blocks of the source until either is written, where the platform and
+    filesystem support it.
+
+    Parameters:
+        source_path (str): The file to copy.
+        target_path (str): The copy, replaced if it exists.
+
+    Returns:
+        bool: False, leaving no copy, if the file could not be copied as a reflink.
+    """
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        if _reflink(source, target):
+            return True
+    os.remove(target_path)
+    return False
+
+
+def copy_file(source_path, target_path):
+    """
+    Copies a file as cheaply as the filesystem allows: as a reflink sharing the blocks of the source until either
+    is written, else by the kernel skipping the holes of the source, else with a plain copy.
+
+    Parameters:
+        source_path (str): The file to copy.
+        target_path (str): The copy, replaced if it exists.
+
+    Returns:
+        str: COPY_REFLINK, COPY_SPARSE or COPY_FULL, the method used.
+    """
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        if _reflink(source, target):
+            return COPY_REFLINK
+        if _sparse_copy(source, target):
+            return COPY_SPARSE
+    shutil.copyfile(source_path, target_path)
+    return COPY_FULL
+
+
+def sync_file(path):
+    """Writes the data of a closed file from the OS caches to the disk."""
+    with open(path, 'r+b') as file:
+        os.fsync(file.fileno())
+
+
+def sync_directory(path):
+    """Writes the entries of the directory of a file to the disk, e.g. after renaming the file."""
+    if os.name == 'nt':
+        return  # Renames are made durable by the file system, and directories cannot be opened
+    descriptor = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def backup_path(path, number):
+    """Returns the path of a backup kept by replace_file(), '<path>.1' being the most recent."""
+    return f"{path}.{number}"
+
+
+def replace_file(partial_path, path, backups=0):
+    """
+    Atomically replaces a file with a complete new version written next to it: the new version is synced to the
+    disk, then renamed over the file, so that after a crash the path holds either version in full.
+
+    The previous versions are kept as backup_path(path, 1) to backup_path(path, backups), the oldest being
+    dropped. The file being replaced becomes the first backup through a hard link, so the path never goes
+    missing, or where hard links are not supported, by a rename just before the new version takes its place.
+
+    Parameters:
+        partial_path (str): The new version, closed, in the directory of path.
+        path (str): The file to replace; it may not exist yet.
+        backups (int): The number of previous versions to keep.
+    """
+    sync_file(partial_path)
+    if backups > 0 and os.path.exists(path):
+        for number in range(backups, 1, -1):
+            if os.path.exists(backup_path(path, number - 1)):
+                os.replace(backup_path(path, number - 1), backup_path(path, number))
+        first_backup = backup_path(path, 1)
+        if os.path.exists(first_backup):
+            os.remove(first_backup)
+        try:
+            os.link(path, first_backup)
+        except OSError:
+            os.replace(path, first_backup)
+    os.replace(partial_path, path)
+    sync_directory(path)
+
+
+def apply_delta(delta_path, path):
+    """
+    Writes the pages of the delta file of an OverlayFile into its base file, which then holds what was read through
+    the overlay, and syncs it to the disk. The delta then records the file as its base, see delta_matches().
+    Applying a delta again, e.g. after a crash while it was applied, gives the same file.
+
+    Parameters:
+        delta_path (str): The delta file, closed.
+        path (str): The base file of the delta, or a file left by applying it partly.
+
+    Returns:
+        int: The number of bytes written.
+
+    Raises:
+        OSError: If the delta file is damaged.
+    """
+    written = 0
+    with open(delta_path, 'r+b') as delta, open(path, 'r+b') as target:
+        header = delta.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:len(OVERLAY_MAGIC)] != OVERLAY_MAGIC:
+            raise OSError(f"{delta_path} is not a delta file.")
+        _, _, _, size, base_limit = _HEADER.unpack(header)
+        if os.fstat(target.fileno()).st_size > base_limit:
+            target.truncate(base_limit)  # Bytes past the limit and in no page read as zeros through the overlay
+        while True:
+            slot = delta.read(_SLOT_SIZE)
+            if len(slot) < _SLOT_SIZE:
+                break
+            page, = _RECORD.unpack(slot[:_RECORD.size])
+            if page >= 0:
+                target.seek(page * OVERLAY_PAGE_SIZE)
+                target.write(slot[_RECORD.size:])
+                written += OVERLAY_PAGE_SIZE
+        target.truncate(size)
+        target.flush()
+        os.fsync(target.fileno())
+        stat = os.fstat(target.fileno())
+        delta.seek(0)
+        delta.write(_HEADER.pack(OVERLAY_MAGIC, stat.st_size, stat.st_mtime_ns, size, base_limit))
+    return written
+
+
+def delta_matches(delta_path, path):
+    """
+    Returns True if a file is still the version recorded as the base of a delta file, i.e. has the same size and
+    modification time, e.g. the version a delta produced when it was applied with apply_delta().
+    """
+    try:
+        with open(delta_path, 'rb') as delta:
+            header = delta.read(_HEADER.size)
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if len(header) < _HEADER.size:
+        return False
+    magic, base_size, base_mtime, _, _ = _HEADER.unpack(header)
+    return magic == OVERLAY_MAGIC and (base_size, base_mtime) == (stat.st_size, stat.st_mtime_ns)
+
+
+class OverlayFile:
+    """
+    A copy-on-write view of a file, opened by h5py as a file-like object: reads come from the base file, which is
+    never written, except for the pages written through the overlay, which are kept in a delta file. Opening it
+    costs the same whatever the size of the base, and the delta only grows with the pages written.
+
+    The delta file starts with a header identifying the base by its size and modification time, followed by
+    slots holding a page number and the contents of that page. Pages are written in place, and the header by
+    flush(), so a delta left behind by a session that ended without closing it can be reopened.
+
+    Attributes:
+        base_path (str): The file the overlay reads from.
+        delta_path (str): The file holding the pages written.
+    """
+
+    def __init__(self, base_path, delta_path, resume=False):
+        """
+        Parameters:
+            base_path (str): The file the overlay reads from.
+            delta_path (str): The file holding the pages written, created or replaced unless resume is True.
+            resume (bool): Whether to reopen an existing delta file, keeping its pages.
+
+        Raises:
+            OSError: If the base cannot be opened, or resume is True and the delta cannot be opened, is damaged,
+                     or was written over another version of the base.
+        """
+        self.base_path = base_path
+        self.delta_path = delta_path
+        self._position = 0
+        self._slots = {}  # Page number -> slot of the delta holding it
+        self._free_slots = []  # Heap of the slots of pages truncated away, reused before the delta grows
+        self._slot_count = 0
+        self._header_stale = False
+
+        stat = os.stat(base_path)
+        self._base_id = (stat.st_size, stat.st_mtime_ns)
+        self._base = open(base_path, 'rb')
+        try:
+            if resume:
+                self._delta = open(delta_path, 'r+b')
+                self._load_delta()
+            else:
+                self._delta = open(delta_path, 'w+b')
+                self._size = self._base_limit = stat.st_size  # Bytes past _base_limit read as zeros
+                self._write_header()
+        except (OSError, ValueError) as e:
+            self._base.close()
+            if hasattr(self, '_delta'):
+                self._delta.close()
+            raise e if isinstance(e, OSError) else OSError(str(e))
+
+    def _load_delta(self):
+        """Reads the header and page numbers of an existing delta file."""
+        header = self._delta.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{self.delta_path} is damaged.")
+        magic, base_size, base_mtime, self._size, self._base_limit = _HEADER.unpack(header)
+        if magic != OVERLAY_MAGIC:
+            raise ValueError(f"{self.delta_path} is not a delta file.")
+        if (base_size, base_mtime) != self._base_id:
+            raise ValueError(f"{self.base_path} has changed since the changes in {self.delta_path} were made.")
+        # A slot cut short by a crash is ignored and overwritten by the next page
+        self._slot_count = (os.fstat(self._delta.fileno()).st_size - _HEADER.size) // _SLOT_SIZE
+        for slot in range(self._slot_count):
+            self._delta.seek(_HEADER.size + slot * _SLOT_SIZE)
+            page, = _RECORD.unpack(self._delta.read(_RECORD.size))
+            if page < 0:
+                self._free_slots.append(slot)
+            else:
+                self._slots[page] = slot
+
+    def _write_header(self):
+        self._delta.seek(0)
+        self._delta.write(_HEADER.pack(OVERLAY_MAGIC, *self._base_id, self._size, self._base_limit))
+        self._header_stale = False
+
+    @property
+    def delta_size(self):
+        """The size of the delta file in bytes."""
+        return _HEADER.size + self._slot_count * _SLOT_SIZE
+
+    def _read_at(self, offset, view):
+        """Fills a memoryview with the bytes of the overlay starting at offset, reading runs of the base at once."""
+        done, count = 0, len(view)
+        while done < count:
+            page, start = divmod(offset + done, OVERLAY_PAGE_SIZE)
+            slot = self._slots.get(page)
+            if slot is not None:
+                length = min(OVERLAY_PAGE_SIZE - start, count - done)
+                self._delta.seek(_HEADER.size + slot * _SLOT_SIZE + _RECORD.size + start)
+                self._delta.readinto(view[done:done + length])
+            else:
+                next_page = page + 1
+                while next_page * OVERLAY_PAGE_SIZE < offset + count and next_page not in self._slots:
+                    next_page += 1
+                length = min(next_page * OVERLAY_PAGE_SIZE, offset + count) - (offset + done)
+                from_base = max(0, min(length, self._base_limit - (offset + done)))
+                if from_base:
+                    self._base.seek(offset + done)
+                    self._base.readinto(view[done:done + from_base])
+                view[done + from_base:done + length] = bytes(length - from_base)
+            done += length
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        count = max(0, min(len(view), self._size - self._position))
+        self._read_at(self._position, view[:count])
+        self._position += count
+        return count
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, self._size - self._position)
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def _new_slot(self, page):
+        """Returns a free slot of the delta for a page, writing the page number into it."""
+        if self._free_slots:
+            slot = heapq.heappop(self._free_slots)
+        else:
+            slot = self._slot_count
+            self._slot_count += 1
+        self._delta.seek(_HEADER.size + slot * _SLOT_SIZE)
+        self._delta.write(_RECORD.pack(page))
+        self._slots[page] = slot
+        return slot
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        offset, done = self._position, 0
+        while done < len(view):
+            page, start = divmod(offset + done, OVERLAY_PAGE_SIZE)
+            length = min(OVERLAY_PAGE_SIZE - start, len(view) - done)
+            slot = self._slots.get(page)
+            if slot is None:
+                if length < OVERLAY_PAGE_SIZE:
+                    # The first write to a page copies the rest of it from the base
+                    contents = bytearray(OVERLAY_PAGE_SIZE)
+                    self._read_at(page * OVERLAY_PAGE_SIZE, memoryview(contents))
+                    contents[start:start + length] = view[done:done + length]
+                    self._new_slot(page)
+                    self._delta.write(contents)
+                else:
+                    self._new_slot(page)
+                    self._delta.write(view[done:done + length])
+            else:
+                self._delta.seek(_HEADER.size + slot * _SLOT_SIZE + _RECORD.size + start)
+                self._delta.write(view[done:done + length])
+            done += length
+        self._position += len(view)
+        if self._position > self._size:
+            self._size = self._position
+            self._header_stale = True
+        return len(view)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size=None):
+        size = self._position if size is None else size
+        if size < self._size:
+            # Pages past the new end are freed and the rest of the last page is zeroed, so that growing the
+            # overlay again reads zeros there
+            first_free = -(-size // OVERLAY_PAGE_SIZE)
+            for page in [page for page in self._slots if page >= first_free]:
+                slot = self._slots.pop(page)
+                self._delta.seek(_HEADER.size + slot * _SLOT_SIZE)
+                self._delta.write(_RECORD.pack(-1))
+                heapq.heappush(self._free_slots, slot)
+            page, start = divmod(size, OVERLAY_PAGE_SIZE)
+            if start and page in self._slots:
+                self._delta.seek(_HEADER.size + self._slots[page] * _SLOT_SIZE + _RECORD.size + start)
+                self._delta.write(bytes(OVERLAY_PAGE_SIZE - start))
+            self._base_limit = min(self._base_limit, size)
+        if size != self._size:
+            self._size = size
+            self._header_stale = True
+        return size
+
+    def flush(self):
+        if self._header_stale:
+            self._write_header()
+        self._delta.flush()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self._delta.closed
+
+    def close(self):
+        """Closes the base and delta files, keeping the delta file."""
+        if not self._delta.closed:
+            self.flush()
+            self._delta.close()
+            self._base.close()
@@ -1,6 +1,11 @@
 import unittest
 import os
 import shutil
+import socket
+import tarfile
+import threading
+import time
+import zipfile
 import numpy as np
 from tempfile import TemporaryDirectory
 import sys
@@ -11,6 +16,35 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../s
 
 # Now import the BrillouinProject class
 from brillouin_project import BrillouinProject
+from src.analysis.file_table_model import FileTableModel
+from src.utils.archive_reader import ArchiveReader
+from src.utils.project_migration import migrate_project, migrate_projects, read_schema_version
+from src.utils.project_repack import repack_project
+from src.utils.spectrum_feed import encode_frame, replay_folder
+
+
+def snapshot(h5file):
+    """Returns every link, attribute and value below the root of a file, for comparing files."""
+    items = {'/': sorted((key, repr(np.asarray(value).tolist())) for key, value in h5file.attrs.items())}
+
+    def visit(group):
+        for name in group:
+            path = f"{group.name.rstrip('/')}/{name}"
+            link = group.get(name, getlink=True)
+            if isinstance(link, h5py.SoftLink):
+                items[path] = link.path
+                continue
+            item = group[name]
+            attrs = sorted((key, repr(np.asarray(value).tolist())) for key, value in item.attrs.items())
+            if isinstance(item, h5py.Group):
+                items[path] = attrs
+                visit(item)
+            else:
+                items[path] = (attrs, repr(np.asarray(item[()]).tolist()))
+
+    visit(h5file)
+    return items
+
 
 class TestBrillouinProject(unittest.TestCase):
 
@@ -122,6 +156,1221 @@ class TestBrillouinProject(unittest.TestCase):
         self.project.save_project()
         self.assertFalse(self.project.check_unsaved_changes())
 
+    def test_import_files_report(self):
+        # Create a valid file, a file without counts, and a path that does not exist
+        dat_file_path_1 = os.path.join(self.test_dir.name, "test_data_1.dat")
+        dat_file_path_2 = os.path.join(self.test_dir.name, "test_data_2.dat")
+        missing_path = os.path.join(self.test_dir.name, "missing.dat")
+
+        with open(dat_file_path_1, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("1\n2\n3\n4\n5\n")
+
+        with open(dat_file_path_2, "w") as f:
+            f.write("Header line\n" * 12)
+
+        report = self.project.import_files([dat_file_path_1, dat_file_path_2, missing_path, dat_file_path_1],
+                                           pressure=1.5, crystal="olivine", max_workers=2)
+
+        # One entry per path, in input order
+        self.assertEqual([entry['status'] for entry in report], ['imported', 'failed', 'failed', 'skipped'])
+
+        group = self.project.h5file['data']["test_data_1.dat"]
+        self.assertTrue(np.array_equal(group['original_data'][:], np.array([1, 2, 3, 4, 5])))
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data_1.dat", 'pressure'), 1.5)
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data_1.dat", 'crystal'), "olivine")
+        self.assertNotIn("test_data_2.dat", self.project.h5file['data'])
+
+    def test_import_files_progress_and_cancel(self):
+        file_paths = []
+        for i in range(5):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write("1\n2\n3\n")
+            file_paths.append(dat_file_path)
+
+        # Cancel the import once two files have been handled
+        cancel_event = threading.Event()
+        progress = []
+
+        def progress_callback(done, total, entry):
+            progress.append((done, total, entry['status']))
+            if done == 2:
+                cancel_event.set()
+
+        report = self.project.import_files(file_paths, progress_callback=progress_callback,
+                                           cancel_event=cancel_event, max_workers=1)
+
+        self.assertEqual([entry['status'] for entry in report], ['imported'] * 2 + ['cancelled'] * 3)
+        self.assertEqual([done for done, total, status in progress], [1, 2, 3, 4, 5])
+        self.assertTrue(all(total == 5 for done, total, status in progress))
+        self.assertEqual(self.project.get_file_count(), 2)
+
+    def test_import_files_to_calibration(self):
+        dat_file_path = os.path.join(self.test_dir.name, "calib.dat")
+        with open(dat_file_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("7\n8\n9\n")
+
+        self.project.add_calibration("calib_1")
+        report = self.project.import_files_to_calibration("calib_1", [dat_file_path, dat_file_path])
+
+        self.assertEqual([entry['status'] for entry in report], ['imported', 'skipped'])
+        self.assertEqual(report[0]['channels'], 3)
+        self.assertTrue(np.array_equal(self.project.get_calibration_file_data("calib_1", "calib.dat"),
+                                       np.array([7, 8, 9])))
+
+    def test_blob_deduplication(self):
+        # The same payload under two names, added to the data group and to a calibration
+        dat_file_path_1 = os.path.join(self.test_dir.name, "test_data_1.dat")
+        dat_file_path_2 = os.path.join(self.test_dir.name, "test_data_2.dat")
+        for dat_file_path in [dat_file_path_1, dat_file_path_2]:
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write("1\n2\n3\n4\n5\n")
+
+        self.project.import_files([dat_file_path_1, dat_file_path_2])
+        self.project.add_calibration("calib_1")
+        self.project.add_file_to_calibration("calib_1", dat_file_path_1)
+
+        statistics = self.project.get_blob_statistics()
+        self.assertEqual(statistics['blobs'], 1)
+        self.assertEqual(statistics['references'], 3)
+        self.assertEqual(statistics['saved_bytes'], 2 * statistics['stored_bytes'])
+
+        # Readers see the payload as if it were stored in each group
+        self.assertTrue(np.array_equal(self.project.h5file['data']["test_data_2.dat"]['original_data'][:],
+                                       np.array([1, 2, 3, 4, 5])))
+        self.assertTrue(np.array_equal(self.project.get_calibration_file_data("calib_1", "test_data_1.dat"),
+                                       np.array([1, 2, 3, 4, 5])))
+
+        # References survive a rename and a save
+        self.project.rename_calibration("calib_1", "calib_2")
+        self.project.save_project()
+        self.project.h5file.close()
+        self.project.h5file = None
+        self.project.load_h5file()
+        self.project.save_project()
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            link = h5file['data']["test_data_1.dat"].get('original_data', getlink=True)
+            self.assertIsInstance(link, h5py.SoftLink)
+            self.assertEqual(len(h5file['blobs']), 1)
+
+        # The blob is deleted once its last reference is removed
+        self.project.remove_dataset("test_data_1.dat")
+        self.project.remove_calibration("calib_2")
+        self.assertEqual(self.project.get_blob_statistics()['references'], 1)
+        self.project.remove_dataset("test_data_2.dat")
+        self.assertEqual(self.project.get_blob_statistics()['blobs'], 0)
+
+    def test_rename_calibration(self):
+        dat_file_path = os.path.join(self.test_dir.name, "calib.dat")
+        with open(dat_file_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("1\n2\n3\n")
+
+        self.project.add_calibration("calib_1", mirror_spacing=5.0)
+        self.project.add_file_to_calibration("calib_1", dat_file_path)
+        old_group = self.project.h5file['calibrations']['calib_1']
+        old_address = h5py.h5o.get_info(old_group.id).addr
+
+        # The group itself is renamed, keeping its attributes and contents
+        self.project.rename_calibration("calib_1", "calib_2")
+        calibrations = self.project.h5file['calibrations']
+        self.assertNotIn("calib_1", calibrations)
+        self.assertEqual(h5py.h5o.get_info(calibrations['calib_2'].id).addr, old_address)
+        self.assertEqual(calibrations['calib_2'].attrs['mirror_spacing'], 5.0)
+        self.assertTrue(np.array_equal(self.project.get_calibration_file_data("calib_2", "calib.dat"),
+                                       np.array([1, 2, 3])))
+
+        self.project.add_calibration("calib_3")
+        with self.assertRaises(ValueError):
+            self.project.rename_calibration("calib_1", "calib_4")
+        with self.assertRaises(ValueError):
+            self.project.rename_calibration("calib_2", "calib_3")
+        self.assertIn("calib_2", calibrations)
+
+    def test_storage_options(self):
+        dat_file_path = os.path.join(self.test_dir.name, "calib.dat")
+        with open(dat_file_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("1\n200\n60000\n")
+
+        self.project.set_storage_options(compression='lzf', shuffle=True, narrow_dtype=True)
+        self.project.add_calibration("calib_1")
+        self.project.add_file_to_calibration("calib_1", dat_file_path)
+
+        # Counts are stored narrowed and compressed but read back as int64
+        dataset = self.project.h5file['calibrations']['calib_1']["calib.dat"]['original_data']
+        self.assertEqual(dataset.dtype, np.uint16)
+        self.assertEqual(dataset.compression, 'lzf')
+        data = self.project.get_calibration_file_data("calib_1", "calib.dat")
+        self.assertEqual(data.dtype, np.int64)
+        self.assertTrue(np.array_equal(data, np.array([1, 200, 60000])))
+
+        # Datasets written before storage options existed are read transparently
+        legacy_group = self.project.h5file['calibrations']['calib_1'].create_group("legacy.dat")
+        legacy_group.create_dataset('original_data', data=[4, 5, 6])
+        self.assertTrue(np.array_equal(self.project.get_calibration_file_data("calib_1", "legacy.dat"),
+                                       np.array([4, 5, 6])))
+
+        # The options are saved with the project
+        self.project.save_project()
+        reloaded = BrillouinProject(folder=self.test_dir.name, project_name=self.project_name)
+        self.project.h5file.close()
+        self.project.h5file = None
+        reloaded.load_h5file()
+        self.assertEqual(reloaded.get_storage_options()['compression'], 'lzf')
+        # The datasets keep their filters and dtype when saved
+        dataset = reloaded.h5file['calibrations']['calib_1']["calib.dat"]['original_data']
+        self.assertEqual(dataset.compression, 'lzf')
+        self.assertTrue(dataset.shuffle)
+        self.assertEqual(dataset.dtype, np.uint16)
+        reloaded.h5file.close()
+
+        with self.assertRaises(ValueError):
+            BrillouinProject(self.test_dir.name, "other", storage_options={'compression': 'zstd'})
+
+    def test_watch_folder(self):
+        watch_dir = os.path.join(self.test_dir.name, "spectrometer")
+        os.makedirs(watch_dir)
+        existing_path = os.path.join(watch_dir, "existing.dat")
+        with open(existing_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("1\n2\n3\n")
+
+        self.project.start_watch_folder(watch_dir, settle_time=10.0)
+        watcher = self.project.folder_watcher
+
+        # A file being written is only reported once it has stopped changing for the settle time
+        new_path = os.path.join(watch_dir, "new.dat")
+        with open(new_path, "w") as f:
+            f.write("Header line\n" * 12)
+        self.assertEqual(watcher.poll(now=0.0), [])
+        with open(new_path, "a") as f:
+            f.write("4\n5\n6\n")
+        self.assertEqual(watcher.poll(now=8.0), [])
+        self.assertEqual(watcher.poll(now=15.0), [])
+        self.assertEqual(watcher.poll(now=18.0), [new_path])
+        self.assertEqual(watcher.poll(now=30.0), [])
+
+        # poll_watch_folder imports ready files with the given pressure and crystal, skipping existing ones
+        self.project.start_watch_folder(watch_dir, settle_time=0.0, include_existing=True)
+        self.assertEqual(self.project.poll_watch_folder(pressure=2.0, crystal="olivine"), [])
+        report = self.project.poll_watch_folder(pressure=2.0, crystal="olivine")
+        self.assertEqual([(entry['name'], entry['status']) for entry in report],
+                         [("existing.dat", 'imported'), ("new.dat", 'imported')])
+        self.assertEqual(self.project.get_metadata_from_dataset("new.dat", 'crystal'), "olivine")
+        self.assertEqual(self.project.poll_watch_folder(), [])
+
+        self.project.stop_watch_folder()
+        with self.assertRaises(ValueError):
+            self.project.poll_watch_folder()
+
+    def test_register_files(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+
+        report = self.project.register_files(file_paths, pressure=3.0, crystal="olivine")
+        self.assertEqual([entry['status'] for entry in report], ['imported'] * 3)
+
+        # Only the file record is stored until the data is first needed
+        group = self.project.h5file['data']["test_data_0.dat"]
+        self.assertNotIn('original_data', group)
+        self.assertEqual(group.attrs['source_path'], os.path.abspath(file_paths[0]))
+        self.assertEqual(self.project.find_files_by_pressure_and_crystal(3.0, "olivine"),
+                         ["test_data_0.dat", "test_data_1.dat", "test_data_2.dat"])
+        self.assertEqual(sorted(self.project.list_registered_files()),
+                         ["test_data_0.dat", "test_data_1.dat", "test_data_2.dat"])
+
+        self.assertTrue(np.array_equal(self.project.get_file_data("test_data_0.dat"), np.array([0, 2, 3])))
+        self.assertIn('original_data', group)
+
+        # Registered calibration files are read by get_calibration_file_data
+        self.project.add_calibration("calib_1")
+        self.project.register_files_to_calibration("calib_1", [file_paths[1]])
+        self.assertTrue(np.array_equal(self.project.get_calibration_file_data("calib_1", "test_data_1.dat"),
+                                       np.array([1, 2, 3])))
+
+        # A file modified after registration is refused, the others are materialized in bulk
+        with open(file_paths[2], "a") as f:
+            f.write("4\n")
+        report = self.project.materialize_files()
+        self.assertEqual([(entry['name'], entry['status']) for entry in report],
+                         [("test_data_1.dat", 'imported'), ("test_data_2.dat", 'failed')])
+        self.assertEqual(self.project.list_registered_files(), ["test_data_2.dat"])
+        with self.assertRaises(ValueError):
+            self.project.get_file_data("test_data_2.dat")
+
+    def test_header_metadata(self):
+        dat_file_path = os.path.join(self.test_dir.name, "test_data.dat")
+        with open(dat_file_path, "w") as f:
+            f.write("Scans: 120\nAcquisition time: 2024-03-14 10:22:05\n")
+            f.write("Header line\n" * 10)
+            f.write("1\n2\n3\n")
+
+        report = self.project.import_files([dat_file_path])
+        self.assertEqual(report[0]['scans'], 120.0)  # Given to the table without reading the project
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data.dat", 'scans'), 120)
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data.dat", 'acquisition_time'),
+                         "2024-03-14T10:22:05")
+        self.assertEqual(self.project.find_datasets_by_metadata('acquisition_time', "2024-03-14T10:22:05"),
+                         ["test_data.dat"])
+        self.assertEqual(self.project.get_header_metadata("test_data.dat")['scans'], 120)
+
+        # Registered files get their header fields when they are first read
+        self.project.add_calibration("calib_1")
+        self.project.register_files_to_calibration("calib_1", [dat_file_path])
+        self.project.get_calibration_file_data("calib_1", "test_data.dat")
+        group = self.project.h5file['calibrations']['calib_1']["test_data.dat"]
+        self.assertEqual(group.attrs['acquisition_time'], "2024-03-14T10:22:05")
+
+    def test_import_manifest(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+
+        # Cancel after the first file, as if the import had been interrupted
+        cancel_event = threading.Event()
+        self.project.import_files(file_paths, max_workers=1, cancel_event=cancel_event,
+                                  progress_callback=lambda done, total, entry: cancel_event.set())
+
+        # Simulate a crash: the temporary file is left behind without saving
+        self.project.h5file.close()
+        self.project.h5file = None
+        recovered = BrillouinProject(folder=self.test_dir.name, project_name=self.project_name)
+        self.assertTrue(recovered.has_recoverable_session())
+        recovered.load_h5file(recover=True)
+        self.project = recovered
+
+        # Re-running the import resumes: the first file is skipped without being read
+        report = self.project.import_files(file_paths)
+        self.assertEqual([entry['status'] for entry in report], ['skipped', 'imported', 'imported'])
+        self.assertEqual(report[0]['message'], "Unchanged since it was last imported.")
+        manifest = self.project.get_import_manifest('/data')
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(manifest[0]['path'], os.path.abspath(file_paths[0]))
+        self.assertEqual(manifest[0]['status'], 'imported')
+
+        # The manifest survives a save, and a file rewritten with different contents is a conflict
+        self.project.save_project()
+        with open(file_paths[2], "a") as f:
+            f.write("4\n")
+        report = self.project.import_files(file_paths)
+        self.assertEqual([entry['status'] for entry in report], ['skipped', 'skipped', 'conflict'])
+        self.assertEqual(self.project.get_import_manifest('/data')[2]['status'], 'conflict')
+
+    def test_import_archives(self):
+        zip_path = os.path.join(self.test_dir.name, "run_1.zip")
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for i in range(3):
+                zip_file.writestr(f"run_1/zip_{i}.DAT", "Header line\n" * 12 + f"{i}\n2\n3\n")
+            zip_file.writestr("run_1/notes.txt", "not a spectrum")
+
+        tar_path = os.path.join(self.test_dir.name, "run_2.tar.gz")
+        dat_file_path = os.path.join(self.test_dir.name, "tar_0.DAT")
+        with open(dat_file_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("7\n8\n9\n")
+        with tarfile.open(tar_path, 'w:gz') as tar_file:
+            tar_file.add(dat_file_path, arcname="tar_0.DAT")
+        plain_tar_path = os.path.join(self.test_dir.name, "run_3.tar")
+        with tarfile.open(plain_tar_path, 'w') as tar_file:
+            tar_file.add(dat_file_path, arcname="run_3/tar_1.DAT")
+        os.remove(dat_file_path)
+
+        # A small compressed tar is decompressed once: listing it keeps the members, so it is not read again
+        compressed_copy = os.path.join(self.test_dir.name, "copy.tar.gz")
+        shutil.copy(tar_path, compressed_copy)
+        with ArchiveReader(compressed_copy) as reader:
+            os.remove(compressed_copy)
+            self.assertEqual([reader.read(path).counts.tolist() for path in reader], [[7, 8, 9]])
+
+        broken_path = os.path.join(self.test_dir.name, "broken.zip")
+        with open(broken_path, "wb") as f:
+            f.write(b"not an archive")
+
+        report = self.project.import_files([zip_path, tar_path, plain_tar_path, broken_path], max_workers=2)
+        self.assertEqual([(entry['name'], entry['status']) for entry in report],
+                         [("zip_0.DAT", 'imported'), ("zip_1.DAT", 'imported'), ("zip_2.DAT", 'imported'),
+                          ("tar_0.DAT", 'imported'), ("tar_1.DAT", 'imported'), ("broken.zip", 'failed')])
+        self.assertEqual(report[0]['file_path'], os.path.join(zip_path, "run_1/zip_0.DAT"))
+        self.assertTrue(np.array_equal(self.project.get_file_data("tar_0.DAT"), np.array([7, 8, 9])))
+
+        # Importing the same archive again finds identical contents
+        report = self.project.import_files([zip_path])
+        self.assertEqual([entry['status'] for entry in report], ['skipped'] * 3)
+
+        # Archives cannot be registered since their members could not be read lazily
+        report = self.project.register_files([zip_path])
+        self.assertEqual(report[0]['status'], 'failed')
+
+    def test_spectrum_feed(self):
+        feed_dir = os.path.join(self.test_dir.name, "acquisition")
+        os.makedirs(feed_dir)
+        for i in range(5):
+            with open(os.path.join(feed_dir, f"spectrum_{i}.DAT"), "w") as f:
+                f.write("Scans: 10\n" + "Header line\n" * 11)
+                f.write(f"{i}\n2\n3\n")
+
+        # A queue smaller than the number of spectra makes the sender wait for the project
+        address = self.project.start_feed(('127.0.0.1', 0), max_queue=2)
+        sender_stats = {}
+        sender = threading.Thread(target=lambda: sender_stats.update(replay_folder(feed_dir, address)))
+        sender.start()
+
+        report = []
+        deadline = time.monotonic() + 10
+        while len(report) < 5 and time.monotonic() < deadline:
+            report.extend(self.project.poll_feed(pressure=1.0, crystal="olivine", max_spectra=2))
+            time.sleep(0.01)
+        sender.join()
+
+        self.assertEqual(sender_stats['sent'], 5)
+        self.assertEqual([(entry['name'], entry['status']) for entry in report],
+                         [(f"spectrum_{i}.DAT", 'imported') for i in range(5)])
+        self.assertTrue(all(entry['sent_at'] <= entry['received_at'] <= entry['written_at'] for entry in report))
+        self.assertTrue(np.array_equal(self.project.get_file_data("spectrum_3.DAT"), np.array([3, 2, 3])))
+        self.assertEqual(self.project.get_metadata_from_dataset("spectrum_3.DAT", 'scans'), 10)
+
+        # Frames without counts are reported as failed
+        with socket.create_connection(address) as sock:
+            sock.sendall(encode_frame("empty.DAT", b"Header line\n" * 12))
+        report = []
+        deadline = time.monotonic() + 10
+        while not report and time.monotonic() < deadline:
+            report = self.project.poll_feed()
+            time.sleep(0.01)
+        self.assertEqual(report[0]['status'], 'failed')
+
+        self.project.stop_feed()
+        with self.assertRaises(ValueError):
+            self.project.poll_feed()
+
+    def test_spectra_matrix(self):
+        file_paths = []
+        for i in range(4):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write("\n".join(str(i + k) for k in range(3 + i)) + "\n")
+            file_paths.append(dat_file_path)
+
+        # Files imported with the groups layout are moved into the matrix; the counts left in the blob store are
+        # deleted, except those of blobs a calibration file links too
+        self.project.import_files(file_paths[:2])
+        self.project.add_calibration("calib_1")
+        self.project.add_file_to_calibration("calib_1", file_paths[1])
+        stored_bytes = self.project.get_blob_statistics()['stored_bytes']
+        counts_bytes = self.project.h5file['data']["test_data_0.dat"]['original_data'].nbytes
+        self.assertEqual(self.project.consolidate_spectra(), 2)
+        blob_0 = self.project.h5file['data']["test_data_0.dat"].attrs['blob']
+        blob_1 = self.project.h5file['data']["test_data_1.dat"].attrs['blob']
+        self.assertNotIn('original_data', self.project.h5file['blobs'][blob_0])
+        self.assertIn('original_data', self.project.h5file['blobs'][blob_1])
+        self.assertEqual(self.project.get_blob_statistics()['stored_bytes'], stored_bytes - counts_bytes)
+        self.assertTrue(np.array_equal(self.project.get_calibration_file_data("calib_1", "test_data_1.dat"),
+                                       np.array([1, 2, 3, 4])))
+        self.assertTrue(np.array_equal(self.project.get_file_data("test_data_0.dat"), np.array([0, 1, 2])))
+        self.assertEqual(self.project.get_storage_options()['spectra_layout'], 'matrix')
+        self.project.import_files(file_paths[2:])
+        self.assertNotIn('original_data', self.project.h5file['data']["test_data_3.dat"])
+        self.assertEqual(self.project.h5file['spectra']['counts'].shape[1], 6)
+
+        # Per-file and bulk reads return the counts without the padding
+        self.assertTrue(np.array_equal(self.project.get_file_data("test_data_1.dat"), np.array([1, 2, 3, 4])))
+        counts, lengths = self.project.get_spectra(["test_data_3.dat", "test_data_0.dat"])
+        self.assertTrue(np.array_equal(lengths, np.array([6, 3])))
+        self.assertTrue(np.array_equal(counts[1], np.array([0, 1, 2, 0, 0, 0])))
+
+        # Removed rows are reused, and the matrix stays resizable after a save
+        self.project.remove_dataset("test_data_0.dat")
+        self.project.save_project()
+        self.project.h5file.close()
+        self.project.h5file = None
+        self.project.load_h5file()
+        self.project.import_files([file_paths[0]])
+        self.assertEqual(self.project.spectra_matrix.row("test_data_0.dat"), 0)
+        counts, lengths = self.project.get_spectra()
+        self.assertEqual(counts.shape, (4, 6))
+
+        # Files stored in their own group are read along with the matrix
+        legacy_group = self.project.h5file['data'].create_group("legacy.dat")
+        legacy_group.create_dataset('original_data', data=np.arange(8))
+        counts, lengths = self.project.get_spectra(["legacy.dat", "test_data_2.dat"])
+        self.assertEqual(counts.shape, (2, 8))
+        self.assertTrue(np.array_equal(counts[1], np.array([2, 3, 4, 5, 6, 0, 0, 0])))
+
+    def test_metadata_table(self):
+        file_paths = []
+        for i in range(4):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths[:3], pressure=1.0, crystal="olivine")
+        self.project.import_files(file_paths[3:], pressure=2.0, crystal="olivine")
+
+        # The metadata is stored as columns, with crystal names encoded as categories
+        self.assertNotIn('pressure', self.project.h5file['data']["test_data_0.dat"].attrs)
+        table_group = self.project.h5file['file_metadata']
+        self.assertEqual(table_group['crystal'].dtype, np.int32)
+        self.assertEqual(list(table_group['crystal_categories'].asstr()[()]), ['', 'olivine'])
+
+        self.project.set_dataset_metadata("test_data_1.dat", {'power': 5.0, 'calibration': "calib_1", 'note': "ok"})
+        self.assertEqual(self.project.find_files_by_pressure_and_crystal(1.0, "olivine"),
+                         ["test_data_0.dat", "test_data_1.dat", "test_data_2.dat"])
+        self.assertEqual(self.project.find_datasets_by_metadata_dict({'calibration': "calib_1", 'note': "ok"}),
+                         ["test_data_1.dat"])
+        self.assertEqual(self.project.find_datasets_by_metadata('pressure', "not a number"), [])
+        metadata = self.project.get_metadata_of_datasets(["test_data_3.dat", "test_data_1.dat"], ('pressure', 'power'))
+        self.assertEqual(metadata, {'pressure': [2.0, 1.0], 'power': [None, 5.0]})
+        with self.assertRaises(ValueError):
+            self.project.add_metadata_to_dataset("test_data_1.dat", 'power', "high")
+        # A value that is not a number leaves the whole row unchanged, and the files table rejects it before
+        with self.assertRaises(ValueError):
+            self.project.set_dataset_metadata("test_data_1.dat", {'chi_angle': 45.0, 'power': "high"})
+        self.assertIsNone(self.project.get_metadata_of_datasets(["test_data_1.dat"], ('chi_angle',))['chi_angle'][0])
+        file_model = FileTableModel()
+        messages, edits = [], []
+        file_model.validation_failed.connect(messages.append)
+        file_model.data_changed_signal.connect(lambda row, name, metadata: edits.append(metadata))
+        file_model.addFilesWithMetadata([("test_data_1.dat", "", None, None, 5.0, None, None)])
+        edits.clear()
+        self.assertFalse(file_model.setData(file_model.index(1, 4), "high"))
+        self.assertFalse(file_model.setData(file_model.index(0, 4), {'value': "high", 'use_default': True}))
+        self.assertTrue(file_model.setData(file_model.index(1, 2), "45"))
+        self.assertEqual(len(messages), 2)
+        self.assertEqual([metadata['chi_angle'] for metadata in edits], [45.0])
+        self.assertEqual(file_model.data(file_model.index(1, 4)), 5.0)
+
+        # Removed files free their row, and the table survives a save
+        self.project.remove_dataset("test_data_0.dat")
+        self.project.save_project()
+        self.project.h5file.close()
+        self.project.h5file = None
+        self.project.load_h5file()
+        self.assertEqual(self.project.find_files_by_pressure_and_crystal(1.0, "olivine"),
+                         ["test_data_1.dat", "test_data_2.dat"])
+        self.project.add_metadata_to_dataset("test_data_2.dat", 'crystal', "garnet")
+        self.assertEqual(self.project.find_datasets_by_metadata('crystal', "garnet"), ["test_data_2.dat"])
+
+        # Projects written before the table existed get it from the attributes of their groups when loaded,
+        # and the next save writes it
+        self.project.save_project()
+        self.project.cleanup_temp_file()
+        with h5py.File(self.project.h5file_path, 'r+') as h5file:
+            del h5file['file_metadata']
+            del h5file.attrs['schema_version']
+            legacy_group = h5file['data']["test_data_3.dat"]
+            legacy_group.attrs['pressure'] = 7.0
+            legacy_group.attrs['crystal'] = "quartz"
+        self.project.load_h5file()
+        self.assertTrue(self.project.check_unsaved_changes())
+        self.assertEqual(self.project.find_files_by_pressure_and_crystal(7.0, "quartz"), ["test_data_3.dat"])
+        self.project.save_project()
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            self.assertIn('file_metadata', h5file)
+
+    def test_fit_results(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.add_velocity("v1")
+        self.project.import_files(file_paths)
+
+        # Files get no velocity groups; results are NaN until set
+        self.assertNotIn('velocities', self.project.h5file['data']["test_data_0.dat"])
+        self.assertTrue(np.isnan(self.project.get_peak_fit_data("test_data_0.dat", "v1")['left_fwhm']))
+        self.assertEqual(self.project.get_peak_fit_data("test_data_0.dat", "unknown"), {})
+        self.project.set_peak_fit_data("test_data_1.dat", "v1", {'left_fwhm': 1.5, 'offset_ch': 2})
+        with self.assertRaises(ValueError):
+            self.project.set_peak_fit_data("test_data_1.dat", "v1", {'not_a_field': 1.0})
+
+        # Adding a velocity resizes the array; renaming keeps the results and removing clears them
+        self.project.add_velocity("v2")
+        self.project.set_peak_fit_data("test_data_2.dat", "v2", {'right_area': 4.0})
+        self.project.rename_velocity("v1", "v3")
+        velocities, values = self.project.get_file_fit_results("test_data_1.dat")
+        self.assertEqual(velocities, ["v2", "v3"])
+        self.assertEqual(values.shape, (2, 18))
+        self.assertEqual(self.project.get_peak_fit_data("test_data_1.dat", "v3")['left_fwhm'], 1.5)
+        file_names, values = self.project.get_velocity_fit_results("v3")
+        self.assertEqual(file_names, ["test_data_0.dat", "test_data_1.dat", "test_data_2.dat"])
+        np.testing.assert_array_equal(values[:, 5], [np.nan, 2.0, np.nan])
+        self.project.remove_velocity("v2")
+        self.project.add_velocity("v4")
+        self.assertTrue(np.isnan(self.project.get_peak_fit_data("test_data_2.dat", "v4")['right_area']))
+
+        # The results survive a save, and removed files free their row
+        self.project.remove_dataset("test_data_0.dat")
+        self.project.save_project()
+        self.project.h5file.close()
+        self.project.h5file = None
+        self.project.load_h5file()
+        self.project.add_velocity("v5")
+        self.assertEqual(self.project.get_peak_fit_data("test_data_1.dat", "v3")['offset_ch'], 2.0)
+        self.assertTrue(np.isnan(self.project.get_peak_fit_data("test_data_1.dat", "v5")['offset_ch']))
+
+        # Projects written before the array existed get it from the velocity groups of their files when loaded;
+        # attributes that are not fields are kept, in the project and by the migration
+        self.project.save_project()
+        self.project.cleanup_temp_file()
+        with h5py.File(self.project.h5file_path, 'r+') as h5file:
+            del h5file['fit_results']
+            del h5file.attrs['schema_version']
+            legacy_group = h5file['data']["test_data_2.dat"].create_group('velocities').create_group("v3")
+            legacy_group.attrs['left_sigma'] = 0.5
+            legacy_group.attrs['left_gamma'] = np.nan
+            legacy_group.attrs['operator'] = "AB"
+        self.project.load_h5file()
+        self.assertTrue(self.project.check_unsaved_changes())
+        self.assertEqual(self.project.get_peak_fit_data("test_data_2.dat", "v3")['left_sigma'], 0.5)
+        velocities, values = self.project.get_file_fit_results("test_data_2.dat")
+        self.assertEqual(velocities, ["v3", "v4", "v5"])
+        self.assertEqual(self.project.h5file['data/test_data_2.dat/velocities/v3'].attrs['operator'], "AB")
+        self.project.cleanup_temp_file()
+        migrate_project(self.project.h5file_path)
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            self.assertEqual(dict(h5file['data/test_data_2.dat/velocities/v3'].attrs), {'operator': "AB"})
+
+    def test_spectra_shards(self):
+        file_paths = []
+        for i in range(4):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n" + "4\n" * i)
+            file_paths.append(dat_file_path)
+        self.project.set_storage_options(spectra_layout='shards', shard_by='pressure')
+        self.project.import_files(file_paths[:2], pressure=1.0)
+        self.project.import_files(file_paths[2:], pressure=2.0)
+
+        # Each pressure has its own shard file; the project only keeps the metadata of the files
+        shards_folder = os.path.join(self.test_dir.name, "test_project_shards")
+        self.assertEqual(sorted(os.listdir(shards_folder)), ["pressure_1.h5", "pressure_2.h5"])
+        group = self.project.h5file['data']["test_data_3.dat"]
+        self.assertEqual(group.attrs['shard'], "pressure_2")
+        self.assertNotIn('original_data', group)
+        np.testing.assert_array_equal(self.project.get_file_data("test_data_3.dat"), [3, 2, 3, 4, 4, 4])
+        counts, lengths = self.project.get_spectra(["test_data_2.dat", "test_data_0.dat"])
+        np.testing.assert_array_equal(lengths, [5, 3])
+        np.testing.assert_array_equal(counts[1], [0, 2, 3, 0, 0, 0])
+
+        # A removed file keeps its spectrum until the removal is saved
+        self.project.remove_dataset("test_data_1.dat")
+        with h5py.File(os.path.join(shards_folder, "pressure_1.h5"), 'r') as shard:
+            self.assertIn("test_data_1.dat", list(shard['spectra/names'].asstr()[()]))
+        self.project.save_project()
+        with h5py.File(os.path.join(shards_folder, "pressure_1.h5"), 'r') as shard:
+            self.assertNotIn("test_data_1.dat", list(shard['spectra/names'].asstr()[()]))
+
+        # The saved project presents all the shards as one virtual array, with paths relative to the project
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            names = list(h5file['sharded_spectra/names'].asstr()[()])
+            row = names.index("test_data_3.dat")
+            np.testing.assert_array_equal(h5file['sharded_spectra/counts'][row, :6], [3, 2, 3, 4, 4, 4])
+            self.assertEqual(h5file['shards'].get("pressure_2", getlink=True).filename,
+                             os.path.join("test_project_shards", "pressure_2.h5"))
+
+        # Spectra written by a session that is not saved are freed when the project is loaded again
+        extra_path = os.path.join(self.test_dir.name, "extra.dat")
+        with open(extra_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("9\n9\n")
+        self.project.import_files([extra_path], pressure=1.0)
+        self.project.cleanup_temp_file()
+        self.project.load_h5file()
+        self.assertNotIn("extra.dat", self.project.spectra_shards)
+        counts, lengths = self.project.get_spectra()
+        np.testing.assert_array_equal(lengths, [3, 5, 6])
+
+        # A file removed and imported again is written to a new entry, so discarding the session keeps the saved one
+        self.project.remove_dataset("test_data_3.dat")
+        with open(file_paths[3], "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("7\n7\n7\n7\n")
+        self.project.import_files([file_paths[3]], pressure=2.0)
+        np.testing.assert_array_equal(self.project.get_file_data("test_data_3.dat"), [7, 7, 7, 7])
+        self.project.cleanup_temp_file()
+        self.project.load_h5file()
+        np.testing.assert_array_equal(self.project.get_file_data("test_data_3.dat"), [3, 2, 3, 4, 4, 4])
+
+        # Once the new file is saved, the spectrum of the old one is freed
+        self.project.remove_dataset("test_data_3.dat")
+        self.project.import_files([file_paths[3]], pressure=2.0)
+        self.project.save_project()
+        with h5py.File(os.path.join(shards_folder, "pressure_2.h5"), 'r') as shard:
+            names = [name for name in shard['spectra/names'].asstr()[()] if name]
+            self.assertEqual(sorted(names), ["test_data_2.dat", "test_data_3.dat@1"])
+        self.project.cleanup_temp_file()
+        self.project.load_h5file()
+        np.testing.assert_array_equal(self.project.get_file_data("test_data_3.dat"), [7, 7, 7, 7])
+
+    def test_schema_migration(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.add_velocity("v1")
+        self.project.import_files(file_paths, pressure=1.0, crystal="olivine")
+        self.assertEqual(self.project.h5file.attrs['schema_version'], 2)
+
+        # Rewrite the project with the version 1 layout: metadata and fit results as attributes of the groups
+        del self.project.h5file['file_metadata']
+        del self.project.h5file['fit_results']
+        del self.project.h5file.attrs['schema_version']
+        for name, group in self.project.h5file['data'].items():
+            group.attrs['pressure'] = 1.0
+            group.attrs['crystal'] = "olivine"
+            group.create_group('velocities').create_group("v1").attrs['left_fwhm'] = 0.5
+        self.project.save_project()
+        self.project.cleanup_temp_file()
+        self.assertEqual(read_schema_version(self.project.h5file_path), 1)
+
+        report = migrate_project(self.project.h5file_path, progress_callback=lambda done, total: None)
+        self.assertTrue(report['migrated'])
+        self.assertEqual((report['from_version'], report['files']), (1, 3))
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir.name, "test_project.v1.h5")))
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            self.assertEqual(h5file.attrs['schema_version'], 2)
+            group = h5file['data']["test_data_0.dat"]
+            self.assertNotIn('pressure', group.attrs)
+            self.assertNotIn('velocities', group)
+            self.assertIn('header', group.attrs)
+            np.testing.assert_array_equal(group['original_data'][()], [0, 2, 3])
+
+        self.project.load_h5file()
+        self.assertEqual(self.project.find_files_by_pressure_and_crystal(1.0, "olivine"),
+                         ["test_data_0.dat", "test_data_1.dat", "test_data_2.dat"])
+        self.assertEqual(self.project.get_peak_fit_data("test_data_2.dat", "v1")['left_fwhm'], 0.5)
+        self.project.cleanup_temp_file()
+
+        # Batch migration skips projects that are up to date, and newer layouts are refused
+        entries = migrate_projects([self.project.h5file_path], max_workers=1)
+        self.assertEqual([entry['status'] for entry in entries], ['skipped'])
+        with h5py.File(self.project.h5file_path, 'a') as h5file:
+            h5file.attrs['schema_version'] = 3
+        with self.assertRaises(ValueError):
+            self.project.load_h5file()
+
+    def test_in_memory_mode(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths[:1], pressure=1.0, crystal='A')
+        self.project.save_project()
+        self.project.cleanup_temp_file()
+
+        # Changes stay in RAM: no temporary file is written until an autosave
+        self.project = BrillouinProject(self.test_dir.name, self.project_name, in_memory=True, autosave_interval=None)
+        self.project.load_h5file()
+        self.assertEqual(self.project.h5file.driver, 'core')
+        self.assertFalse(os.path.exists(self.project.temp_h5file_path))
+        self.project.import_files(file_paths[1:], pressure=2.0, crystal='B')
+        self.assertFalse(self.project.poll_autosave())
+        self.assertFalse(os.path.exists(self.project.temp_h5file_path))
+        self.assertTrue(self.project.check_unsaved_changes())
+        usage = self.project.get_memory_usage()
+        self.assertTrue(usage['in_memory'])
+        self.assertEqual(usage['file_bytes'], self.project.h5file.id.get_filesize())
+        self.assertGreaterEqual(usage['required_bytes'], usage['file_bytes'])
+
+        # An autosave writes the working copy to the temporary file, from which the session can be recovered
+        self.project.autosave_interval = 0
+        self.project.set_dataset_metadata('test_data_1.dat', {'crystal': 'C'})
+        self.assertTrue(os.path.exists(self.project.temp_h5file_path))
+        self.assertFalse(self.project.poll_autosave())  # Nothing changed since
+        self.project.h5file.close()
+        self.project.h5file = None
+        recovered = BrillouinProject(self.test_dir.name, self.project_name, in_memory=True)
+        self.assertTrue(recovered.has_recoverable_session())
+        recovered.load_h5file(recover=True)
+        self.project = recovered
+        self.assertEqual(self.project.get_metadata_from_dataset('test_data_1.dat', 'crystal'), 'C')
+
+        # Saving writes the project file and deletes the autosave, now older than the project
+        self.project.save_project()
+        self.assertFalse(os.path.exists(self.project.temp_h5file_path))
+        self.project.cleanup_temp_file()
+        reloaded = BrillouinProject(self.test_dir.name, self.project_name)
+        reloaded.load_h5file()
+        self.project = reloaded
+        self.assertEqual(self.project.list_datasets(), ['test_data_0.dat', 'test_data_1.dat', 'test_data_2.dat'])
+        self.assertEqual(self.project.get_metadata_from_dataset('test_data_2.dat', 'pressure'), 2.0)
+        self.assertEqual(self.project.get_metadata_from_dataset('test_data_1.dat', 'crystal'), 'C')
+        np.testing.assert_array_equal(self.project.get_spectra(['test_data_2.dat'])[0], [[2, 2, 3]])
+
+    def test_overlay_mode(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.set_storage_options(spectra_layout='shards')
+        self.project.import_files(file_paths[:2], pressure=1.0)
+        self.project.save_project()
+        self.project.cleanup_temp_file()
+        project_size = os.path.getsize(self.project.h5file_path)
+
+        # The project is not copied: changes go to a delta file in the scratch folder
+        scratch_folder = os.path.join(self.test_dir.name, "scratch")
+        self.project = BrillouinProject(self.test_dir.name, self.project_name, scratch_folder=scratch_folder,
+                                        overlay=True)
+        self.project.load_h5file()
+        self.assertEqual(os.path.dirname(self.project.delta_path), scratch_folder)
+        self.assertFalse(os.path.exists(self.project.temp_h5file_path))
+        self.project.import_files(file_paths[2:], pressure=2.0)
+        self.project.set_dataset_metadata('test_data_0.dat', {'crystal': 'C'})
+        self.assertEqual(os.path.getsize(self.project.h5file_path), project_size)
+        self.assertTrue(os.path.exists(self.project.delta_path))
+        counts, lengths = self.project.get_spectra(['test_data_2.dat', 'test_data_0.dat'])
+        np.testing.assert_array_equal(counts, [[2, 2, 3], [0, 2, 3]])
+        self.assertTrue(self.project.check_unsaved_changes())
+
+        # The delta of an interrupted session is recovered
+        self.project.h5file.close()
+        self.project.h5file = None
+        recovered = BrillouinProject(self.test_dir.name, self.project_name, scratch_folder=scratch_folder,
+                                     overlay=True)
+        self.assertTrue(recovered.has_recoverable_session())
+        recovered.load_h5file(recover=True)
+        self.project = recovered
+        self.assertEqual(self.project.list_datasets(), ['test_data_0.dat', 'test_data_1.dat', 'test_data_2.dat'])
+
+        # Saving replaces the project file and starts a new delta over it
+        self.project.save_project()
+        self.assertFalse(self.project.check_unsaved_changes())
+        self.assertEqual(self.project.get_metadata_from_dataset('test_data_0.dat', 'crystal'), 'C')
+        self.project.h5file.close()
+        self.project.h5file = None
+
+        # A delta made over a version of the project file that has since changed is not applied
+        os.utime(self.project.h5file_path, ns=(0, 0))
+        stale = BrillouinProject(self.test_dir.name, self.project_name, scratch_folder=scratch_folder, overlay=True)
+        with self.assertRaises(OSError):
+            stale.load_h5file(recover=True)
+
+        reloaded = BrillouinProject(self.test_dir.name, self.project_name)
+        reloaded.load_h5file()
+        self.project = reloaded
+        self.assertEqual(self.project.get_metadata_from_dataset('test_data_2.dat', 'pressure'), 2.0)
+        np.testing.assert_array_equal(self.project.get_file_data('test_data_2.dat'), [2, 2, 3])
+
+    def test_repack(self):
+        file_paths = []
+        for i in range(20):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write("\n".join(str((i * j) % 97) for j in range(10000)))
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths)
+        self.project.save_project()
+
+        # Removing most files leaves the working copy mostly free, so saving compacts it
+        for i in range(15):
+            self.project.remove_dataset(f"test_data_{i}.dat")
+        size = os.path.getsize(self.project.temp_h5file_path)
+        self.project.save_project()
+        self.assertLess(os.path.getsize(self.project.temp_h5file_path), size)
+        self.assertEqual(len(self.project.list_datasets()), 5)
+
+        # A repack can store the data already in the project with other options, which new data then uses
+        expected = self.project.get_file_data("test_data_19.dat")
+        report = self.project.repack(compression='lzf', shuffle=False)
+        self.assertTrue(report['repacked'])
+        self.assertGreater(report['rewritten'], 0)
+        self.assertEqual(report['bytes_reclaimed'], report['bytes_before'] - report['bytes_after'])
+        self.assertEqual(self.project.get_storage_options()['compression'], 'lzf')
+        group = self.project.h5file['data']["test_data_19.dat"]
+        self.assertEqual(group['original_data'].compression, 'lzf')
+        np.testing.assert_array_equal(self.project.get_file_data("test_data_19.dat"), expected)
+        self.assertFalse(self.project.check_unsaved_changes())
+
+        with self.assertRaises(ValueError):
+            self.project.repack(spectra_layout='matrix')
+        with self.assertRaises(ValueError):
+            repack_project(self.project.h5file_path, options={'compression': 'zstd'})
+
+
+
+    def test_incremental_save(self):
+        from unittest import mock
+
+        file_paths = []
+        for i in range(6):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i % 3}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths[:4], pressure=1.0)
+        self.project.add_calibration("calib_1")
+        self.project.import_files_to_calibration("calib_1", file_paths[:2])
+        self.project.add_velocity("v1")
+        self.project.save_project()
+        with h5py.File(self.project.h5file_path, 'r+') as h5file:
+            h5file['data']["test_data_3.dat"].attrs['marker'] = 1  # Only kept if the group is not rewritten
+
+        # Edits of every kind are written into the project file, which ends up like the working copy
+        self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', 2.0)
+        self.project.add_metadata_to_dataset("test_data_0.dat", 'note', 'edited')
+        self.project.set_peak_fit_data("test_data_1.dat", "v1", {'left_fwhm': 1.5})
+        self.project.remove_dataset("test_data_2.dat")
+        self.project.import_files(file_paths[4:])
+        self.project.update_calibration_attributes("calib_1", mirror_spacing=5.0)
+        self.project.update_peak_fit("calib_1", "test_data_0.dat", left_peak_fit={'center': 1.0, 'x_fit': [1, 2]})
+        self.project.rename_calibration("calib_1", "calib_2")
+        self.project.remove_file_from_calibration("calib_2", "test_data_1.dat")
+        self.project.add_calibration("calib_1")
+        self.project.add_pressure(3.0)
+        # Whether there are unsaved changes is told by the changes recorded, without reading the files
+        with mock.patch.object(self.project, '_compare_h5_files', side_effect=AssertionError):
+            self.assertTrue(self.project.check_unsaved_changes())
+            self.project.save_project()
+            self.assertFalse(self.project.check_unsaved_changes())
+        with h5py.File(self.project.h5file_path, 'r+') as h5file:
+            # Objects that did not change are not rewritten
+            self.assertIn('marker', h5file['data']["test_data_3.dat"].attrs)
+            del h5file['data']["test_data_3.dat"].attrs['marker']
+            self.assertEqual(snapshot(h5file), snapshot(self.project.h5file))
+
+        # A recovered session, whose changes were not recorded, is saved in full
+        self.project.add_metadata_to_dataset("test_data_3.dat", 'pressure', 4.0)
+        self.project.h5file.close()
+        self.project.h5file = None
+        recovered = BrillouinProject(self.test_dir.name, self.project_name)
+        recovered.load_h5file(recover=True)
+        self.project = recovered
+        self.project.save_project()
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            self.assertEqual(snapshot(h5file), snapshot(self.project.h5file))
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data_3.dat", 'pressure'), 4.0)
+
+        # Project files without free-space tracking are written in full once, then get it
+        self.project.h5file.close()
+        self.project.h5file = None
+        old_path = self.project.h5file_path + '.old'
+        with h5py.File(self.project.h5file_path, 'r') as source, h5py.File(old_path, 'w') as old:
+            for key, value in source.attrs.items():
+                old.attrs[key] = value
+            for name in source:
+                source.copy(source[name], old, name=name)
+        os.replace(old_path, self.project.h5file_path)
+        self.project.load_h5file()
+        self.project.remove_calibration("calib_1")
+        self.project.save_project()
+        with h5py.File(self.project.h5file_path, 'r') as h5file:
+            self.assertTrue(h5file.id.get_create_plist().get_file_space_strategy()[1])
+            self.assertEqual(snapshot(h5file), snapshot(self.project.h5file))
+
+        # A group created since the last save is saved even when what was created in it has been removed
+        self.project.cleanup_temp_file()
+        self.project = BrillouinProject(self.test_dir.name, "fresh_project")
+        self.project.create_h5file()
+        self.project.save_project()
+        self.project.add_calibration("calib_1")
+        self.project.remove_calibration("calib_1")
+        self.project.save_project()
+        self.assertEqual(self.project.check_unsaved_changes(detailed=True),
+                         {'added': [], 'removed': [], 'altered': []})
+
+    def test_atomic_save(self):
+        from unittest import mock
+        import brillouin_project
+
+        self.project.h5file.close()
+        self.project = BrillouinProject(folder=self.test_dir.name, project_name=self.project_name, backups=2)
+        self.project.create_h5file()
+        project_path = self.project.h5file_path
+        saving_path = project_path + '.saving'
+
+        def saved_pressure(path):
+            with h5py.File(path, 'r') as h5file:
+                return h5file['file_metadata/pressure'][0]
+
+        dat_file_path = os.path.join(self.test_dir.name, "test_data.dat")
+        with open(dat_file_path, "w") as f:
+            f.write("Header line\n" * 12)
+            f.write("1\n2\n3\n")
+        self.project.import_files([dat_file_path], pressure=1.0)
+        self.project.save_project()  # Written in full: the project file was just created
+        self.assertFalse(os.path.exists(saving_path))
+        self.assertTrue(os.path.exists(project_path + '.1'))
+
+        # The previous versions are rotated, the oldest dropped
+        for pressure in (2.0, 3.0):
+            self.project.add_metadata_to_dataset("test_data.dat", 'pressure', pressure)
+            self.project.save_project()
+        self.assertEqual(saved_pressure(project_path), 3.0)
+        self.assertEqual(saved_pressure(project_path + '.1'), 2.0)
+        self.assertEqual(saved_pressure(project_path + '.2'), 1.0)
+        self.assertFalse(os.path.exists(project_path + '.3'))
+
+        # A save failing midway leaves the project file as it was, and the next save writes all the changes
+        def fail(*args):
+            raise OSError("No space left on device")
+
+        self.project.add_metadata_to_dataset("test_data.dat", 'pressure', 4.0)
+        with mock.patch.object(brillouin_project, 'copy_member', fail):
+            with self.assertRaises(OSError):
+                self.project.save_project()  # Incremental
+            with mock.patch.object(self.project, '_save_changes', return_value=False), self.assertRaises(OSError):
+                self.project.save_project()  # In full
+        self.assertFalse(os.path.exists(saving_path))
+        self.assertEqual(saved_pressure(project_path), 3.0)
+        self.assertEqual(saved_pressure(project_path + '.1'), 2.0)
+        self.project.save_project()
+        self.assertEqual(saved_pressure(project_path), 4.0)
+
+        # Without backups, only the project file is written
+        self.project.backups = 0
+        os.remove(project_path + '.1')
+        self.project.add_metadata_to_dataset("test_data.dat", 'pressure', 5.0)
+        self.project.save_project()
+        self.assertEqual(saved_pressure(project_path), 5.0)
+        self.assertFalse(os.path.exists(project_path + '.1'))
+
+    def test_in_place_save(self):
+        from unittest import mock
+        import brillouin_project
+
+        rng = np.random.default_rng(0)
+        file_paths = []
+        for i in range(8):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write("\n".join(map(str, rng.integers(0, 2 ** 30, 50000))) + "\n")
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths, pressure=1.0)
+        self.project.save_project()  # Written in full: the project file was just created
+        project_path = self.project.h5file_path
+
+        def saved_pressure(path):
+            with h5py.File(path, 'r') as h5file:
+                return h5file['file_metadata/pressure'][0]
+
+        def fail(*args):
+            raise OSError("Copied the project file")
+
+        # Without reflinks, the changes are written into the project file; the first such save copies it to the
+        # backup, the next ones bring the backup up to date with the changes of the previous save
+        with mock.patch.object(brillouin_project, 'reflink_file', return_value=False):
+            self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', 2.0)
+            self.project.save_project()
+            inode = os.stat(project_path).st_ino
+            self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', 3.0)
+            with mock.patch.object(brillouin_project, 'copy_file', fail):
+                self.project.save_project()
+        self.assertEqual(os.stat(project_path).st_ino, inode)
+        self.assertLess(os.path.getsize(project_path + '.1.redo'), os.path.getsize(project_path) / 20)
+        self.assertEqual(saved_pressure(project_path), 3.0)
+        self.assertEqual(saved_pressure(project_path + '.1'), 2.0)
+        with h5py.File(project_path, 'r') as h5file:
+            self.assertEqual(snapshot(h5file), snapshot(self.project.h5file))
+
+        # A save interrupted while the project file is written is completed when the project is loaded again
+        self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', 4.0)
+        with mock.patch.object(brillouin_project, 'reflink_file', return_value=False), \
+                mock.patch.object(self.project, '_apply_redo_log', side_effect=OSError("Power loss")):
+            with self.assertRaises(OSError):
+                self.project.save_project()
+        self.assertTrue(os.path.exists(project_path + '.redo'))
+        self.assertEqual(saved_pressure(project_path + '.1'), 3.0)
+        self.project.cleanup_temp_file()
+        self.project.load_h5file()
+        self.assertFalse(os.path.exists(project_path + '.redo'))
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data_0.dat", 'pressure'), 4.0)
+
+        # A save in full replaces the project file, so the next one copies it to the backup again
+        self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', 5.0)
+        with mock.patch.object(self.project, '_save_changes', return_value=False):
+            self.project.save_project()
+        self.assertFalse(os.path.exists(project_path + '.1.redo'))
+        self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', 6.0)
+        with mock.patch.object(brillouin_project, 'reflink_file', return_value=False):
+            self.project.save_project()
+        self.assertEqual(saved_pressure(project_path), 6.0)
+        self.assertEqual(saved_pressure(project_path + '.1'), 5.0)
+
+    def test_mutation_journal(self):
+        file_paths = []
+        for i in range(5):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths[:2], pressure=1.0)
+        self.project.save_project()
+
+        def crash():
+            # The application ends without closing the project, and its temporary file is lost
+            self.project.h5file.close()
+            self.project.h5file = None
+            self.project._close_journal()
+            os.remove(self.project.temp_h5file_path)
+            self.project = BrillouinProject(folder=self.test_dir.name, project_name=self.project_name)
+
+        # Edits of every kind, made directly or through imports, are replayed on the saved project
+        self.project.import_files(file_paths[2:4], pressure=2.0)
+        self.project.register_files(file_paths[4:])
+        self.project.set_dataset_metadata("test_data_0.dat", {'pressure': 3.0, 'note': 'edited'})
+        self.project.add_velocity("v1")
+        self.project.set_peak_fit_data("test_data_1.dat", "v1", {'left_fwhm': 1.5})
+        self.project.add_calibration("calib_1")
+        self.project.import_files_to_calibration("calib_1", file_paths[:2])
+        self.project.update_peak_fit("calib_1", "test_data_0.dat",
+                                     left_peak_fit={'center': 1.0, 'x_fit': np.linspace(0.0, 1.0, 5)})
+        self.project.rename_calibration("calib_1", "calib_2")
+        self.project.remove_dataset("test_data_2.dat")
+        self.project.add_array_to_dataset("test_data_3.dat", "extra", np.arange(3.0))
+        expected = snapshot(self.project.h5file)
+        crash()
+        with open(self.project.journal_path, 'ab') as f:
+            f.write(b'\x40\x00\x00\x00torn')  # A record cut short by the crash is dropped
+        self.assertTrue(self.project.has_recoverable_session())
+        self.project.load_h5file(recover=True)
+        self.assertEqual(snapshot(self.project.h5file), expected)
+        report = self.project.import_files(file_paths[:4])  # The import manifest was replayed too
+        self.assertEqual([entry['status'] for entry in report], ['skipped', 'skipped', 'imported', 'skipped'])
+        self.assertEqual(report[3]['message'], "Unchanged since it was last imported.")
+
+        # Changes made after a replay are journaled after the replayed ones
+        self.project.add_metadata_to_dataset("test_data_1.dat", 'pressure', 4.0)
+        # Runs of table edits are replayed in batches, the last value of a cell winning, up to the next operation
+        for value in (5.0, None, 6.0):
+            self.project.set_dataset_metadata("test_data_3.dat", {'pressure': value, 'crystal': f"c{value}"})
+            self.project.set_peak_fit_data("test_data_3.dat", "v1", {'left_fwhm': value})
+        self.project.remove_dataset("test_data_3.dat")
+        self.project.set_dataset_metadata("test_data_1.dat", {'pressure': 7.0})
+        self.project.set_peak_fit_data("test_data_1.dat", "v1", {'right_fwhm': 2.0})
+        expected = snapshot(self.project.h5file)
+        crash()
+        self.project.load_h5file(recover=True)
+        self.assertEqual(snapshot(self.project.h5file), expected)
+
+        # A save empties the journal, and a journal following another version of the project is not replayed
+        self.project.save_project()
+        crash()
+        self.assertFalse(self.project.has_recoverable_session())
+        self.project.load_h5file()
+        self.project.remove_velocity("v1")
+        crash()
+        os.utime(self.project.h5file_path, ns=(0, 0))
+        self.assertFalse(self.project.has_recoverable_session())
+        self.project.load_h5file(recover=True)
+        self.assertIn("v1", self.project.h5file.attrs['velocities'])
+
+    def test_undo_redo(self):
+        file_paths = []
+        for i in range(3):
+            dat_file_path = os.path.join(self.test_dir.name, f"test_data_{i}.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * 12)
+                f.write(f"{i}\n2\n3\n")
+            file_paths.append(dat_file_path)
+        self.project.import_files(file_paths, pressure=1.0, crystal='MgO')
+        for velocity in ("v1", "v2"):
+            self.project.add_velocity(velocity)
+        self.project.set_peak_fit_data("test_data_1.dat", "v1", {'left_fwhm': 1.5, 'right_area': 2.0})
+        self.project.add_pressure(1.0)
+        self.project.add_crystal('MgO')
+        self.assertIsNone(self.project.history.redo_label())
+        before = snapshot(self.project.h5file)
+
+        # A filled column is undone and redone as one step; the values it replaced are restored exactly
+        with self.project.undo_group("Fill column"):
+            for i in range(3):
+                self.project.add_metadata_to_dataset(f"test_data_{i}.dat", 'chi_angle', 45.0)
+        self.project.set_dataset_metadata("test_data_0.dat", {'chi_angle': 45.0})  # Changes nothing, no step
+        self.assertEqual(self.project.history.undo_label(), "Fill column")
+        changes = self.project.undo()
+        self.assertEqual(changes['label'], "Fill column")
+        self.assertEqual(changes['files'], {f"test_data_{i}.dat" for i in range(3)})
+        self.assertEqual(snapshot(self.project.h5file), before)
+        self.project.redo()
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data_2.dat", 'chi_angle'), 45.0)
+        self.project.undo()
+
+        # A removed velocity comes back at its place, with its fit results; a new change empties the redo stack
+        self.project.remove_velocity("v1")
+        self.project.add_array_to_dataset("test_data_0.dat", "extra", np.arange(3.0))
+        self.project.remove_crystal('MgO')
+        for _ in range(3):
+            self.project.undo()
+        self.assertEqual(snapshot(self.project.h5file), before)
+        self.assertEqual(self.project.get_peak_fit_data("test_data_1.dat", "v1")['left_fwhm'], 1.5)
+        self.project.redo()
+        self.project.redo()  # The array removed by the undo is linked back
+        self.assertEqual(self.project.h5file['data/test_data_0.dat/extra'][()].tolist(), [0.0, 1.0, 2.0])
+        changes = self.project.undo()
+        self.assertEqual(changes['files'], {"test_data_0.dat"})
+        self.project.set_peak_fit_data("test_data_2.dat", "v3", {'left_fwhm': 3.0})
+        self.assertIsNone(self.project.history.redo_label())
+        changes = self.project.undo()
+        self.assertEqual(changes['attributes'], {'velocities'})
+        self.assertNotIn("v3", self.project.get_unique_pressures_crystals_velocities()[2])
+        changes = self.project.undo()
+        self.assertEqual(changes['attributes'], {'velocities'})
+        self.assertEqual(changes['peak_fits'], {"test_data_1.dat"})
+        self.assertEqual(list(self.project.h5file.attrs['velocities']), ["v1", "v2"])
+
+        # Undoing is journaled: the project recovered after a crash is the one left by the undo and redo
+        self.project.redo()
+        self.project.redo()  # The array removed is journaled by its contents
+        expected = snapshot(self.project.h5file)
+        self.project.h5file.close()
+        self.project.h5file = None
+        self.project._close_journal()
+        os.remove(self.project.temp_h5file_path)
+        self.project = BrillouinProject(folder=self.test_dir.name, project_name=self.project_name)
+        self.project.load_h5file(recover=True)
+        self.assertEqual(snapshot(self.project.h5file), expected)
+        self.assertIsNone(self.project.history.undo_label())
+        with self.assertRaises(ValueError):
+            self.project.undo()
+
+        # Changes that cannot be undone forget the history; beyond the memory limit, the oldest steps are forgotten
+        self.project.add_crystal('Si')
+        self.project.remove_dataset("test_data_2.dat")
+        self.assertEqual(len(self.project.history), 0)
+        self.project.history.limit = 4096
+        for i in range(50):
+            self.project.add_metadata_to_dataset("test_data_0.dat", 'pressure', float(i))
+        self.assertLessEqual(self.project.history.size, 4096)
+        self.assertLess(len(self.project.history), 50)
+        while self.project.history.undo_label():
+            self.project.undo()
+        self.assertEqual(self.project.get_metadata_from_dataset("test_data_0.dat", 'pressure'),
+                         49.0 - len(self.project.history))
+
 
 if __name__ == '__main__':
     unittest.main()
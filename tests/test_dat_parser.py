@@ -0,0 +1,64 @@
+import unittest
+import os
+import numpy as np
+from tempfile import TemporaryDirectory
+import sys
+
+# Add the repository root to the system path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.utils.dat_parser import HEADER_LINES, decode_counts, parse_dat_bytes, parse_header, read_dat_file
+
+
+class TestDatParser(unittest.TestCase):
+
+    def test_read_dat_file(self):
+        with TemporaryDirectory() as test_dir:
+            dat_file_path = os.path.join(test_dir, "test_data.dat")
+            with open(dat_file_path, "w") as f:
+                f.write("Header line\n" * HEADER_LINES)
+                f.write("1\n2\n3\n4\n5\n")
+
+            dat_file = read_dat_file(dat_file_path)
+
+            self.assertEqual(dat_file.name, "test_data.dat")
+            self.assertEqual(dat_file.header, ["Header line"] * HEADER_LINES)
+            self.assertTrue(np.array_equal(dat_file.counts, np.array([1, 2, 3, 4, 5])))
+            with open(dat_file_path, "rb") as f:
+                self.assertEqual(dat_file.raw_content, f.read())
+
+    def test_crlf_line_endings(self):
+        raw = b"Header line\r\n" * HEADER_LINES + b"10\r\n20\r\n30\r\n"
+        dat_file = parse_dat_bytes(raw)
+        self.assertEqual(dat_file.header[0], "Header line")
+        self.assertTrue(np.array_equal(dat_file.counts, np.array([10, 20, 30])))
+
+    def test_malformed_lines_are_skipped(self):
+        # Matches the historical rule: only lines that are purely digits after stripping are kept
+        counts = decode_counts(b"1\n 2 \n\n-3\n4.5\nabc\n6\n")
+        self.assertTrue(np.array_equal(counts, np.array([1, 2, 6])))
+
+    def test_empty_body(self):
+        self.assertEqual(len(decode_counts(b"")), 0)
+        self.assertEqual(len(decode_counts(b"\n\r\n")), 0)
+        self.assertEqual(len(parse_dat_bytes(b"Header line\n" * 3).counts), 0)
+
+    def test_parse_header(self):
+        header = ["TFP-2 HC", "No. of Scans: 250", "Mirror spacing (mm) = 4.5", "Date: 03/14/2024",
+                  "Time: 10:22:05", "Comment: sample A: run 1", "Scans: 999"]
+        metadata = parse_header(header)
+        self.assertEqual(metadata['no_of_scans'], 250)
+        self.assertEqual(metadata['mirror_spacing'], 4.5)
+        self.assertEqual(metadata['date'], "2024-03-14")
+        self.assertEqual(metadata['comment'], "sample A: run 1")
+        self.assertNotIn('tfp_2_hc', metadata)
+
+        raw = ("\n".join(header) + "\n" * (HEADER_LINES - len(header) + 1) + "1\n2\n").encode('latin-1')
+        dat_file = parse_dat_bytes(raw)
+        self.assertEqual(dat_file.scans, 999)  # 'scans' takes precedence over the other spellings
+        self.assertEqual(dat_file.acquisition_time, "2024-03-14T10:22:05")
+        self.assertIsNone(parse_dat_bytes(b"Header line\n" * HEADER_LINES).scans)
+
+
+if __name__ == '__main__':
+    unittest.main()